@@ -0,0 +1,306 @@
+"""Rerun benchmark: drives class_monitor.py headlessly through Streamlit's AppTest
+
+For each roster size it seeds a synthetic snapshot and history, logs in and
+scripts the interactions an aide makes, reporting rerun time, elements rendered,
+dataframe cells and Arrow bytes sent, and peak Python memory for each.
+
+    python benchmarks/bench_rerun.py                      # 11, 100 and 1000 students
+    python benchmarks/bench_rerun.py --students 100 --repeat 5 --skip-memory
+    python benchmarks/bench_rerun.py --grades-per-student 200 --todos-per-student 60
+    python benchmarks/bench_rerun.py --json results.json
+
+AppTest reruns the whole script for every interaction, fragments included, and
+always renders expander bodies, so timings are an upper bound on a browser session's.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import streamlit as st  # noqa: E402
+import streamlit.logger  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+# Streamlit would otherwise warn that it is running without a server on every cached call
+streamlit.logger.set_log_level("error")
+
+import canvas_sync  # noqa: E402
+from canvas_sync import AnnouncementRecord, ConversationRecord, GradeRecord, TodoRecord  # noqa: E402
+
+APP_PATH = os.path.join(ROOT, "class_monitor.py")
+PASSWORD = "bench"
+COHORT_SIZE = 25
+COURSES_PER_STUDENT = 6
+ISSUES = ["Missing", "Zero Grade", "Unsubmitted"]
+
+
+def iso(moment):
+    return moment.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def student_names(count):
+    return [f"Student{i:04d}" for i in range(count)]
+
+
+def synthetic_snapshot(students, args, now, seed=0):
+    """Builds a Snapshot with the requested rows per student, spread over the dashboard's time windows"""
+    rng = random.Random(seed)
+    grades, conversations, announcements, todos = [], [], [], []
+    for s, name in enumerate(student_names(students)):
+        courses = [(s % 40) * COURSES_PER_STUDENT + c for c in range(COURSES_PER_STUDENT)]
+        for i in range(args.grades_per_student):
+            course_id = courses[i % len(courses)]
+            grades.append(GradeRecord(
+                name, course_id, course_id * 1000 + i, f"Assignment {i}", f"Course {course_id}",
+                rng.choice(ISSUES), iso(now - timedelta(days=rng.uniform(0, 60))), "unsubmitted"
+            ))
+        for i in range(args.messages_per_student):
+            conversations.append(ConversationRecord(
+                name, f"Message {i}", "Please check the feedback on your last submission.",
+                iso(now - timedelta(days=rng.uniform(0, 21))), f"Teacher {i % 4}"
+            ))
+        for i in range(args.announcements_per_student):
+            course_id = courses[i % len(courses)]
+            announcements.append(AnnouncementRecord(
+                name, course_id * 1000 + i, f"Announcement {i}", "Reminder about this week's due dates.",
+                iso(now - timedelta(days=rng.uniform(0, 21))), f"Course {course_id}"
+            ))
+        for i in range(args.todos_per_student):
+            todos.append(TodoRecord(
+                name, f"Task {i}", iso(now + timedelta(days=rng.uniform(0, 14))),
+                rng.choice(["Todo", "Submitted"])
+            ))
+    return canvas_sync.build_dataframes(grades, conversations, announcements, todos)
+
+
+def write_roster(path, students):
+    """Writes a roster.toml that splits the students into cohorts of COHORT_SIZE"""
+    names = student_names(students)
+    with open(path, "w") as f:
+        f.write("[cohorts]\n")
+        for start in range(0, len(names), COHORT_SIZE):
+            members = ", ".join(f'"{name}"' for name in names[start:start + COHORT_SIZE])
+            f.write(f'"Cohort {start // COHORT_SIZE + 1}" = [{members}]\n')
+
+
+def seed_data(workdir, students, args):
+    """Writes the roster, snapshot and history the app reads; returns (snapshot path, snapshot)"""
+    now = datetime.now(timezone.utc)
+    write_roster(os.path.join(workdir, "roster.toml"), students)
+    snapshot = synthetic_snapshot(students, args, now)
+
+    history_path = os.path.join(workdir, "history")
+    for i in range(args.history_syncs, 0, -1):
+        canvas_sync.append_history(snapshot, now - timedelta(hours=6 * i), students, root=history_path)
+
+    snapshot_path = os.path.join(workdir, "snapshot.sqlite3")
+    canvas_sync.write_snapshot(snapshot_path, snapshot, now)
+    return snapshot_path, snapshot
+
+
+def new_app(workdir, snapshot_path, students, timeout):
+    """An AppTest for class_monitor.py with secrets pointing at workdir's synthetic data"""
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.secrets["passwords"] = {"auth": PASSWORD}
+    at.secrets["tokens"] = {name: f"token-{name}" for name in student_names(students)}
+    at.secrets["roster"] = {"path": os.path.join(workdir, "roster.toml")}
+    at.secrets["sync"] = {"snapshot_path": snapshot_path}
+    at.secrets["history"] = {"path": os.path.join(workdir, "history")}
+    at.secrets["logging"] = {"level": "WARNING"}
+    return at
+
+
+def find_widget(widgets, key=None, label=None):
+    """The first widget with key or label, or None if this rerun didn't render it"""
+    for widget in widgets:
+        if (key is not None and widget.key == key) or (label is not None and widget.label == label):
+            return widget
+    return None
+
+
+def set_radio(key=None, label=None, value=None):
+    def interact(at, state):
+        radio = find_widget(at.radio, key=key, label=label)
+        return radio and radio.set_value(value)
+    return interact
+
+
+def set_number(key, value):
+    def interact(at, state):
+        widget = find_widget(at.number_input, key=key)
+        return widget and widget.set_value(value)
+    return interact
+
+
+def set_text(key, value):
+    def interact(at, state):
+        widget = find_widget(at.text_input, key=key)
+        return widget and widget.input(value)
+    return interact
+
+
+def pick_all_cohorts(at, state):
+    widget = find_widget(at.multiselect, label="Choose cohorts to monitor:")
+    return widget and widget.set_value(widget.options)
+
+
+def new_sync(at, state):
+    """Rewrites the snapshot as a later sync would, then clicks Refresh Now to load it"""
+    refreshed_at = datetime.now(timezone.utc)
+    canvas_sync.write_snapshot(state["snapshot_path"], state["snapshot"], refreshed_at)
+    stamp = time.time() + state.setdefault("syncs", 0) + 1
+    state["syncs"] += 1
+    os.utime(state["snapshot_path"], (stamp, stamp))  # Coarse mtimes could hide the rewrite
+    button = find_widget(at.button, label="🔄 Refresh Now")
+    return button and button.click()
+
+
+# (name, interaction); an interaction arranges the next rerun on at and returns a falsy
+# value when the widget it needs isn't on the page (e.g. a one-page breakdown).
+INTERACTIONS = [
+    ("rerun, no change", lambda at, state: at),
+    ("assignments: This Week", set_radio(key="assignment_filter", value="This Week")),
+    ("assignments: Next 2 Weeks", set_radio(key="assignment_filter", value="Next 2 Weeks")),
+    ("messages: Last 3 Days", set_radio(key="email_filter", value="Last 3 Days")),
+    ("messages: Last 3 Weeks", set_radio(key="email_filter", value="Last 3 Weeks (All)")),
+    ("announcements: Last Week", set_radio(key="announcement_filter", value="Last Week")),
+    ("grades breakdown: page 2", set_number("grades_page", 2)),
+    ("grades breakdown: search", set_text("grades_search", "Student000")),
+    ("grades breakdown: clear search", set_text("grades_search", "")),
+    ("trends: Zero Grades", set_radio(key="trend_metric", value="Zero Grades")),
+    ("trends: Grade Alerts", set_radio(key="trend_metric", value="Grade Alerts")),
+    ("students: By Cohort", set_radio(label="Select students:", value="By Cohort")),
+    ("students: every cohort", pick_all_cohorts),
+    ("students: All Students", set_radio(label="Select students:", value="All Students")),
+    ("new sync + Refresh Now", new_sync),
+]
+
+
+def count_elements(node):
+    """Counts the rendered elements under node, not counting the containers that hold them"""
+    children = getattr(node, "children", None)
+    if children is None:
+        return 1
+    return sum(count_elements(child) for child in children.values())
+
+
+def measure(at, run, trace_memory):
+    """Runs one rerun and returns its measurements"""
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - started
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    if at.exception:
+        raise RuntimeError(f"class_monitor.py raised: {at.exception[0].value}")
+    tables = list(at.dataframe) + list(at.table)
+    return {
+        "seconds": elapsed,
+        "elements": count_elements(at._tree),
+        "dataframe_cells": sum(df.value.size for df in tables),
+        "arrow_bytes": sum(len(df.proto.arrow_data.data) for df in tables),
+        "peak_memory_bytes": peak,
+    }
+
+
+def run_session(workdir, snapshot_path, snapshot, students, args):
+    """Logs in once and performs every interaction; returns {name: measurements}"""
+    # The data store and trend cache are process-wide; start each session from a cold app
+    st.cache_resource.clear()
+    st.cache_data.clear()
+
+    at = new_app(workdir, snapshot_path, students, args.timeout)
+    trace_memory = not args.skip_memory
+    state = {"snapshot_path": snapshot_path, "snapshot": snapshot}
+    results = {"first load (password prompt)": measure(at, at.run, trace_memory)}
+    password = at.text_input(key="password").input(PASSWORD)
+    results["log in"] = measure(at, password.run, trace_memory)
+
+    for name, interact in INTERACTIONS:
+        arranged = interact(at, state)
+        results[name] = measure(at, at.run, trace_memory) if arranged else None
+    return results
+
+
+def bench_roster(students, args):
+    """Benchmarks one roster size; returns a result row per interaction, timings aggregated over the repeats"""
+    with tempfile.TemporaryDirectory() as workdir:
+        snapshot_path, snapshot = seed_data(workdir, students, args)
+        sessions = [run_session(workdir, snapshot_path, snapshot, students, args) for _ in range(args.repeat)]
+
+    results = []
+    for name in sessions[0]:
+        runs = [session[name] for session in sessions if session[name] is not None]
+        if not runs:
+            results.append({"students": students, "interaction": name, "skipped": True})
+            continue
+        peaks = [run["peak_memory_bytes"] for run in runs if run["peak_memory_bytes"] is not None]
+        results.append({
+            "students": students,
+            "interaction": name,
+            "skipped": False,
+            "median_seconds": round(statistics.median(run["seconds"] for run in runs), 4),
+            "max_seconds": round(max(run["seconds"] for run in runs), 4),
+            "elements": runs[-1]["elements"],
+            "dataframe_cells": runs[-1]["dataframe_cells"],
+            "arrow_bytes": runs[-1]["arrow_bytes"],
+            "peak_memory_bytes": max(peaks) if peaks else None,
+        })
+    return results
+
+
+def format_row(result):
+    if result["skipped"]:
+        return f"{result['students']:>8} {result['interaction']:<32} {'(not on the page)':>9}"
+    peak = result["peak_memory_bytes"]
+    return (f"{result['students']:>8} {result['interaction']:<32} {result['median_seconds']:>9.3f} "
+            f"{result['max_seconds']:>9.3f} {result['elements']:>9} {result['dataframe_cells']:>9} "
+            f"{result['arrow_bytes'] / 1e6:>9.2f} "
+            f"{'-' if peak is None else f'{peak / 1e6:.1f}':>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark class_monitor.py reruns with Streamlit's AppTest")
+    parser.add_argument("--students", type=int, nargs="+", default=[11, 100, 1000],
+                        help="roster sizes to benchmark (default: 11 100 1000)")
+    parser.add_argument("--grades-per-student", type=int, default=30, help="grade alert rows per student")
+    parser.add_argument("--messages-per-student", type=int, default=10, help="unread message rows per student")
+    parser.add_argument("--announcements-per-student", type=int, default=8, help="announcement rows per student")
+    parser.add_argument("--todos-per-student", type=int, default=12, help="to-do rows per student")
+    parser.add_argument("--history-syncs", type=int, default=3,
+                        help="earlier syncs written to the history, for the trends and the 🆕 column")
+    parser.add_argument("--repeat", type=int, default=3, help="sessions per roster size; timings are medians")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds AppTest waits for one rerun")
+    parser.add_argument("--skip-memory", action="store_true", help="don't trace peak memory (faster, cleaner timings)")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = parser.parse_args()
+
+    print(f"{'students':>8} {'interaction':<32} {'median s':>9} {'max s':>9} {'elements':>9} "
+          f"{'df cells':>9} {'arrow MB':>9} {'peak MB':>9}")
+    results = []
+    for students in args.students:
+        for result in bench_roster(students, args):
+            print(format_row(result), flush=True)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Sync benchmark: runs the canvas_sync fetch layer against a local fake Canvas
+
+For each roster size it starts a FakeCanvas in a child process, runs one full sync_students pass
+(and optionally an incremental re-sync) and reports wall time, request count,
+bytes transferred, throttled requests, peak Python memory and the in-memory size of
+the resulting snapshot frames.
+
+    python benchmarks/bench_sync.py                      # 11, 100 and 1000 students
+    python benchmarks/bench_sync.py --students 11 100 --latency-ms 100 --resync
+    python benchmarks/bench_sync.py --backend graphql --json results.json
+    python benchmarks/bench_sync.py --sections grades todos   # what the dashboard syncs by default
+    python benchmarks/bench_sync.py --stall-rate 0.05 --deadline 15   # wedged courses vs. the sync deadline
+    python benchmarks/bench_sync.py --revoked 0.1 --resync  # requests spent on revoked tokens
+
+Peak memory comes from tracemalloc and covers only the sync (the server runs in
+its own process). Tracing slows Python down noticeably; pass --skip-memory when
+only the timings matter.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+
+import canvas_sync  # noqa: E402
+from fake_canvas import FakeCanvas, serve_in_subprocess  # noqa: E402
+
+
+def run_sync(url, tokens, client, max_concurrent, sync_state, trace_memory, sections=canvas_sync.SECTIONS,
+             deadline_seconds=None):
+    """Runs one sync against the fake Canvas at url and returns its measurements"""
+    requests.post(f"{url}/_fake/reset").raise_for_status()
+    if trace_memory:
+        tracemalloc.start()
+
+    incomplete = {}
+    started = time.perf_counter()
+    frames = canvas_sync.sync_students(tokens, max_concurrent=max_concurrent, client=client, sync_state=sync_state,
+                                        sections=sections, incomplete=incomplete, deadline_seconds=deadline_seconds)
+    elapsed = time.perf_counter() - started
+
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    stats = requests.get(f"{url}/_fake/stats").json()
+    grades_df, convos_df, announcements_df, todos_df = frames
+    return {
+        "wall_seconds": round(elapsed, 3),
+        "requests": stats["requests"],
+        "bytes": stats["bytes"],
+        "throttled": stats["throttled"],
+        "stalled": stats["stalled"],
+        "incomplete_students": len(incomplete),
+        "peak_memory_bytes": peak,
+        "frame_bytes": sum(int(df.memory_usage(deep=True).sum()) for df in frames if df is not None),
+        "rows": {
+            "grades": 0 if grades_df is None else len(grades_df),
+            "conversations": 0 if convos_df is None else len(convos_df),
+            "announcements": 0 if announcements_df is None else len(announcements_df),
+            "todos": 0 if todos_df is None else len(todos_df),
+        },
+        "by_endpoint": stats["by_endpoint"],
+    }
+
+
+def bench_roster(students, args):
+    """Benchmarks one roster size; returns a list of result rows (full sync, then resync)"""
+    options = dict(students=students, courses_per_student=args.courses_per_student,
+                   submissions_per_course=args.submissions_per_course,
+                   latency=args.latency_ms / 1000, page_size=args.page_size, stall_rate=args.stall_rate)
+    url, server = serve_in_subprocess(**options)
+    tokens = FakeCanvas(**options).tokens()
+    # Revoked tokens: the fake server answers every request from them with a 401
+    for name in list(tokens)[:int(students * args.revoked)]:
+        tokens[name] = f"revoked-{tokens[name]}"
+    canvas_sync.configure(api_url=url, backend=args.backend)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = canvas_sync.ResponseCache(os.path.join(cache_dir, "responses.sqlite3")) if args.cache else None
+        client = canvas_sync.CanvasClient(pool_size=args.concurrency * 2, cache=cache)
+        sync_state = {}
+
+        results = []
+        passes = ["full", "resync"] if args.resync else ["full"]
+        for sync_pass in passes:
+            result = run_sync(url, tokens, client, args.concurrency, sync_state, not args.skip_memory, args.sections,
+                              args.deadline)
+            results.append({"students": students, "pass": sync_pass, "backend": args.backend, **result})
+
+    server.terminate()
+    return results
+
+
+def format_row(result):
+    peak = result["peak_memory_bytes"]
+    return (f"{result['students']:>8} {result['pass']:>7} {result['wall_seconds']:>9.2f} "
+            f"{result['requests']:>9} {result['bytes'] / 1e6:>9.2f} {result['throttled']:>9} "
+            f"{'-' if peak is None else f'{peak / 1e6:.1f}':>9} {result['frame_bytes'] / 1e6:>9.2f} "
+            f"{result['rows']['grades']:>9} {result['incomplete_students']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark canvas_sync against a local fake Canvas")
+    parser.add_argument("--students", type=int, nargs="+", default=[11, 100, 1000],
+                        help="roster sizes to benchmark (default: 11 100 1000)")
+    parser.add_argument("--courses-per-student", type=int, default=6)
+    parser.add_argument("--submissions-per-course", type=int, default=40)
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="delay added to every request")
+    parser.add_argument("--page-size", type=int, default=100, help="largest per_page the fake server honours")
+    parser.add_argument("--concurrency", type=int, default=canvas_sync.MAX_CONCURRENT_REQUESTS,
+                        help="max students and requests in flight (default: MAX_CONCURRENT_REQUESTS)")
+    parser.add_argument("--backend", choices=["rest", "graphql"], default="rest")
+    parser.add_argument("--sections", nargs="+", choices=canvas_sync.SECTIONS, default=canvas_sync.SECTIONS,
+                        help="data types to sync (default: all)")
+    parser.add_argument("--stall-rate", type=float, default=0.0,
+                        help="fraction of courses whose submissions requests hang on the fake server")
+    parser.add_argument("--deadline", type=float, default=0,
+                        help="sync deadline in seconds (default: none, so every request finishes)")
+    parser.add_argument("--revoked", type=float, default=0.0,
+                        help="fraction of students whose token Canvas rejects")
+    parser.add_argument("--cache", action="store_true", help="use a fresh on-disk response cache")
+    parser.add_argument("--resync", action="store_true", help="also time an incremental re-sync after the full one")
+    parser.add_argument("--skip-memory", action="store_true", help="don't trace peak memory (faster, cleaner timings)")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = parser.parse_args()
+
+    print(f"{'students':>8} {'pass':>7} {'wall s':>9} {'requests':>9} {'MB':>9} {'throttled':>9} "
+          f"{'peak MB':>9} {'frames MB':>9} {'alerts':>9} {'incomplete':>10}")
+    results = []
+    for students in args.students:
+        for result in bench_roster(students, args):
+            print(format_row(result), flush=True)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,492 @@
+"""Local stand-in for the Canvas endpoints the class monitor uses
+
+Serves synthetic data for a configurable roster so syncs can be measured without
+touching wvm.instructure.com or real student tokens. Implements:
+
+    GET  /api/v1/planner/items
+    GET  /api/v1/courses
+    GET  /api/v1/conversations
+    GET  /api/v1/announcements
+    GET  /api/v1/courses/:id/students/submissions
+    GET  /api/v1/users/self
+    GET  /api/v1/users/self/missing_submissions
+    POST /api/graphql                 (the allCourses query used by the graphql backend)
+
+Responses are paginated with Link headers, every request costs rate-limit units
+from a per-token leaky bucket (reported in X-Rate-Limit-Remaining / X-Request-Cost,
+and a 403 "Rate Limit Exceeded" once it runs dry), and each request can be delayed
+to simulate network latency. A fraction of courses can be made to stall: their
+submissions requests hang for stall_seconds, like a wedged Canvas connection.
+Data is generated deterministically from a seed when requested, so server memory
+stays flat at any roster size.
+
+Benchmarks should run it with serve_in_subprocess, so the server's own CPU time and
+allocations don't leak into the client's measurements; the stats are then read
+over HTTP from /_fake/stats and reset with POST /_fake/reset.
+
+Run it standalone and set [sync] api_url = "http://127.0.0.1:8765" in secrets.toml to
+point the dashboard (or canvas_sync.py) at it:
+
+    python benchmarks/fake_canvas.py --students 100 --port 8765
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+# Canvas buckets start at 700 units and refill at roughly 10 units a second
+RATE_LIMIT_BUCKET = 700.0
+RATE_LIMIT_REFILL_PER_SECOND = 10.0
+
+SUBMISSIONS_PATH = re.compile(r"^/api/v1/courses/(\d+)/students/submissions$")
+# Submission states Course.submissionsConnection returns when the query has no states filter
+GRAPHQL_DEFAULT_STATES = {"submitted", "pending_review", "graded"}
+
+
+def iso(moment):
+    return moment.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class FakeCanvas:
+    """A threaded HTTP server with a synthetic roster of students, courses and submissions
+
+    students get tokens "fake-token-<n>" (see tokens()). Each student is enrolled in
+    courses_per_student courses drawn from a shared pool sized for about
+    students_per_course students per course, and has submissions_per_course
+    submissions in each. latency is added to every request, in seconds.
+    page_size caps per_page the way Canvas does. request_cost is the rate-limit
+    cost of one request; set rate_limit=False to turn throttling off. stall_rate is
+    the fraction of courses whose submissions requests hang for stall_seconds.
+    """
+
+    def __init__(self, students=11, courses_per_student=6, submissions_per_course=40,
+                 conversations_per_student=15, todos_per_student=12, announcements_per_course=3,
+                 students_per_course=25, latency=0.0, page_size=100, request_cost=1.0,
+                 rate_limit=True, stall_rate=0.0, stall_seconds=120.0, seed=0):
+        self.students = students
+        self.courses_per_student = courses_per_student
+        self.submissions_per_course = submissions_per_course
+        self.conversations_per_student = conversations_per_student
+        self.todos_per_student = todos_per_student
+        self.announcements_per_course = announcements_per_course
+        self.course_count = max(courses_per_student, students * courses_per_student // students_per_course)
+        self.latency = latency
+        self.page_size = page_size
+        self.request_cost = request_cost
+        self.rate_limit = rate_limit
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.seed = seed
+        self.now = datetime.now(timezone.utc).replace(microsecond=0)
+
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self.reset_stats()
+
+    # --- Lifecycle ---
+
+    def start(self, port=0):
+        """Starts serving on 127.0.0.1 in a daemon thread and returns the base URL"""
+        fake = self
+
+        class Handler(FakeCanvasHandler):
+            canvas = fake
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-canvas", daemon=True).start()
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def tokens(self):
+        """Maps student name -> token for the whole synthetic roster"""
+        return {f"Student{n:04d}": f"fake-token-{n}" for n in range(self.students)}
+
+    # --- Stats ---
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {"requests": 0, "bytes": 0, "throttled": 0, "stalled": 0, "by_endpoint": {}}
+
+    def record(self, endpoint, size, throttled=False):
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["bytes"] += size
+            self.stats["throttled"] += throttled
+            self.stats["by_endpoint"][endpoint] = self.stats["by_endpoint"].get(endpoint, 0) + 1
+
+    def spend(self, token):
+        """Charges one request to the token's bucket; returns (remaining, allowed)"""
+        now = time.monotonic()
+        with self._lock:
+            remaining, updated_at = self._buckets.get(token, (RATE_LIMIT_BUCKET, now))
+            remaining = min(RATE_LIMIT_BUCKET, remaining + (now - updated_at) * RATE_LIMIT_REFILL_PER_SECOND)
+            allowed = not self.rate_limit or remaining >= self.request_cost
+            if allowed:
+                remaining -= self.request_cost
+            self._buckets[token] = (remaining, now)
+        return remaining, allowed
+
+    # --- Synthetic data ---
+
+    def student_index(self, token):
+        match = re.fullmatch(r"Bearer fake-token-(\d+)", token or "")
+        if not match or int(match.group(1)) >= self.students:
+            return None
+        return int(match.group(1))
+
+    def stalls(self, course_id):
+        return self.stall_rate > 0 and self._rng("stall", course_id).random() < self.stall_rate
+
+    def _rng(self, *parts):
+        return random.Random(":".join(str(part) for part in (self.seed,) + parts))
+
+    def courses_for(self, student):
+        rng = self._rng("courses", student)
+        return sorted(rng.sample(range(1, self.course_count + 1), self.courses_per_student))
+
+    def course(self, course_id):
+        return {
+            "id": course_id,
+            "name": f"Course {course_id}",
+            "course_code": f"C{course_id:04d}",
+            "workflow_state": "available",
+            "enrollment_term_id": 1,
+            "start_at": iso(self.now - timedelta(weeks=8)),
+            "end_at": iso(self.now + timedelta(weeks=8)),
+        }
+
+    def assignment(self, course_id, index):
+        return {
+            "id": course_id * 10000 + index,
+            "name": f"Assignment {index + 1}",
+            "due_at": iso(self.now + timedelta(days=index - self.submissions_per_course // 2, hours=23)),
+            "points_possible": 10,
+            "course_id": course_id,
+        }
+
+    def submissions(self, student, course_id):
+        rng = self._rng("submissions", student, course_id)
+        rows = []
+        for index in range(self.submissions_per_course):
+            assignment = self.assignment(course_id, index)
+            past_due = assignment["due_at"] < iso(self.now)
+            roll = rng.random()
+            if past_due and roll < 0.05:
+                state, score, missing = "unsubmitted", None, True
+            elif past_due and roll < 0.08:
+                state, score, missing = "graded", 0, False
+            elif past_due:
+                state, score, missing = "graded", rng.randint(6, 10), False
+            else:
+                state, score, missing = ("submitted", None, False) if roll < 0.3 else ("unsubmitted", None, False)
+            changed_at = iso(self.now - timedelta(days=rng.randint(0, 30), minutes=rng.randint(0, 1440)))
+            rows.append({
+                "id": (student * 1000 + course_id) * 10000 + index,
+                "assignment_id": assignment["id"],
+                "user_id": student,
+                "score": score,
+                "grade": None if score is None else str(score),
+                "missing": missing,
+                "late": False,
+                "excused": False,
+                "workflow_state": state,
+                "attempt": None if state == "unsubmitted" else 1,
+                "submitted_at": None if state == "unsubmitted" else changed_at,
+                "graded_at": changed_at if state == "graded" else None,
+                "preview_url": f"{self.url}/courses/{course_id}/assignments/{assignment['id']}/submissions/{student}",
+                "_assignment": assignment,
+            })
+        return rows
+
+    def conversations(self, student):
+        rng = self._rng("conversations", student)
+        rows = []
+        for index in range(self.conversations_per_student):
+            # Newest first, spread over six weeks so the three-week cutoff stops pagination early
+            sent_at = self.now - timedelta(hours=index * 6 * 7 * 24 / max(self.conversations_per_student, 1))
+            rows.append({
+                "id": student * 1000 + index,
+                "subject": f"Message {index + 1}",
+                "workflow_state": "unread",
+                "last_message": f"<p>Reminder {index + 1} about {rng.choice(['labs', 'quizzes', 'essays'])}.</p>",
+                "last_message_at": iso(sent_at),
+                "message_count": 1,
+                "participants": [{"id": 1, "name": "Teacher"}, {"id": student, "name": f"Student{student:04d}"}],
+            })
+        return rows
+
+    def announcements(self, course_id):
+        rows = []
+        for index in range(self.announcements_per_course):
+            rows.append({
+                "id": course_id * 100 + index,
+                "title": f"Course {course_id} update {index + 1}",
+                "message": "<p>Please read the updated syllabus.</p>",
+                "posted_at": iso(self.now - timedelta(days=index * 5, hours=course_id % 24)),
+                "context_code": f"course_{course_id}",
+            })
+        return rows
+
+    def planner_items(self, student):
+        courses = self.courses_for(student)
+        rows = []
+        for index in range(self.todos_per_student):
+            course_id = courses[index % len(courses)]
+            submitted = (student + index) % 3 == 0
+            rows.append({
+                "plannable_id": course_id * 10000 + index,
+                "plannable_type": "assignment",
+                "course_id": course_id,
+                "plannable": {"id": course_id * 10000 + index, "title": f"Task {index + 1}"},
+                "plannable_date": iso(self.now + timedelta(days=index * 2, hours=23)),
+                "submissions": {"submitted": submitted, "graded": False, "missing": False},
+            })
+        return rows
+
+
+class FakeCanvasHandler(BaseHTTPRequestHandler):
+    """Routes requests to a FakeCanvas; subclassed in FakeCanvas.start to bind it"""
+
+    canvas = None
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without TCP_NODELAY every
+    # keep-alive response would stall ~40ms on Nagle + delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def _handle(self, method):
+        canvas = self.canvas
+        if canvas.latency:
+            time.sleep(canvas.latency)
+
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        endpoint = SUBMISSIONS_PATH.sub("/api/v1/courses/:id/students/submissions", parts.path)
+        token = self.headers.get("Authorization")
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0)) if method == "POST" else b""
+
+        if parts.path == "/_fake/stats":
+            return self._send_json(200, canvas.stats)
+        if parts.path == "/_fake/reset" and method == "POST":
+            canvas.reset_stats()
+            return self._send_json(200, canvas.stats)
+
+        student = canvas.student_index(token)
+        if student is None:
+            return self._reply(endpoint, 401, {"errors": [{"message": "Invalid access token."}]},
+                               {"WWW-Authenticate": 'Bearer realm="canvas-lms"'})
+
+        remaining, allowed = canvas.spend(token)
+        headers = {"X-Rate-Limit-Remaining": f"{remaining:.1f}", "X-Request-Cost": f"{canvas.request_cost:.1f}"}
+        if not allowed:
+            return self._reply(endpoint, 403, "403 Forbidden (Rate Limit Exceeded)", headers, throttled=True)
+
+        if method == "POST" and parts.path == "/api/graphql":
+            return self._reply(endpoint, 200, self._graphql(student, json.loads(body or b"{}")), headers)
+        if method != "GET":
+            return self._reply(endpoint, 404, {"errors": [{"message": "Not found"}]}, headers)
+
+        if parts.path == "/api/v1/users/self":
+            return self._reply(endpoint, 200, {"id": student + 1, "name": f"Student{student:04d}"}, headers)
+        if parts.path == "/api/v1/courses":
+            rows = [canvas.course(course_id) for course_id in canvas.courses_for(student)]
+        elif parts.path == "/api/v1/conversations":
+            rows = canvas.conversations(student)
+        elif parts.path == "/api/v1/planner/items":
+            rows = self._planner_items(student, query)
+        elif parts.path == "/api/v1/announcements":
+            rows = self._announcements(student, query)
+        elif parts.path == "/api/v1/users/self/missing_submissions":
+            rows = self._missing_submissions(student, query)
+        elif SUBMISSIONS_PATH.match(parts.path):
+            if canvas.stalls(int(SUBMISSIONS_PATH.match(parts.path).group(1))):
+                with canvas._lock:
+                    canvas.stats["stalled"] += 1
+                time.sleep(canvas.stall_seconds)
+            rows = self._submissions(student, int(SUBMISSIONS_PATH.match(parts.path).group(1)), query)
+            if rows is None:
+                return self._reply(endpoint, 403, {"errors": [{"message": "user not authorized"}]}, headers)
+        else:
+            return self._reply(endpoint, 404, {"errors": [{"message": "Not found"}]}, headers)
+
+        page, link = self._paginate(rows, parts.path, query)
+        if link:
+            headers["Link"] = link
+        self._reply(endpoint, 200, page, headers)
+
+    def _announcements(self, student, query):
+        enrolled = set(self.canvas.courses_for(student))
+        start = query.get("start_date", [""])[0]
+        rows = []
+        for code in query.get("context_codes[]", []):
+            course_id = int(code.replace("course_", ""))
+            if course_id in enrolled:
+                rows.extend(row for row in self.canvas.announcements(course_id) if row["posted_at"][:10] >= start)
+        return sorted(rows, key=lambda row: row["posted_at"], reverse=True)
+
+    def _planner_items(self, student, query):
+        # Dates compare as ISO strings; like Canvas, both ends are inclusive, so adjacent ranges share their boundary
+        start = query.get("start_date", [""])[0]
+        end = query.get("end_date", [None])[0]
+        return [row for row in self.canvas.planner_items(student)
+                if row["plannable_date"] >= start and (end is None or row["plannable_date"] <= end)]
+
+    def _submissions(self, student, course_id, query):
+        if course_id not in self.canvas.courses_for(student):
+            return None
+        include_assignment = "assignment" in query.get("include[]", [])
+        submitted_since = query.get("submitted_since", [None])[0]
+        graded_since = query.get("graded_since", [None])[0]
+        workflow_state = query.get("workflow_state", [None])[0]
+
+        rows = []
+        for row in self.canvas.submissions(student, course_id):
+            if workflow_state and row["workflow_state"] != workflow_state:
+                continue
+            if submitted_since and not (row["submitted_at"] and row["submitted_at"] >= submitted_since[:19]):
+                continue
+            if graded_since and not (row["graded_at"] and row["graded_at"] >= graded_since[:19]):
+                continue
+            assignment = row.pop("_assignment")
+            if include_assignment:
+                row["assignment"] = assignment
+            rows.append(row)
+        return rows
+
+    def _missing_submissions(self, student, query):
+        include_course = "course" in query.get("include[]", [])
+        now = iso(self.canvas.now)
+        rows = []
+        for course_id in self.canvas.courses_for(student):
+            for row in self.canvas.submissions(student, course_id):
+                assignment = row["_assignment"]
+                if row["missing"] or (row["workflow_state"] == "unsubmitted" and assignment["due_at"] < now):
+                    rows.append({**assignment, "course": self.canvas.course(course_id)} if include_course else assignment)
+        return rows
+
+    def _graphql(self, student, payload):
+        page_size = int(payload.get("variables", {}).get("pageSize", 100))
+        # Like Canvas, submissionsConnection leaves out unsubmitted work unless filter: {states: [...]} asks for it
+        states = re.search(r"states:\s*\[([^\]]*)\]", payload.get("query", ""))
+        states = set(re.findall(r"\w+", states.group(1))) if states else GRAPHQL_DEFAULT_STATES
+        courses = []
+        for course_id in self.canvas.courses_for(student):
+            course = self.canvas.course(course_id)
+            submissions = [row for row in self.canvas.submissions(student, course_id) if row["workflow_state"] in states]
+            nodes = [{
+                "score": row["score"],
+                "missing": row["missing"],
+                "excused": row["excused"],
+                "state": row["workflow_state"],
+                "assignment": {
+                    "_id": str(row["_assignment"]["id"]),
+                    "name": row["_assignment"]["name"],
+                    "dueAt": row["_assignment"]["due_at"],
+                },
+            } for row in submissions[:page_size]]
+            courses.append({
+                "_id": str(course_id),
+                "name": course["name"],
+                "courseCode": course["course_code"],
+                "state": "available",
+                "submissionsConnection": {"pageInfo": {"hasNextPage": len(submissions) > page_size}, "nodes": nodes},
+            })
+        return {"data": {"allCourses": courses}}
+
+    def _paginate(self, rows, path, query):
+        per_page = min(int(query.get("per_page", ["10"])[0]), self.canvas.page_size)
+        page = int(query.get("page", ["1"])[0])
+        start = (page - 1) * per_page
+        link = None
+        if start + per_page < len(rows):
+            next_query = {**query, "page": [str(page + 1)]}
+            link = f'<{self.canvas.url}{path}?{urlencode(next_query, doseq=True)}>; rel="next"'
+        return rows[start:start + per_page], link
+
+    def _reply(self, endpoint, status, payload, headers=None, throttled=False):
+        size = self._send_json(status, payload, headers)
+        self.canvas.record(endpoint, size, throttled)
+
+    def _send_json(self, status, payload, headers=None):
+        body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json" if not isinstance(payload, str) else "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+
+def _serve_forever(options, ready):
+    canvas = FakeCanvas(**options)
+    ready.put(canvas.start())
+    while True:
+        time.sleep(3600)
+
+
+def serve_in_subprocess(**options):
+    """Starts a FakeCanvas(**options) in a child process; returns (base_url, process)
+
+    Terminate the process when done. The roster's tokens are the same as
+    FakeCanvas(**options).tokens() would give in this process.
+    """
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve_forever, args=(options, ready), daemon=True)
+    process.start()
+    return ready.get(timeout=30), process
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--students", type=int, default=11)
+    parser.add_argument("--courses-per-student", type=int, default=6)
+    parser.add_argument("--submissions-per-course", type=int, default=40)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="fraction of courses whose submissions hang")
+    args = parser.parse_args()
+
+    canvas = FakeCanvas(students=args.students, courses_per_student=args.courses_per_student,
+                        submissions_per_course=args.submissions_per_course,
+                        latency=args.latency_ms / 1000, page_size=args.page_size, stall_rate=args.stall_rate)
+    url = canvas.start(args.port)
+    print(f"Fake Canvas serving {args.students} students at {url}")
+    print("Tokens: fake-token-0 ... " f"fake-token-{args.students - 1}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        canvas.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2478 @@
+"""Canvas fetch layer for the class monitor: HTTP client, fetchers, sync engine and normalization
+
+Nothing here depends on Streamlit, so syncs can run from scripts, cron and
+benchmarks as well as from the dashboard. pandas is only imported when frames are
+built, which keeps importing this module cheap.
+
+Run it directly to sync every student in the secrets file and write a snapshot
+the dashboard loads (see [sync] snapshot_path):
+
+    python canvas_sync.py --secrets .streamlit/secrets.toml --output .cache/snapshot.sqlite3
+"""
+import requests
+import copy
+import hashlib
+import glob
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
+from zoneinfo import ZoneInfo
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("canvas_sync")
+
+# --- CONFIGURATION ---
+# Defaults; the dashboard and other callers override them with configure()
+API_URL = "https://wvm.instructure.com"
+
+# Maximum number of Canvas requests in flight at once during a sync
+MAX_CONCURRENT_REQUESTS = 8
+
+# Canvas rate limiting: each token has a leaky bucket that starts at 700 units and
+# refills over time. Below RATE_LIMIT_LOW_WATER we start spacing out requests.
+RATE_LIMIT_LOW_WATER = 150
+RATE_LIMIT_REFILL_PER_SECOND = 10
+MAX_THROTTLE_DELAY = 5.0  # seconds
+MAX_RETRIES = 4
+
+# (connect, read) timeout for every Canvas request, in seconds
+REQUEST_TIMEOUT = (3.05, 15)
+# A sync stops sending requests after this many seconds and keeps whatever it has;
+# students it didn't finish are marked incomplete. None lets syncs run to completion.
+SYNC_DEADLINE_SECONDS = 120
+# After this many consecutive timeouts or 5xx responses from one Canvas path (each
+# course's submissions is its own path), requests to it are skipped for CIRCUIT_RESET_SECONDS.
+# Once a path has failed, requests stuck on it for CIRCUIT_STALL_SECONDS count as failures
+# while they wait, so one wedged endpoint can't tie up every worker until its requests time out.
+CIRCUIT_FAILURE_THRESHOLD = 3
+CIRCUIT_RESET_SECONDS = 5 * 60
+CIRCUIT_STALL_SECONDS = 10
+
+# Each token is checked with one /api/v1/users/self request this often (seconds);
+# a token Canvas rejects is skipped by every sync until it is checked again
+TOKEN_HEALTH_TTL = 60 * 60
+
+# Incremental sync: after the first sync, grades and announcements are fetched only
+# from each student's high-water mark. A full re-fetch still runs this often, which
+# also picks up time-based changes (assignments becoming past due) and deletions.
+FULL_SYNC_INTERVAL = timedelta(hours=6)
+
+# Canvas returns UTC timestamps; dates are shown in the school's timezone
+DISPLAY_TIMEZONE = "America/Los_Angeles"
+
+# Which API fetches courses and submissions: "rest" (one request per course) or
+# "graphql" (one query per student). To-dos, conversations and announcements always use REST.
+FETCH_BACKEND = "rest"
+
+# Announcements are fetched per course; this many context_codes[] go in one request
+ANNOUNCEMENT_CONTEXT_CHUNK = 10
+
+# On-disk response cache. Each endpoint stays fresh for its own TTL (seconds);
+# after that the cached copy is revalidated with If-None-Match / If-Modified-Since.
+CACHE_PATH = ".cache/canvas_responses.sqlite3"
+CACHE_MAX_BYTES = 200 * 1024 * 1024
+CACHE_TTLS = [
+    (r"^/api/v1/courses$", 24 * 60 * 60),               # Course lists change about once a term
+    (r"/students/submissions$", 10 * 60),
+    (r"^/api/v1/users/self/missing_submissions$", 10 * 60),
+    (r"^/api/v1/announcements$", 15 * 60),
+    (r"^/api/v1/planner/items$", 5 * 60),
+    (r"^/api/v1/conversations$", None),                  # Private messages are never written to disk
+]
+
+# Every sync's grade alerts and assignments are appended to a Parquet history here
+# (see HISTORY below); an empty path turns the history off
+HISTORY_PATH = ".cache/history"
+
+
+def configure(api_url=None, max_concurrent_requests=None, backend=None, cache_path=None, cache_max_mb=None,
+              history_path=None, deadline_seconds=None):
+    """Overrides the configuration defaults above; call before the first sync
+
+    Arguments left as None keep their current value; deadline_seconds=0 removes the deadline.
+    """
+    global API_URL, MAX_CONCURRENT_REQUESTS, FETCH_BACKEND, CACHE_PATH, CACHE_MAX_BYTES, HISTORY_PATH
+    global SYNC_DEADLINE_SECONDS
+    if api_url is not None:
+        API_URL = api_url.rstrip("/")
+    if max_concurrent_requests is not None:
+        MAX_CONCURRENT_REQUESTS = int(max_concurrent_requests)
+    if backend is not None:
+        FETCH_BACKEND = backend
+    if cache_path is not None:
+        CACHE_PATH = cache_path
+    if cache_max_mb is not None:
+        CACHE_MAX_BYTES = int(cache_max_mb) * 1024 * 1024
+    if history_path is not None:
+        HISTORY_PATH = history_path
+    if deadline_seconds is not None:
+        SYNC_DEADLINE_SECONDS = float(deadline_seconds) or None
+
+
+# --- INSTRUMENTATION ---
+
+# Fields that logging.LogRecord sets itself; anything else passed via extra= is structured data
+_LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Formats each log record as one JSON object per line, including fields passed via extra="""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _LOG_RECORD_FIELDS})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def setup_logging(level="INFO"):
+    """Sends canvas_sync logs to stderr as JSON lines; safe to call on every rerun"""
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonLogFormatter())
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(level)
+
+
+def endpoint_name(url):
+    """Canvas path with numeric ids replaced, e.g. /api/v1/courses/:id/students/submissions"""
+    return re.sub(r"/\d+(?=/|$)", "/:id", urlsplit(url).path)
+
+
+class SyncMetrics:
+    """Instrumentation for one sync: a record per Canvas request plus timed stages
+
+    Request records are tagged with the student (looked up from the token, which is
+    never stored) and the endpoint, and carry latency, status, response size, cache
+    use ("hit" when served from the cache without a request) and Canvas's rate-limit
+    cost / remaining headers. Each retry is its own record, so throttling shows up
+    as rows with throttled set. Requests that timed out or couldn't connect have status 0.
+    """
+
+    def __init__(self, student_tokens=None):
+        self.started_at = datetime.now(timezone.utc)
+        self.finished_at = None
+        self.requests = []
+        self.stages = []
+        self._students = {}
+        self._lock = threading.Lock()
+        self.add_students(student_tokens or {})
+
+    def add_students(self, student_tokens):
+        self._students.update({token: name for name, token in student_tokens.items()})
+
+    def record_request(self, method, url, token, status, seconds, size, cache=None, throttled=False, attempt=0,
+                       headers=None):
+        headers = headers or {}
+        record = {
+            "student": self._students.get(token, "unknown"),
+            "endpoint": endpoint_name(url),
+            "method": method,
+            "status": status,
+            "seconds": round(seconds, 4),
+            "bytes": size,
+            "cache": cache,
+            "throttled": throttled,
+            "attempt": attempt,
+            "cost": _header_float(headers, "X-Request-Cost"),
+            "remaining": _header_float(headers, "X-Rate-Limit-Remaining"),
+        }
+        with self._lock:
+            self.requests.append(record)
+        logger.debug("canvas request", extra=record)
+
+    @contextmanager
+    def stage(self, name):
+        """Times the enclosed block and records it as a named stage"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stages.append({"stage": name, "seconds": round(time.perf_counter() - started, 4)})
+
+    def finish(self):
+        self.finished_at = datetime.now(timezone.utc)
+        logger.info("sync finished", extra=self.totals())
+
+    def totals(self):
+        """Headline numbers for the whole sync"""
+        network = [record for record in self.requests if record["cache"] != "hit"]
+        end = self.finished_at or datetime.now(timezone.utc)
+        return {
+            "wall_seconds": round((end - self.started_at).total_seconds(), 3),
+            "requests": len(network),
+            "cache_hits": len(self.requests) - len(network),
+            "revalidated": sum(record["status"] == 304 for record in network),
+            "throttled": sum(record["throttled"] for record in network),
+            "errors": sum(record["status"] >= 400 or record["status"] == 0 for record in network),
+            "bytes": sum(record["bytes"] for record in network),
+            "request_seconds": round(sum(record["seconds"] for record in network), 3),
+        }
+
+    def summarize(self, by):
+        """Per-group request stats as a DataFrame, grouped by "endpoint", "student" or both"""
+        pd = _import_pandas()
+
+        df = pd.DataFrame(self.requests, columns=[
+            "student", "endpoint", "method", "status", "seconds", "bytes", "cache", "throttled", "attempt", "cost",
+            "remaining"
+        ])
+        if df.empty:
+            return df
+        df["network"] = df["cache"] != "hit"
+        df["error"] = (df["status"] >= 400) | (df["status"] == 0)
+        summary = df.groupby(by, sort=False).agg(
+            requests=("network", "sum"),
+            cache_hits=("network", lambda network: (~network).sum()),
+            errors=("error", "sum"),
+            throttled=("throttled", "sum"),
+            total_seconds=("seconds", "sum"),
+            p50_seconds=("seconds", "median"),
+            max_seconds=("seconds", "max"),
+            kb=("bytes", lambda size: round(size.sum() / 1024, 1)),
+            cost=("cost", "sum"),
+            min_remaining=("remaining", "min"),
+        )
+        return summary.sort_values("total_seconds", ascending=False).reset_index()
+
+    @classmethod
+    def from_json(cls, text):
+        """Rebuilds a finished sync's metrics from to_json output, e.g. from a snapshot file"""
+        data = json.loads(text)
+        metrics = cls()
+        metrics.started_at = datetime.fromisoformat(data["started_at"])
+        metrics.finished_at = datetime.fromisoformat(data["finished_at"]) if data["finished_at"] else None
+        metrics.stages = data["stages"]
+        metrics.requests = data["requests"]
+        return metrics
+
+    def to_json(self):
+        """The full diagnostics for this sync as a JSON string, for export"""
+        with self._lock:
+            return json.dumps({
+                "started_at": self.started_at.isoformat(),
+                "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+                "totals": self.totals(),
+                "stages": list(self.stages),
+                "requests": list(self.requests),
+            }, indent=2, default=str)
+
+
+def _header_float(headers, name):
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+# --- CANVAS HTTP CLIENT ---
+
+def is_rate_limited(response):
+    """True if Canvas throttled this request rather than rejecting the token"""
+    if response is None:
+        return False
+    if response.status_code == 429:
+        return True
+    return response.status_code == 403 and "Rate Limit Exceeded" in response.text
+
+
+class CachedResponse:
+    """Stand-in for requests.Response when a page is served from the response cache"""
+
+    status_code = 200
+    from_cache = True
+
+    def __init__(self, url, body, link_header):
+        self.url = url
+        self.content = body
+        self.headers = {"Link": link_header} if link_header else {}
+        self.links = {}
+        if link_header:
+            for link in requests.utils.parse_header_links(link_header):
+                self.links[link.get("rel") or link["url"]] = link
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+
+def cache_ttl(url):
+    """Seconds a cached response for this URL stays fresh before it must be revalidated
+
+    None means responses for the URL are never cached.
+    """
+    path = urlsplit(url).path
+    for pattern, ttl in CACHE_TTLS:
+        if re.search(pattern, path):
+            return ttl
+    return 0
+
+
+def make_private_dirs(path):
+    """Creates path and its missing parents, each readable by the current user only"""
+    path = os.path.abspath(path or ".")
+    missing = []
+    while not os.path.isdir(path):
+        missing.append(path)
+        path = os.path.dirname(path)
+    for directory in reversed(missing):
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+
+def create_private_file(path):
+    """Creates path if needed and makes it readable and writable by the current user only"""
+    os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+    os.chmod(path, 0o600)
+
+
+class ResponseCache:
+    """SQLite-backed cache of Canvas GET responses, shared across syncs and sessions
+
+    Entries are keyed by a hash of token, URL and params, so tokens are never
+    written to disk. Fresh entries are served without touching Canvas; stale ones
+    keep their ETag / Last-Modified so the client can revalidate with a
+    conditional request and get a bodyless 304 when nothing changed. When the
+    database grows past max_bytes, least recently used entries are evicted.
+    Bodies hold student data, so the database is readable by its owner only.
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path = path or CACHE_PATH
+        self.max_bytes = max_bytes or CACHE_MAX_BYTES
+        make_private_dirs(os.path.dirname(path))
+        create_private_file(path)  # SQLite gives its -wal and -shm files the same mode
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                link TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )
+        """)
+        self._db.commit()
+
+    @staticmethod
+    def make_key(token, url, params):
+        items = sorted((params or {}).items())
+        raw = json.dumps([token, url, items], default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def lookup(self, key):
+        """Returns the stored entry as a dict, or None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT body, link, etag, last_modified, fetched_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+        body, link, etag, last_modified, fetched_at = row
+        return {"body": body, "link": link, "etag": etag, "last_modified": last_modified, "fetched_at": fetched_at}
+
+    def store(self, key, response):
+        now = time.time()
+        body = response.content
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, body, response.headers.get("Link"), response.headers.get("ETag"),
+                 response.headers.get("Last-Modified"), now, now, len(body))
+            )
+            self._evict()
+            self._db.commit()
+
+    def mark_revalidated(self, key):
+        """Restarts an entry's TTL after Canvas answered 304 Not Modified"""
+        now = time.time()
+        with self._lock:
+            self._db.execute("UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE key = ?", (now, now, key))
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop least recently used entries until we're back under 90% of the limit
+        target = total - int(self.max_bytes * 0.9)
+        rows = self._db.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall()
+        doomed = []
+        for key, size in rows:
+            if target <= 0:
+                break
+            doomed.append((key,))
+            target -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", doomed)
+
+
+class SyncIncomplete(requests.RequestException):
+    """A request that was skipped or cut short, so its data is missing from this sync
+
+    Raised when the request timed out or couldn't connect, when the sync's deadline
+    has passed, or when the endpoint's circuit breaker is open. Fetchers report it
+    with report_incomplete and the student keeps their data from the last sync.
+    """
+
+
+class CircuitBreaker:
+    """Skips Canvas paths that keep failing instead of waiting on each one to time out
+
+    A path opens after threshold consecutive failures (timeouts, connection errors
+    and 5xx responses; 4xx responses are the token's problem, not the endpoint's).
+    After reset_seconds one trial request is let through: success closes the path
+    again, another failure re-opens it for another reset_seconds. Once a path's last
+    finished request failed, requests in flight on it for over stall_seconds count
+    towards threshold as well; slow requests alone never open a healthy path.
+    """
+
+    def __init__(self, threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS,
+                 stall_seconds=CIRCUIT_STALL_SECONDS):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.stall_seconds = stall_seconds
+        self._paths = {}  # path -> (consecutive failures, time.monotonic() when opened or None)
+        self._in_flight = {}  # path -> start times of requests still running
+        self._lock = threading.Lock()
+
+    def _blocked(self, path, now):
+        failures, opened_at = self._paths.get(path, (0, None))
+        if opened_at is not None:
+            return True
+        stuck = sum(now - started > self.stall_seconds for started in self._in_flight.get(path, []))
+        return failures > 0 and failures + stuck >= self.threshold
+
+    def acquire(self, path):
+        """Returns a ticket for sending a request to path, or None if the path is being skipped
+
+        Pass the ticket to release once the request is done.
+        """
+        now = time.monotonic()
+        with self._lock:
+            opened_at = self._paths.get(path, (0, None))[1]
+            if opened_at is not None:
+                if now - opened_at < self.reset_seconds:
+                    return None
+                # Half open: this caller is the trial. One more failure re-opens the path,
+                # and everyone else is skipped for another reset_seconds meanwhile.
+                self._paths[path] = (self.threshold - 1, now)
+            elif self._blocked(path, now):
+                return None
+            self._in_flight.setdefault(path, []).append(now)
+            return now
+
+    def release(self, path, ticket, ok):
+        """Ends a request from acquire; ok is True/False for success/failure, None if it says nothing about the path"""
+        with self._lock:
+            in_flight = self._in_flight.get(path, [])
+            in_flight.remove(ticket)
+            if not in_flight:
+                self._in_flight.pop(path, None)
+            if ok is None:
+                return
+            if ok:
+                self._paths.pop(path, None)
+                return
+            failures = self._paths.get(path, (0, None))[0] + 1
+            opened_at = time.monotonic() if failures >= self.threshold else None
+            self._paths[path] = (failures, opened_at)
+        if opened_at is not None:
+            logger.warning("circuit breaker opened", extra={"endpoint": path, "failures": failures})
+
+    def open_paths(self):
+        """Paths currently being skipped, including open ones waiting for their trial request"""
+        now = time.monotonic()
+        with self._lock:
+            return [path for path in self._paths if self._blocked(path, now)]
+
+
+class TokenHealth:
+    """Remembers which Canvas tokens work, so a revoked token costs one request instead of a whole sync
+
+    check() asks /api/v1/users/self about a token that has no result younger than
+    ttl seconds, and syncs skip tokens it rejected. The client also records every
+    response: a 2xx keeps the token's ok fresh, so a token in regular use is checked
+    only once, and a 401 with a WWW-Authenticate header (Canvas's answer to a bad
+    token, as opposed to a 401 for a forbidden action) marks it rejected mid-sync.
+    Entries are keyed by a hash of the token, like the response cache.
+    """
+
+    def __init__(self, ttl=TOKEN_HEALTH_TTL):
+        self.ttl = ttl
+        self._entries = {}  # token hash -> {"status": "ok" or "rejected", "checked_at", "detail"}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def lookup(self, token):
+        """The token's last recorded result, or None if it has never been used"""
+        with self._lock:
+            return self._entries.get(self._key(token))
+
+    def fresh(self, token):
+        """The token's last recorded result while it is younger than ttl, else None"""
+        entry = self.lookup(token)
+        if entry is None or (datetime.now(timezone.utc) - entry["checked_at"]).total_seconds() >= self.ttl:
+            return None
+        return entry
+
+    def record(self, token, status, detail=""):
+        entry = {"status": status, "checked_at": datetime.now(timezone.utc), "detail": detail}
+        with self._lock:
+            self._entries[self._key(token)] = entry
+
+    def usable(self, token):
+        """False for tokens Canvas has rejected within the ttl"""
+        entry = self.fresh(token)
+        return entry is None or entry["status"] != "rejected"
+
+    def check(self, name, token, client):
+        """Checks the token unless a fresh result is known; returns whether the student should be synced
+
+        A check that fails for other reasons (timeouts, throttling, 5xx) isn't
+        recorded, so the sync goes ahead and finds out for itself.
+        """
+        if self.fresh(token) is None:
+            try:
+                response = client.get(f"{API_URL}/api/v1/users/self", token)
+            except SyncIncomplete as e:
+                logger.warning("token check skipped", extra={"student": name, "reason": str(e)})
+                return True
+            if response.status_code == 401:
+                self.record(token, "rejected", http_error_detail(response))
+        if not self.usable(token):
+            logger.warning("token rejected; skipping student", extra={"student": name})
+            return False
+        return True
+
+    def report(self, student_tokens):
+        """{student: last recorded result} for the students whose tokens have been used, for display
+
+        Each entry also carries the token's hash, so restore() can tell whether the
+        token in secrets is still the one that was checked.
+        """
+        report = {}
+        for name, token in student_tokens.items():
+            entry = self.lookup(token)
+            if entry is not None:
+                report[name] = {**entry, "token_key": self._key(token)}
+        return report
+
+    def restore(self, student_tokens, report):
+        """Loads a report() saved by an earlier process, skipping students whose token has since changed"""
+        for name, entry in report.items():
+            token = student_tokens.get(name)
+            if token is not None and entry.get("token_key") == self._key(token) and self.lookup(token) is None:
+                with self._lock:
+                    self._entries[entry["token_key"]] = {
+                        "status": entry["status"], "checked_at": entry["checked_at"], "detail": entry["detail"]
+                    }
+
+
+def deadline_remaining():
+    """Seconds left before the current sync's deadline, or None without one (or outside a sync)"""
+    deadline = getattr(_sync_worker, "deadline", None)
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def request_timeout():
+    """(connect, read) timeout for the next request, cut short by the current sync's deadline
+
+    Raises SyncIncomplete once the deadline has passed.
+    """
+    connect, read = REQUEST_TIMEOUT
+    remaining = deadline_remaining()
+    if remaining is None:
+        return connect, read
+    if remaining <= 0:
+        raise SyncIncomplete("sync deadline reached")
+    return min(connect, remaining), min(read, remaining)
+
+
+def sleep_within_deadline(seconds):
+    """Sleeps, but never past the current sync's deadline"""
+    remaining = deadline_remaining()
+    time.sleep(max(0.0, seconds if remaining is None else min(seconds, remaining)))
+
+
+class CanvasClient:
+    """Pooled HTTP client shared by every fetcher, aware of Canvas rate limits
+
+    One keep-alive session is reused for all requests, so a sync pays for the
+    TLS handshake once per connection instead of once per call. Canvas reports
+    each token's remaining bucket in X-Rate-Limit-Remaining; when that runs low
+    the client spaces out requests for that token, and throttled responses are
+    retried with jittered exponential backoff. Every request has REQUEST_TIMEOUT
+    and respects the sync deadline, and paths that keep failing are skipped by a
+    CircuitBreaker; all three raise SyncIncomplete.
+    """
+
+    def __init__(self, pool_size=None, max_retries=MAX_RETRIES, cache=None):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size or MAX_CONCURRENT_REQUESTS)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.max_retries = max_retries
+        self.cache = cache
+        self.refresh = False
+        self.breaker = CircuitBreaker()
+        self.token_health = TokenHealth()
+        self._buckets = {}  # token -> (remaining, time.monotonic() when reported)
+        self._lock = threading.Lock()
+
+    def with_refresh(self):
+        """Returns a view of this client that skips cached reads but still updates the cache
+
+        The view shares the session, rate-limit buckets, circuit breaker, token health
+        and cache with the original.
+        """
+        view = copy.copy(self)
+        view.refresh = True
+        return view
+
+    def get(self, url, token, params=None):
+        """GETs a Canvas URL with the token, served from the cache when fresh"""
+        key = entry = None
+        ttl = cache_ttl(url)
+        cache = self.cache if ttl is not None else None
+        if cache is not None:
+            key = cache.make_key(token, url, params)
+            entry = None if self.refresh else cache.lookup(key)
+            if entry and time.time() - entry["fetched_at"] < ttl:
+                metrics = current_metrics()
+                if metrics is not None:
+                    metrics.record_request("GET", url, token, 200, 0.0, 0, cache="hit")
+                return CachedResponse(url, entry["body"], entry["link"])
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        # Revalidate stale entries so unchanged data costs a 304 instead of a full body
+        if entry:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = self._send("GET", url, token, headers, params=params)
+
+        if cache is not None:
+            if response.status_code == 304 and entry:
+                cache.mark_revalidated(key)
+                return CachedResponse(url, entry["body"], entry["link"])
+            if response.status_code == 200:
+                cache.store(key, response)
+
+        return response
+
+    def post(self, url, token, json_body):
+        """POSTs JSON to Canvas (used for GraphQL); never cached, but rate limited like GETs"""
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+        return self._send("POST", url, token, headers, json_body=json_body)
+
+    def _send(self, method, url, token, headers, params=None, json_body=None):
+        """Sends the request, waiting or retrying with backoff when rate limited
+
+        Raises SyncIncomplete if the request can't be sent or doesn't complete in time.
+        """
+        metrics = current_metrics()
+        path = urlsplit(url).path
+        ticket = self.breaker.acquire(path)
+        if ticket is None:
+            raise SyncIncomplete(f"{endpoint_name(url)} keeps failing; skipped for now")
+
+        ok = None
+        try:
+            for attempt in range(self.max_retries + 1):
+                self._wait_for_bucket(token)
+                timeout = request_timeout()
+                started = time.perf_counter()
+                try:
+                    response = self.session.request(method, url, headers=headers, params=params, json=json_body,
+                                                    timeout=timeout)
+                except (requests.Timeout, requests.ConnectionError) as e:
+                    ok = False
+                    if metrics is not None:
+                        metrics.record_request(method, url, token, 0, time.perf_counter() - started, 0,
+                                               attempt=attempt)
+                    reason = "timed out" if isinstance(e, requests.Timeout) else "connection failed"
+                    raise SyncIncomplete(f"{endpoint_name(url)} {reason}") from e
+
+                ok = response.status_code < 500
+                if response.ok:
+                    self.token_health.record(token, "ok")
+                elif response.status_code == 401 and "WWW-Authenticate" in response.headers:
+                    self.token_health.record(token, "rejected", http_error_detail(response))
+                self._record_bucket(token, response)
+                if metrics is not None:
+                    metrics.record_request(
+                        method, url, token, response.status_code, time.perf_counter() - started,
+                        len(response.content), throttled=is_rate_limited(response), attempt=attempt,
+                        headers=response.headers
+                    )
+
+                if not is_rate_limited(response) or attempt == self.max_retries:
+                    return response
+
+                sleep_within_deadline(self._backoff(attempt))
+        finally:
+            self.breaker.release(path, ticket, ok)
+
+    def remaining(self, token):
+        """Estimated units left in the token's bucket, or None before the first response"""
+        with self._lock:
+            bucket = self._buckets.get(token)
+        if bucket is None:
+            return None
+        remaining, reported_at = bucket
+        return remaining + (time.monotonic() - reported_at) * RATE_LIMIT_REFILL_PER_SECOND
+
+    def _record_bucket(self, token, response):
+        remaining = response.headers.get("X-Rate-Limit-Remaining")
+        if remaining is None:
+            return
+        try:
+            remaining = float(remaining)
+        except ValueError:
+            return
+        with self._lock:
+            self._buckets[token] = (remaining, time.monotonic())
+
+    def _wait_for_bucket(self, token):
+        remaining = self.remaining(token)
+        if remaining is None or remaining >= RATE_LIMIT_LOW_WATER:
+            return
+        # Slow down more the closer the bucket is to empty
+        pressure = 1 - max(remaining, 0) / RATE_LIMIT_LOW_WATER
+        sleep_within_deadline(pressure * MAX_THROTTLE_DELAY * random.uniform(0.5, 1.0))
+
+    def _backoff(self, attempt):
+        # Full jitter so parallel workers don't retry in lockstep
+        return random.uniform(0, min(MAX_THROTTLE_DELAY * 4, 0.5 * 2 ** attempt))
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_canvas_client():
+    """Returns the process-wide CanvasClient, creating it and its response cache on first use"""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = CanvasClient(pool_size=MAX_CONCURRENT_REQUESTS * 2, cache=ResponseCache())
+        return _default_client
+
+
+def http_error_message(name, error, message):
+    """Builds the error text for a failed fetch, calling out throttling separately from bad tokens"""
+    if is_rate_limited(error.response):
+        return f"⚠️ {name}: Canvas rate limit reached, try syncing again in a minute"
+    return f"⚠️ {name}: {message} (Check Token)"
+
+
+def canvas_time(moment):
+    """An aware datetime as the ISO 8601 UTC string Canvas date parameters accept"""
+    return moment.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def http_error_detail(response):
+    """Canvas's own error message from an error response, else the HTTP status"""
+    try:
+        errors = response.json().get("errors")
+        if isinstance(errors, list) and errors and isinstance(errors[0], dict):
+            return errors[0].get("message") or f"HTTP {response.status_code}"
+    except (ValueError, AttributeError):
+        pass
+    return f"HTTP {response.status_code}"
+
+
+def paginate(url, token, params=None, stop_when=None, client=None):
+    """Yields items from a Canvas list endpoint, following Link: rel="next" headers
+
+    Items are yielded as each page arrives. If stop_when(item) returns True the
+    iterator ends there and no further pages are requested, which lets endpoints
+    sorted newest-first stop once a date cutoff is passed.
+    Raises requests.HTTPError if any page comes back with an error status.
+    """
+    client = client or get_canvas_client()
+
+    while url:
+        response = client.get(url, token, params=params)
+        response.raise_for_status()
+
+        for item in response.json():
+            if stop_when is not None and stop_when(item):
+                return
+            yield item
+
+        url = response.links.get("next", {}).get("url")
+        params = None  # The next link already carries the full query string
+
+
+# --- RECORDS ---
+# Fetchers build one compact tuple per item and keep Canvas timestamps as raw ISO
+# strings; the normalization stage turns each list into a DataFrame and parses
+# every timestamp column in a single vectorized pass. The *_CATEGORIES columns
+# repeat a handful of values across many rows and are stored as categoricals.
+
+GradeRecord = namedtuple("GradeRecord", "student course_id assignment_id assignment course issue due status")
+GRADE_COLUMNS = ["Student", "Course ID", "Assignment ID", "Assignment", "Course", "Issue", "Due Date", "Status"]
+GRADE_CATEGORIES = ["Student", "Course", "Issue", "Status"]
+
+ConversationRecord = namedtuple("ConversationRecord", "student subject preview date sender")
+CONVERSATION_COLUMNS = ["Student", "Subject", "Preview", "Date", "From"]
+CONVERSATION_CATEGORIES = ["Student", "From"]
+
+CourseAnnouncement = namedtuple("CourseAnnouncement", "course_id id title preview posted")
+
+AnnouncementRecord = namedtuple("AnnouncementRecord", "student id title preview posted course")
+ANNOUNCEMENT_COLUMNS = ["Student", "ID", "Title", "Preview", "Posted", "Course"]
+ANNOUNCEMENT_CATEGORIES = ["Student", "Course"]
+
+TodoRecord = namedtuple("TodoRecord", "student task due status")
+TODO_COLUMNS = ["Student", "Task", "Due", "Status"]
+TODO_CATEGORIES = ["Student", "Status"]
+
+# What a sync produces: one DataFrame (or None when empty) per dashboard section.
+# Snapshots are shared read-only by every session; see _import_pandas.
+Snapshot = namedtuple("Snapshot", "grades conversations announcements todos")
+
+# The data types a sync can be limited to, named like the Snapshot fields
+SECTIONS = Snapshot._fields
+
+
+def parse_canvas_time(value):
+    """Parses one Canvas ISO 8601 timestamp into an aware datetime (for per-item checks)"""
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def get_student_todo(name, token, cutoff_date=None, client=None, start_date=None):
+    """Fetches To-Do list using the DIRECT Canvas API endpoint
+
+    Only items due from start_date (default: today) up to cutoff_date (default: no
+    limit) are requested; both are aware datetimes.
+    Returns None if the fetch was cut short (see SyncIncomplete).
+    """
+    try:
+        url = f"{API_URL}/api/v1/planner/items"
+
+        params = {
+            "start_date": canvas_time(start_date) if start_date else datetime.now().strftime("%Y-%m-%d"),
+            "filter": "new_activity",
+            "per_page": 100,
+            "order": "asc"  # Sort by due date
+        }
+
+        # If we have a cutoff date, add it to the API params
+        if cutoff_date:
+            params["end_date"] = canvas_time(cutoff_date)
+
+        items = paginate(url, token, params, client=client)
+
+        tasks = []
+        for item in items:
+            title = item.get('plannable', {}).get('title', 'Untitled')
+            due_date_str = item.get('plannable_date', None)
+
+            # Check Status
+            status = "Todo"
+            score = ""
+
+            if 'submissions' in item:
+                subs = item['submissions']
+                if isinstance(subs, dict):
+                    if subs.get('submitted'):
+                        status = "Submitted"
+                    if subs.get('graded'):
+                        score = f" (Score: {subs.get('score')})"
+                elif isinstance(subs, list) and len(subs) > 0:
+                    if subs[0].get('submitted'):
+                        status = "Submitted"
+
+            tasks.append(TodoRecord(name, title, due_date_str, status + score))
+
+        return tasks
+
+    except SyncIncomplete as e:
+        report_incomplete(name, "to-dos", e)
+        return None
+
+    except requests.HTTPError as e:
+        report_problem(name, http_error_message(name, e, "Access Denied"))
+        return []
+
+    except Exception:
+        logger.exception("Error fetching to-dos", extra={"student": name})
+        return []
+
+
+def get_student_courses(name, token, client=None):
+    """Fetches active courses for a student - prerequisite for grades and announcements
+
+    Returns None if the fetch was cut short (see SyncIncomplete).
+    """
+    try:
+        url = f"{API_URL}/api/v1/courses"
+
+        params = {
+            "enrollment_type": "student",
+            "enrollment_state": "active",
+            "per_page": 100
+        }
+
+        courses_data = paginate(url, token, params, client=client)
+
+        # Extract relevant course information
+        courses = []
+        for course in courses_data:
+            courses.append({
+                "id": course.get('id'),
+                "name": course.get('name', 'Unknown Course'),
+                "course_code": course.get('course_code', '')
+            })
+
+        return courses
+
+    except SyncIncomplete as e:
+        report_incomplete(name, "courses", e)
+        return None
+
+    except requests.HTTPError as e:
+        report_problem(name, http_error_message(name, e, "Unable to fetch courses"))
+        return []
+
+    except Exception:
+        logger.exception("Error fetching courses", extra={"student": name})
+        return []
+
+
+def strip_html(text):
+    """Remove HTML tags from text"""
+    if not text:
+        return ""
+    clean = re.sub('<.*?>', '', text)
+    return clean.strip()
+
+
+def get_student_conversations(name, token, client=None):
+    """Fetches unread conversations (emails) from Canvas - last 3 weeks
+
+    Returns None if the fetch was cut short (see SyncIncomplete).
+    """
+    try:
+        url = f"{API_URL}/api/v1/conversations"
+
+        params = {
+            "scope": "unread",
+            "per_page": 100  # Increased to get more results
+        }
+
+        # Filter to last 3 weeks
+        three_weeks_ago = datetime.now(timezone.utc) - timedelta(weeks=3)
+
+        def older_than_cutoff(convo):
+            last_message_at = convo.get('last_message_at')
+            return bool(last_message_at) and parse_canvas_time(last_message_at) < three_weeks_ago
+
+        # Conversations come back newest first, so stop paging at the first one past the cutoff
+        conversations = paginate(url, token, params, stop_when=older_than_cutoff, client=client)
+
+        messages = []
+        for convo in conversations:
+            last_message_at = convo.get('last_message_at')
+
+            # Anything older than 3 weeks already ended the page loop
+            if not last_message_at:
+                continue  # Skip if no date
+
+            subject = convo.get('subject', 'No Subject')
+            last_message = convo.get('last_message', '')
+
+            # Create preview (first 100 chars)
+            preview = strip_html(last_message)
+            if len(preview) > 100:
+                preview = preview[:100] + "..."
+
+            # Get sender info
+            participants = convo.get('participants', [])
+            from_user = "Unknown"
+            if participants:
+                from_user = participants[0].get('name', 'Unknown')
+
+            messages.append(ConversationRecord(name, subject, preview, last_message_at, from_user))
+
+        return messages
+
+    except SyncIncomplete as e:
+        report_incomplete(name, "unread messages", e)
+        return None
+
+    except requests.HTTPError as e:
+        report_problem(name, http_error_message(name, e, "Unable to fetch conversations"))
+        return []
+
+    except Exception:
+        logger.exception("Error fetching conversations", extra={"student": name})
+        return []
+
+
+def get_course_announcements(name, token, courses, client=None, since=None):
+    """Fetches announcements for a batch of courses - last 3 weeks
+
+    The courses only need to be visible to token; name is the student the token
+    belongs to and only labels errors. Records carry a course id instead of a
+    student so one fetch can be fanned out to every enrolled student.
+    context_codes[] is sent in chunks of ANNOUNCEMENT_CONTEXT_CHUNK to keep URLs short.
+    With since (a UTC datetime), only announcements posted on or after that day are requested.
+    Returns None if the announcements could not be fetched.
+    """
+    try:
+        if not courses:
+            return []
+
+        url = f"{API_URL}/api/v1/announcements"
+
+        # Calculate start date (3 weeks ago) and end date (today)
+        three_weeks_ago = datetime.now(timezone.utc) - timedelta(weeks=3)
+        start_date = max(three_weeks_ago, since) if since else three_weeks_ago
+
+        announcements = []
+        for chunk_start in range(0, len(courses), ANNOUNCEMENT_CONTEXT_CHUNK):
+            chunk = courses[chunk_start:chunk_start + ANNOUNCEMENT_CONTEXT_CHUNK]
+
+            # Build context_codes array from course IDs
+            params = {
+                "context_codes[]": [f"course_{course['id']}" for course in chunk],
+                "active_only": True,
+                "start_date": start_date.strftime("%Y-%m-%d"),
+                "end_date": datetime.now().strftime("%Y-%m-%d"),
+                "per_page": 100
+            }
+
+            for announcement in paginate(url, token, params, client=client):
+                title = announcement.get('title', 'No Title')
+                message = announcement.get('message', '')
+                posted_at = announcement.get('posted_at')
+
+                if not posted_at:
+                    continue
+
+                # Strip HTML and create preview
+                preview = strip_html(message)
+                if len(preview) > 150:
+                    preview = preview[:150] + "..."
+
+                # Get course from context_code
+                context_code = announcement.get('context_code', '')
+                course_id = None
+                if context_code.startswith('course_'):
+                    course_id = int(context_code.replace('course_', ''))
+
+                announcements.append(CourseAnnouncement(course_id, announcement.get('id'), title, preview, posted_at))
+
+        return announcements
+
+    except SyncIncomplete as e:
+        report_incomplete(name, "announcements", e)
+        return None
+
+    except requests.HTTPError as e:
+        report_problem(name, http_error_message(name, e, "Unable to fetch announcements"))
+        return None
+
+    except Exception:
+        logger.exception("Error fetching announcements", extra={"student": name})
+        return None
+
+
+def grade_records(name, course, submissions, keep_resolved=False):
+    """Flags missing/zero grades in REST-shaped submission dicts and builds alert rows
+
+    Only submissions with a problem become rows, unless keep_resolved is set; then
+    clean ones come back too, with Issue set to None, for incremental merging.
+    """
+    grade_issues = []
+    now = datetime.now(timezone.utc)
+
+    # Check each submission for issues
+    for submission in submissions:
+        assignment_name = submission.get('assignment', {}).get('name', 'Unknown Assignment')
+        score = submission.get('score')
+        missing = submission.get('missing', False)
+        workflow_state = submission.get('workflow_state', '')
+        due_at = submission.get('assignment', {}).get('due_at')
+
+        issue = None
+
+        # Skip if excused
+        if submission.get('excused'):
+            pass
+        # Check for zero grade (but not excused)
+        elif score == 0:
+            issue = "Zero Grade"
+        # Check for missing flag
+        elif missing:
+            issue = "Missing"
+        # Check for unsubmitted past due
+        elif workflow_state == "unsubmitted" and due_at:
+            if parse_canvas_time(due_at) < now:
+                issue = "Unsubmitted"
+
+        if issue or keep_resolved:
+            grade_issues.append(GradeRecord(
+                name, course['id'], submission.get('assignment_id'), assignment_name,
+                course['name'], issue, due_at, workflow_state
+            ))
+
+    return grade_issues
+
+
+def get_course_grades(name, token, course, client=None, since=None):
+    """Fetches a single course's graded submissions and flags zero grades
+
+    Missing work comes from get_student_missing instead, so a full fetch only asks
+    Canvas for graded submissions (with their assignments included) rather than
+    the whole gradebook. With since (a UTC datetime), only submissions submitted
+    or graded after it are requested. Every one of those comes back, with Issue set
+    to None when it no longer has a problem, so merge_records can clear resolved alerts.
+    Returns None if the course's submissions could not be fetched.
+    """
+    course_id = course['id']
+
+    try:
+        url = f"{API_URL}/api/v1/courses/{course_id}/students/submissions"
+        params = {
+            "student_ids[]": "all",
+            "include[]": "assignment",
+            "per_page": 100
+        }
+
+        if since:
+            # A submission changes state when it is turned in or when it is graded
+            param_sets = [{**params, "submitted_since": since.isoformat()},
+                          {**params, "graded_since": since.isoformat()}]
+        else:
+            param_sets = [{**params, "workflow_state": "graded"}]
+
+        submissions = {}
+        for query in param_sets:
+            for submission in paginate(url, token, query, client=client):
+                submissions[submission.get('assignment_id')] = submission
+
+        return [row if row.issue in (None, "Zero Grade") else row._replace(issue=None)
+                for row in grade_records(name, course, submissions.values(), keep_resolved=bool(since))]
+
+    except SyncIncomplete as e:
+        report_incomplete(name, "grades", e)
+        return None
+
+    except requests.HTTPError:
+        return None  # Skip this course if we can't access submissions
+
+    except Exception:
+        logger.exception("Error fetching submissions", extra={"student": name, "course_id": course_id})
+        return None  # Skip this course and continue with others
+
+
+def get_student_missing(name, token, client=None):
+    """Fetches the student's missing assignments across every course in one paginated request
+
+    Canvas works out which assignments are past due, unsubmitted and not excused,
+    so only the alerts themselves are downloaded. Records carry the assignment's
+    course id; their course names come from include[]=course.
+    Returns None if the missing assignments could not be fetched.
+    """
+    try:
+        url = f"{API_URL}/api/v1/users/self/missing_submissions"
+        params = {
+            "include[]": "course",
+            "filter[]": "submittable",
+            "per_page": 100
+        }
+
+        missing = []
+        for assignment in paginate(url, token, params, client=client):
+            course = assignment.get('course') or {}
+            missing.append(GradeRecord(
+                name, assignment.get('course_id'), assignment.get('id'),
+                assignment.get('name', 'Unknown Assignment'), course.get('name', 'Unknown Course'),
+                "Missing", assignment.get('due_at'), "unsubmitted"
+            ))
+        return missing
+
+    except SyncIncomplete as e:
+        report_incomplete(name, "missing assignments", e)
+        return None
+
+    except requests.HTTPError as e:
+        report_problem(name, http_error_message(name, e, "Unable to fetch missing assignments"))
+        return None
+
+    except Exception:
+        logger.exception("Error fetching missing assignments", extra={"student": name})
+        return None
+
+
+def get_student_grades(name, token, courses, executor=None, client=None, since_by_course=None):
+    """Fetches graded submissions and flags zero grades across all courses
+
+    When an executor is given, the per-course requests run in parallel on it.
+    since_by_course maps course id -> UTC datetime for courses that only need
+    changes since their last sync; other courses are fetched in full.
+    Returns (grade_issues, fetched_course_ids), leaving out courses that failed.
+    """
+    since_by_course = since_by_course or {}
+    grade_issues = []
+    fetched_course_ids = []
+
+    def fetch(course):
+        return get_course_grades(name, token, course, client, since_by_course.get(course['id']))
+
+    try:
+        if executor is not None:
+            course_results = executor.map(fetch, courses)
+        else:
+            course_results = (fetch(course) for course in courses)
+
+        for course, course_issues in zip(courses, course_results):
+            if course_issues is None:
+                continue
+            grade_issues.extend(course_issues)
+            fetched_course_ids.append(course['id'])
+
+        return grade_issues, fetched_course_ids
+
+    except Exception:
+        logger.exception("Error collecting grades", extra={"student": name})
+        return [], []
+
+
+# --- GRAPHQL BACKEND ---
+
+# submissionsConnection only returns submitted, pending_review and graded work unless
+# a states filter asks for more; unsubmitted work is where Missing alerts come from.
+GRAPHQL_STUDENT_QUERY = """
+query StudentGrades($pageSize: Int!) {
+  allCourses {
+    _id
+    name
+    courseCode
+    state
+    submissionsConnection(first: $pageSize, filter: {states: [unsubmitted, submitted, pending_review, graded]}) {
+      pageInfo {
+        hasNextPage
+      }
+      nodes {
+        score
+        missing
+        excused
+        state
+        assignment {
+          _id
+          name
+          dueAt
+        }
+      }
+    }
+  }
+}
+"""
+GRAPHQL_PAGE_SIZE = 100
+
+
+def get_student_graphql(name, token, client=None):
+    """Fetches a student's active courses and submissions in one Canvas GraphQL query
+
+    Returns (courses, grade_issues, overflow_courses) in the same record shapes as
+    get_student_courses and get_course_grades. Courses with more submissions than
+    one connection page are listed in overflow_courses so the caller can fetch them
+    through REST. Returns None if the query failed, so the caller can fall back to REST.
+    """
+    client = client or get_canvas_client()
+
+    try:
+        response = client.post(f"{API_URL}/api/graphql", token, {
+            "query": GRAPHQL_STUDENT_QUERY,
+            "variables": {"pageSize": GRAPHQL_PAGE_SIZE}
+        })
+        response.raise_for_status()
+        payload = response.json()
+
+        if payload.get("errors"):
+            logger.error("GraphQL query returned errors", extra={"student": name, "errors": payload["errors"]})
+            return None
+
+        courses = []
+        grade_issues = []
+        overflow_courses = []
+        for node in payload["data"]["allCourses"]:
+            # allCourses includes concluded courses; "available" matches REST's active enrollments
+            if node.get("state") != "available":
+                continue
+
+            course = {
+                "id": int(node["_id"]),
+                "name": node.get("name") or "Unknown Course",
+                "course_code": node.get("courseCode") or ""
+            }
+            courses.append(course)
+
+            connection = node.get("submissionsConnection") or {}
+            if connection.get("pageInfo", {}).get("hasNextPage"):
+                overflow_courses.append(course)
+                continue
+
+            # Reshape GraphQL nodes like REST submissions so both backends share grade_records
+            submissions = []
+            for sub in connection.get("nodes", []):
+                assignment = sub.get("assignment") or {}
+                submissions.append({
+                    "assignment_id": int(assignment["_id"]) if assignment.get("_id") else None,
+                    "score": sub.get("score"),
+                    "missing": sub.get("missing", False),
+                    "excused": sub.get("excused", False),
+                    "workflow_state": sub.get("state", ""),
+                    "assignment": {"name": assignment.get("name", "Unknown Assignment"), "due_at": assignment.get("dueAt")}
+                })
+            grade_issues.extend(grade_records(name, course, submissions))
+
+        return courses, grade_issues, overflow_courses
+
+    except SyncIncomplete as e:
+        report_incomplete(name, "grades", e)
+        return None
+
+    except requests.HTTPError as e:
+        if is_rate_limited(e.response):
+            report_problem(name, http_error_message(name, e, "Unable to run GraphQL query"))
+        return None
+
+    except Exception:
+        logger.exception("Error running GraphQL query", extra={"student": name})
+        return None
+
+
+# --- CONCURRENT SYNC ENGINE ---
+
+_sync_worker = threading.local()
+
+
+def _init_sync_worker(problems, metrics, incomplete=None, deadline=None):
+    """Points a sync worker thread at the problems, metrics, incomplete markers and deadline of its sync"""
+    _sync_worker.problems = problems
+    _sync_worker.metrics = metrics
+    _sync_worker.incomplete = incomplete
+    _sync_worker.deadline = deadline
+
+
+def current_metrics():
+    """The SyncMetrics of the sync running on this thread, or None outside a sync"""
+    return getattr(_sync_worker, "metrics", None)
+
+
+def report_problem(name, message):
+    """Records a fetch failure for the current sync, to be shown once it finishes
+
+    Fetchers run on worker threads that may belong to the background refresher,
+    where there is no session to st.error into, so problems are collected instead.
+    """
+    logger.warning(message, extra={"student": name})
+    problems = getattr(_sync_worker, "problems", None)
+    if problems is not None:
+        problems.append((name, message))
+
+
+def report_incomplete(name, what, error):
+    """Marks what (e.g. "grades") as missing from this sync for a student, who keeps their last synced data"""
+    logger.warning("sync incomplete", extra={"student": name, "data": what, "reason": str(error)})
+    incomplete = getattr(_sync_worker, "incomplete", None)
+    if incomplete is not None:
+        incomplete.setdefault(name, {})[what] = str(error)
+
+
+def merge_records(previous, changed, key, keep=None):
+    """Overlays changed records on previous ones by key, then drops rows that fail keep"""
+    merged = {key(row): row for row in previous}
+    for row in changed:
+        merged[key(row)] = row
+    return [row for row in merged.values() if keep is None or keep(row)]
+
+
+def grade_key(row):
+    return (row.course_id, row.assignment_id)
+
+
+def is_fresh(since, url, now):
+    """True if data last synced at since is still within the endpoint's cache TTL"""
+    return since is not None and (now - since).total_seconds() < cache_ttl(url)
+
+
+def sync_student_grades(name, token, request_pool, client, previous, started_at, carried=None):
+    """Fetches one student's courses and grade alerts - missing work replaced, zero grades merged per course
+
+    previous holds the incremental marks (None for a full fetch); carried (default
+    previous) holds the courses and rows kept wherever a fetch fails.
+    Returns (courses, grades, grades_since, missing_since).
+    """
+    carried = previous if carried is None else carried
+    missing_since = previous.get("missing_since") if previous else None
+    missing_stale = not is_fresh(missing_since, f"{API_URL}/api/v1/users/self/missing_submissions", started_at)
+
+    # The GraphQL backend returns courses and every course's current alerts in one
+    # query; those courses replace their previous rows instead of merging into them
+    graphql = get_student_graphql(name, token, client) if FETCH_BACKEND == "graphql" else None
+    if graphql is not None:
+        courses, replaced_grades, rest_courses = graphql
+        replaced_course_ids = {course['id'] for course in courses} - {course['id'] for course in rest_courses}
+        missing_future = None
+        if rest_courses and missing_stale:
+            missing_future = request_pool.submit(get_student_missing, name, token, client)
+    else:
+        # Courses are needed for zero grades & announcements
+        missing_future = request_pool.submit(get_student_missing, name, token, client) if missing_stale else None
+        courses = request_pool.submit(get_student_courses, name, token, client).result()
+        if not courses:
+            # Course list failed; keep syncing against the last known one
+            courses = carried["courses"] if carried else []
+        replaced_grades, rest_courses, replaced_course_ids = [], courses, set()
+
+    grades_since = previous["grades_since"] if previous else {}
+    stale_courses = [
+        course for course in rest_courses
+        if not is_fresh(grades_since.get(course['id']),
+                        f"{API_URL}/api/v1/courses/{course['id']}/students/submissions", started_at)
+    ]
+    changed_grades, fetched_course_ids = get_student_grades(
+        name, token, stale_courses, executor=request_pool, client=client, since_by_course=grades_since
+    )
+
+    # Drop rows for courses the student has left or that were re-read in full
+    course_ids = {course['id'] for course in courses}
+    refetched_ids = set(fetched_course_ids) - set(grades_since)
+    previous_grades = [
+        row for row in carried["grades"]
+        if row.course_id in course_ids and row.course_id not in replaced_course_ids
+        and not (row.issue == "Zero Grade" and row.course_id in refetched_ids)
+    ] if carried else []
+
+    # Missing work is re-read in full; if it was fresh or the fetch failed, keep the last known list
+    missing = missing_future.result() if missing_future else None
+    if missing is not None:
+        missing_since = started_at
+    else:
+        missing = [row for row in previous_grades if row.issue != "Zero Grade"]
+    rest_course_ids = {course['id'] for course in rest_courses}
+    missing = [row for row in missing if row.course_id in rest_course_ids]
+
+    # Overlay changed zero grades, then let a zero grade win over a missing row for the same assignment
+    zero_grades = merge_records([row for row in previous_grades if row.issue == "Zero Grade"], changed_grades,
+                                key=grade_key, keep=lambda row: row.issue == "Zero Grade")
+    grades = merge_records(replaced_grades + missing, zero_grades, key=grade_key)
+
+    # Courses that failed keep their old mark so their changes are picked up next time
+    new_grades_since = {course_id: since for course_id, since in grades_since.items() if course_id in course_ids}
+    for course_id in list(replaced_course_ids) + fetched_course_ids:
+        new_grades_since[course_id] = started_at
+
+    return courses, grades, new_grades_since, missing_since
+
+
+def todo_window_start(now):
+    """Start of now's day in DISPLAY_TIMEZONE: to-dos are synced from there on"""
+    return now.astimezone(ZoneInfo(DISPLAY_TIMEZONE)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def todo_window_end(until):
+    """until rounded up to the end of its day, so the window (and its ranges) only move once a day"""
+    return None if until is None else todo_window_start(until) + timedelta(days=1)
+
+
+def plan_todo_fetches(ranges, start, until, now, max_age=None):
+    """Splits the to-do window [start, until) into the parts already cached and the parts to fetch
+
+    ranges is a student's list of (start, end, fetched_at) fetched so far, with end
+    None for open-ended. Ranges younger than max_age seconds (default: the planner
+    cache TTL) cover their part of the window. until None means everything upcoming.
+    Returns (ranges still cached, [(start, end)] to fetch).
+    """
+    max_age = cache_ttl(f"{API_URL}/api/v1/planner/items") if max_age is None else max_age
+    cached = sorted(
+        (cached_range for cached_range in ranges
+         if (now - cached_range[2]).total_seconds() < max_age and (cached_range[1] is None or cached_range[1] > start)),
+        key=lambda cached_range: cached_range[0]
+    )
+
+    missing = []
+    cursor = start
+    for range_start, range_end, _ in cached:
+        if until is not None and cursor >= until:
+            break
+        if range_start > cursor:
+            missing.append((cursor, range_start if until is None else min(range_start, until)))
+        if range_end is None:
+            cursor = None
+            break
+        cursor = max(cursor, range_end)
+    if cursor is not None and (until is None or cursor < until):
+        missing.append((cursor, until))
+    return cached, missing
+
+
+def merge_todo_fetches(previous, cached, fetches, start, until, now):
+    """Combines a student's previous to-dos with the sub-ranges just fetched
+
+    fetches is a list of (start, end, future) from plan_todo_fetches' missing ranges.
+    Fetched rows replace previous ones in their range; a fetch that was cut short
+    keeps the previous rows for its range and isn't recorded as cached. Previous rows
+    outside the window are kept only while their range is still cached, and rows due
+    before start are dropped. Canvas's date ranges are inclusive, so an item due on a
+    boundary comes back from both neighbouring ranges; it is listed once.
+    Returns (todos, ranges).
+    """
+    fetched = []
+    results = []
+    for range_start, range_end, future in fetches:
+        result = future.result()
+        if result is None:
+            continue
+        fetched.append((range_start, range_end, now))
+        results.append(result)
+
+    def due(row):
+        return datetime.fromisoformat(row.due) if row.due else start
+
+    def within(row, spans):
+        return any(span[0] <= due(row) and (span[1] is None or due(row) < span[1]) for span in spans)
+
+    kept = [
+        row for row in previous
+        if due(row) >= start and not within(row, fetched) and within(row, cached + [(start, until)])
+    ]
+    # Union as multisets: identical rows within one list are distinct items, across lists the same one
+    todos = Counter()
+    for rows in [kept] + results:
+        todos |= Counter(rows)
+    return list(todos.elements()), cached + fetched
+
+
+def fetch_student_data(name, token, request_pool, client=None, previous=None, sections=SECTIONS, todos_until=None,
+                       todos_max_age=None, fallback=None):
+    """Fetches the requested data types for one student, running endpoints in parallel on request_pool
+
+    previous is the state this function returned on the student's last sync; while it
+    is younger than FULL_SYNC_INTERVAL, grades are fetched incrementally. fallback is
+    the state a full sync started over from. Data types not in sections, fetches cut
+    short and students whose token is rejected keep the rows from previous (or fallback).
+    todos_until bounds the to-do window (None for everything upcoming) and
+    todos_max_age is passed to plan_todo_fetches.
+    Returns the student's new state, which holds the course list and record lists.
+    """
+    started_at = datetime.now(timezone.utc)
+    carried = previous or fallback or {}
+    if previous and started_at - previous["full_sync_at"] > FULL_SYNC_INTERVAL:
+        previous = None
+
+    # A rejected token would fail every request below; carry everything over instead
+    client = client or get_canvas_client()
+    if not client.token_health.check(name, token, client):
+        sections = ()
+
+    convos_future = None
+    if "conversations" in sections:
+        convos_future = request_pool.submit(get_student_conversations, name, token, client)
+
+    todos = carried.get("todos", [])
+    todo_ranges = previous.get("todo_ranges", []) if previous else []
+    if "todos" in sections:
+        todos_start, todos_until = todo_window_start(started_at), todo_window_end(todos_until)
+        todo_ranges, missing = plan_todo_fetches(todo_ranges, todos_start, todos_until, started_at, todos_max_age)
+        todo_fetches = [
+            (range_start, range_end, request_pool.submit(get_student_todo, name, token, range_end, client, range_start))
+            for range_start, range_end in missing
+        ]
+
+    courses = carried.get("courses", [])
+    grades = carried.get("grades", [])
+    grades_since = carried.get("grades_since", {})
+    missing_since = carried.get("missing_since")
+    full_sync_at = carried.get("full_sync_at", started_at)
+    if "grades" in sections:
+        courses, grades, grades_since, missing_since = sync_student_grades(
+            name, token, request_pool, client, previous, started_at, carried
+        )
+        full_sync_at = previous["full_sync_at"] if previous else started_at
+    elif "announcements" in sections:
+        courses = request_pool.submit(get_student_courses, name, token, client).result() or courses
+
+    if "todos" in sections:
+        todos, todo_ranges = merge_todo_fetches(todos, todo_ranges, todo_fetches, todos_start, todos_until, started_at)
+
+    return {
+        "full_sync_at": full_sync_at,
+        "courses": courses,
+        "grades_since": grades_since,
+        "missing_since": missing_since,
+        "grades": grades,
+        "conversations": _result_or(convos_future, carried.get("conversations", [])),
+        "todos": todos,
+        "todo_ranges": todo_ranges
+    }
+
+
+def _result_or(future, previous):
+    """A fetch future's records, or previous if it wasn't started or was cut short"""
+    result = future.result() if future else None
+    return previous if result is None else result
+
+
+def plan_course_fetches(student_courses):
+    """Assigns every course in the union of all students' courses to one enrolled student
+
+    student_courses maps student name -> course list. Returns {name: [courses]} in
+    which each course appears exactly once, so course-scoped resources are fetched
+    once with a token that can see them. Courses go to the enrolled student with the
+    fewest assigned so far, which spreads the load across tokens' rate limits.
+    """
+    enrolled = {}
+    for name, courses in student_courses.items():
+        for course in courses:
+            enrolled.setdefault(course['id'], (course, []))[1].append(name)
+
+    plan = {}
+    for course, names in enrolled.values():
+        name = min(names, key=lambda candidate: len(plan.get(candidate, [])))
+        plan.setdefault(name, []).append(course)
+    return plan
+
+
+def sync_course_announcements(student_courses, student_tokens, request_pool, client=None, course_state=None):
+    """Fetches announcements once per course across all students
+
+    Returns {course_id: [announcement records]}. course_state maps course id -> state
+    from earlier syncs and is updated in place; fresh courses aren't requested again,
+    stale ones are fetched from their high-water mark and merged, and courses that
+    fail keep their previous rows and mark.
+    """
+    started_at = datetime.now(timezone.utc)
+    course_state = {} if course_state is None else course_state
+    announcements_url = f"{API_URL}/api/v1/announcements"
+
+    for course_id, state in list(course_state.items()):
+        if started_at - state["full_sync_at"] > FULL_SYNC_INTERVAL:
+            del course_state[course_id]
+
+    futures = {}
+    for name, courses in plan_course_fetches(student_courses).items():
+        stale = [course for course in courses
+                 if not is_fresh(course_state.get(course['id'], {}).get("since"), announcements_url, started_at)]
+        if not stale:
+            continue
+        # One request batch per token; start from the oldest mark in the batch and let the merge dedupe
+        marks = [course_state.get(course['id'], {}).get("since") for course in stale]
+        since = None if None in marks else min(marks)
+        future = request_pool.submit(get_course_announcements, name, student_tokens[name], stale, client, since)
+        futures[future] = stale
+
+    three_weeks_ago = started_at - timedelta(weeks=3)
+    for future, courses in futures.items():
+        changed = future.result()
+        if changed is None:
+            continue
+        for course in courses:
+            previous = course_state.get(course['id'])
+            course_state[course['id']] = {
+                "full_sync_at": previous["full_sync_at"] if previous else started_at,
+                "since": started_at,
+                "announcements": merge_records(
+                    previous["announcements"] if previous else [],
+                    [row for row in changed if row.course_id == course['id']],
+                    key=lambda row: row.id,
+                    keep=lambda row: parse_canvas_time(row.posted) >= three_weeks_ago
+                )
+            }
+
+    return {course_id: state["announcements"] for course_id, state in course_state.items()}
+
+
+def fan_out_announcements(name, courses, announcements_by_course):
+    """Builds one student's announcement rows from the per-course announcements"""
+    announcements = []
+    for course in courses:
+        for row in announcements_by_course.get(course['id'], []):
+            announcements.append(AnnouncementRecord(name, row.id, row.title, row.preview, row.posted, course['name']))
+    return announcements
+
+
+# --- NORMALIZATION ---
+
+def _import_pandas():
+    """Imports pandas on first use, turning on copy-on-write under pandas 2
+
+    Snapshot frames are shared by every session. With copy-on-write (always on from
+    pandas 3), the slices and assign() results rendering derives from them are cheap
+    views that can never write back into the shared frame.
+    """
+    import pandas as pd
+
+    if int(pd.__version__.split(".")[0]) < 3:
+        pd.set_option("mode.copy_on_write", True)
+    return pd
+
+
+def compact_frame(df, categories):
+    """Stores repetitive string columns as categoricals: one small code per row plus a shared value table"""
+    return df.astype({column: "category" for column in categories})
+
+
+def records_to_frame(records, columns, time_column, categories=()):
+    """Builds a compact DataFrame from record tuples, parsing the timestamp column in one pass
+
+    Timestamps become timezone-aware UTC datetimes (NaT where Canvas gave none);
+    they are only turned into display strings at render time.
+    """
+    pd = _import_pandas()
+
+    df = pd.DataFrame.from_records(records, columns=columns)
+    df[time_column] = pd.to_datetime(df[time_column], utc=True, errors="coerce", format="ISO8601")
+    return compact_frame(df, categories)
+
+
+def build_dataframes(all_grades, all_conversations, all_announcements, all_todos):
+    """Normalizes collected records into a Snapshot of the four dashboard DataFrames"""
+    grades_df = records_to_frame(all_grades, GRADE_COLUMNS, 'Due Date', GRADE_CATEGORIES) if all_grades else None
+    convos_df = records_to_frame(
+        all_conversations, CONVERSATION_COLUMNS, 'Date', CONVERSATION_CATEGORIES
+    ) if all_conversations else None
+    announcements_df = records_to_frame(
+        all_announcements, ANNOUNCEMENT_COLUMNS, 'Posted', ANNOUNCEMENT_CATEGORIES
+    ) if all_announcements else None
+    todos_df = records_to_frame(all_todos, TODO_COLUMNS, 'Due', TODO_CATEGORIES) if all_todos else None
+
+    # Sort the time-filtered frames by date once here, so filter_window can binary search them
+    if convos_df is not None:
+        convos_df = sort_by_time(convos_df, 'Date')
+
+    if announcements_df is not None:
+        announcements_df = sort_by_time(announcements_df, 'Posted')
+
+    if todos_df is not None:
+        todos_df = sort_by_time(todos_df, 'Due')
+
+    return Snapshot(grades_df, convos_df, announcements_df, todos_df)
+
+
+def sort_by_time(df, column):
+    """Sorts ascending by a datetime column with undated rows first, as filter_window expects
+
+    NaT compares as the smallest timestamp in a binary search, so it has to sort first too.
+    """
+    return df.sort_values(column, na_position='first', kind='stable', ignore_index=True)
+
+
+def filter_window(df, column, start=None, end=None, newest_first=False):
+    """Returns the rows whose column falls in [start, end] as a slice, without copying
+
+    df must come from sort_by_time, so both bounds are found by binary search
+    (O(log n)) and the result is an iloc slice. Undated rows are kept only when
+    there is no start bound.
+    """
+    values = df[column]
+    lo = 0 if start is None else values.searchsorted(start, side='left')
+    hi = len(df) if end is None else values.searchsorted(end, side='right')
+    window = df.iloc[lo:hi]
+    return window.iloc[::-1] if newest_first else window
+
+
+def format_dates(df, column, fmt):
+    """Returns df with a datetime column rendered as display strings in DISPLAY_TIMEZONE"""
+    formatted = df[column].dt.tz_convert(DISPLAY_TIMEZONE).dt.strftime(fmt).fillna("No Date")
+    return df.assign(**{column: formatted})
+
+
+def iter_sync_students(student_tokens, max_concurrent=None, client=None, sync_state=None, problems=None,
+                       metrics=None, sections=SECTIONS, incomplete=None, deadline_seconds=None, todos_until=None,
+                       todos_max_age=None, fallback_state=None):
+    """Fetches all students in parallel, yielding each student's name as soon as they finish
+
+    student_tokens maps student name -> Canvas token. max_concurrent bounds both the
+    students and the Canvas requests in flight (default MAX_CONCURRENT_REQUESTS).
+    sync_state is updated in place as results arrive (pass the same dict each time for
+    incremental syncs); fallback_state is the state a full sync started over from.
+    problems collects (student, message) pairs, metrics is a SyncMetrics, and
+    incomplete collects {student: {data type: reason}} for fetches cut short.
+    deadline_seconds defaults to SYNC_DEADLINE_SECONDS. sections, todos_until and
+    todos_max_age are passed to fetch_student_data. Announcements are synced per
+    course after every student; None is yielded last, once they are in sync_state.
+    """
+    client = client or get_canvas_client()
+    max_concurrent = max_concurrent or MAX_CONCURRENT_REQUESTS
+    problems = [] if problems is None else problems
+    metrics = SyncMetrics() if metrics is None else metrics
+    metrics.add_students(student_tokens)
+    incomplete = {} if incomplete is None else incomplete
+    deadline_seconds = SYNC_DEADLINE_SECONDS if deadline_seconds is None else deadline_seconds
+    deadline = time.monotonic() + deadline_seconds if deadline_seconds else None
+    worker_context = (problems, metrics, incomplete, deadline)
+    sync_state = {} if sync_state is None else sync_state
+    student_state = sync_state.setdefault("students", {})
+    course_state = sync_state.setdefault("courses", {})
+    fallback_students = (fallback_state or {}).get("students", {})
+
+    with ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="canvas-request",
+                            initializer=_init_sync_worker, initargs=worker_context) as request_pool, \
+         ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="canvas-student",
+                            initializer=_init_sync_worker, initargs=worker_context) as student_pool:
+
+        futures = {
+            student_pool.submit(
+                fetch_student_data, name, token, request_pool, client, student_state.get(name), sections,
+                todos_until, todos_max_age, fallback_students.get(name)
+            ): name
+            for name, token in student_tokens.items()
+        }
+
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                student_state[name] = future.result()
+            except Exception:
+                logger.exception("Error syncing student", extra={"student": name})  # Fall back to the last good sync
+            yield name
+
+        # Course-scoped data is fetched once per course, then fanned out to each enrolled student
+        if "announcements" in sections:
+            student_courses = {name: student_state[name]["courses"] for name, token in student_tokens.items()
+                               if name in student_state and client.token_health.usable(token)}
+            with metrics.stage("course announcements"):
+                sync_course_announcements(student_courses, student_tokens, request_pool, client, course_state)
+
+    if deadline is not None and time.monotonic() >= deadline:
+        logger.warning("sync deadline reached", extra={"seconds": deadline_seconds, "incomplete": len(incomplete)})
+    yield None
+
+
+def snapshot_from_state(student_tokens, sync_state, fallback_state=None):
+    """Builds (grades_df, convos_df, announcements_df, todos_df) from sync state
+
+    Works mid-sync: students that haven't finished yet contribute their data from
+    the previous sync, or from fallback_state (the state a full refresh started over
+    from) when sync_state has none for them.
+    """
+    fallback_state = fallback_state or {}
+    student_state = {**fallback_state.get("students", {}), **sync_state.get("students", {})}
+    course_state = {**fallback_state.get("courses", {}), **sync_state.get("courses", {})}
+    announcements_by_course = {course_id: state["announcements"] for course_id, state in course_state.items()}
+
+    # Collect results in roster order so tables stay stable between syncs
+    all_conversations = []
+    all_todos = []
+    all_grades = []
+    all_announcements = []
+
+    for name in student_tokens:
+        student_data = student_state.get(name)
+        if not student_data:
+            continue
+        all_conversations.extend(student_data["conversations"])
+        all_todos.extend(student_data["todos"])
+        all_grades.extend(student_data["grades"])
+        all_announcements.extend(fan_out_announcements(name, student_data["courses"], announcements_by_course))
+
+    return build_dataframes(all_grades, all_conversations, all_announcements, all_todos)
+
+
+def sync_students(student_tokens, max_concurrent=None, on_student_done=None, client=None,
+                  sync_state=None, problems=None, metrics=None, sections=SECTIONS, incomplete=None,
+                  deadline_seconds=None, todos_until=None, todos_max_age=None, fallback_state=None):
+    """Fetches all students in parallel and returns (grades_df, convos_df, announcements_df, todos_df)
+
+    Runs iter_sync_students to completion; on_student_done(name) is called from the
+    calling thread as each student finishes. See iter_sync_students for the other arguments.
+    """
+    sync_state = {} if sync_state is None else sync_state
+    metrics = SyncMetrics() if metrics is None else metrics
+    for name in iter_sync_students(student_tokens, max_concurrent, client, sync_state, problems, metrics, sections,
+                                   incomplete, deadline_seconds, todos_until, todos_max_age, fallback_state):
+        if name is not None and on_student_done:
+            on_student_done(name)
+    with metrics.stage("normalize"):
+        snapshot = snapshot_from_state(student_tokens, sync_state, fallback_state)
+    metrics.finish()
+    return snapshot
+
+
+# --- SNAPSHOTS ---
+
+# Snapshot table for each dashboard frame, in Snapshot order, with its time and categorical columns
+SNAPSHOT_TABLES = [
+    ("grades", "Due Date", GRADE_CATEGORIES),
+    ("conversations", "Date", CONVERSATION_CATEGORIES),
+    ("announcements", "Posted", ANNOUNCEMENT_CATEGORIES),
+    ("todos", "Due", TODO_CATEGORIES),
+]
+
+
+def _time_to_json(moment):
+    return None if moment is None else moment.isoformat()
+
+
+def _time_from_json(value):
+    return None if value is None else datetime.fromisoformat(value)
+
+
+# Record lists in a student's sync state, and the record type of each
+STATE_RECORDS = {"grades": GradeRecord, "conversations": ConversationRecord, "todos": TodoRecord}
+
+
+def sync_state_to_json(sync_state):
+    """Serializes iter_sync_students' sync state as JSON
+
+    Records become lists and datetimes ISO strings; dicts keyed by course id are
+    stored as [id, value] pairs so the ids keep their type.
+    """
+    students = {
+        name: {
+            **state,
+            "full_sync_at": _time_to_json(state["full_sync_at"]),
+            "grades_since": [[course_id, _time_to_json(since)] for course_id, since in state["grades_since"].items()],
+            "missing_since": _time_to_json(state.get("missing_since")),
+            "todo_ranges": [[_time_to_json(moment) for moment in todo_range]
+                            for todo_range in state.get("todo_ranges", [])],
+        }
+        for name, state in sync_state.get("students", {}).items()
+    }
+    courses = [
+        [course_id, {**state, "full_sync_at": _time_to_json(state["full_sync_at"]),
+                     "since": _time_to_json(state["since"])}]
+        for course_id, state in sync_state.get("courses", {}).items()
+    ]
+    return json.dumps({"students": students, "courses": courses})
+
+
+def sync_state_from_json(text):
+    """Loads sync state written by sync_state_to_json"""
+    data = json.loads(text)
+    students = {
+        name: {
+            **state,
+            "full_sync_at": _time_from_json(state["full_sync_at"]),
+            "grades_since": {course_id: _time_from_json(since) for course_id, since in state["grades_since"]},
+            "missing_since": _time_from_json(state.get("missing_since")),
+            "todo_ranges": [tuple(_time_from_json(moment) for moment in todo_range)
+                            for todo_range in state.get("todo_ranges", [])],
+            **{key: [record_type(*row) for row in state[key]] for key, record_type in STATE_RECORDS.items()},
+        }
+        for name, state in data.get("students", {}).items()
+    }
+    courses = {
+        course_id: {
+            **state,
+            "full_sync_at": _time_from_json(state["full_sync_at"]),
+            "since": _time_from_json(state["since"]),
+            "announcements": [CourseAnnouncement(*row) for row in state["announcements"]],
+        }
+        for course_id, state in data.get("courses", [])
+    }
+    return {"students": students, "courses": courses}
+
+
+def write_snapshot(path, snapshot, refreshed_at, problems=(), metrics=None, sync_state=None, incomplete=None,
+                   token_health=None):
+    """Writes a sync's frames and metadata to a SQLite file, replacing it atomically
+
+    snapshot is (grades_df, convos_df, announcements_df, todos_df). sync_state is
+    stored too, so the next sync from the same file can be incremental.
+    token_health is a TokenHealth.report().
+    """
+    make_private_dirs(os.path.dirname(path))
+    temp_path = f"{path}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    create_private_file(temp_path)
+
+    db = sqlite3.connect(temp_path)
+    try:
+        for (table, _, _), df in zip(SNAPSHOT_TABLES, snapshot):
+            if df is not None:
+                df.to_sql(table, db, index=False)
+        db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value BLOB)")
+        db.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ("refreshed_at", refreshed_at.isoformat()),
+            ("problems", json.dumps(list(problems))),
+            ("incomplete", json.dumps(incomplete or {})),
+            ("token_health", json.dumps(token_health or {}, default=str)),
+            ("metrics", metrics.to_json() if metrics is not None else None),
+            ("sync_state", sync_state_to_json(sync_state or {})),
+        ])
+        db.commit()
+    finally:
+        db.close()
+    os.replace(temp_path, path)
+
+
+def read_snapshot(path, with_sync_state=False):
+    """Loads a file written by write_snapshot
+
+    Returns a dict with snapshot (a Snapshot, with None for empty frames), refreshed_at,
+    problems, incomplete, token_health and metrics (a SyncMetrics or None), plus
+    sync_state when with_sync_state is set. Only a sync needs it; an unreadable one
+    (e.g. from an older version) comes back empty, so the sync runs in full.
+    """
+    pd = _import_pandas()
+
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        tables = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        frames = []
+        for table, time_column, categories in SNAPSHOT_TABLES:
+            if table not in tables:
+                frames.append(None)
+                continue
+            df = pd.read_sql(f'SELECT * FROM "{table}" ORDER BY rowid', db)
+            df[time_column] = pd.to_datetime(df[time_column], utc=True, format="ISO8601")
+            frames.append(compact_frame(df, categories))
+        meta = dict(db.execute("SELECT key, value FROM meta"))
+    finally:
+        db.close()
+
+    loaded = {
+        "snapshot": Snapshot(*frames),
+        "refreshed_at": datetime.fromisoformat(meta["refreshed_at"]),
+        "problems": [tuple(problem) for problem in json.loads(meta["problems"])],
+        "incomplete": json.loads(meta.get("incomplete") or "{}"),
+        "token_health": {
+            name: {**entry, "checked_at": datetime.fromisoformat(entry["checked_at"])}
+            for name, entry in json.loads(meta.get("token_health") or "{}").items()
+        },
+        "metrics": SyncMetrics.from_json(meta["metrics"]) if meta.get("metrics") else None,
+    }
+    if with_sync_state:
+        try:
+            loaded["sync_state"] = sync_state_from_json(meta.get("sync_state") or "{}")
+        except (ValueError, TypeError, KeyError):
+            logger.warning("Could not read sync state from snapshot; the next sync runs in full", extra={"path": path})
+            loaded["sync_state"] = {}
+    return loaded
+
+
+# --- HISTORY ---
+# An append-only Parquet dataset per table under HISTORY_PATH, in hive-style
+# date=YYYY-MM-DD partitions (UTC). Each sync adds one file per table, with a
+# "Synced At" column and rows sorted by student; the syncs table records every
+# sync, so a sync that found nothing still counts as zero. Finished days are
+# compacted into one file sorted by student, so a trend query over weeks reads one
+# file per day; day partitions outside the query's range aren't opened at all.
+
+HISTORY_TABLES = ["grades", "todos"]
+HISTORY_KEYS = {
+    "grades": ["Student", "Course ID", "Assignment ID"],
+    "todos": ["Student", "Task", "Due"],
+}
+
+
+def _history_schema(table):
+    import pyarrow as pa
+
+    utc = pa.timestamp("us", tz="UTC")
+    return pa.schema({
+        "grades": [("Student", pa.string()), ("Course ID", pa.int64()), ("Assignment ID", pa.int64()),
+                   ("Assignment", pa.string()), ("Course", pa.string()), ("Issue", pa.string()),
+                   ("Due Date", utc), ("Status", pa.string()), ("Synced At", utc)],
+        "todos": [("Student", pa.string()), ("Task", pa.string()), ("Due", utc), ("Status", pa.string()),
+                  ("Synced At", utc)],
+        "syncs": [("Section", pa.string()), ("Students", pa.int64()), ("Synced At", utc)],
+    }[table])
+
+
+def _write_parquet_atomically(path, table):
+    """Writes an Arrow table to path via a hidden temp file, so readers never see half a file"""
+    import pyarrow.parquet as pq
+
+    make_private_dirs(os.path.dirname(path))
+    temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    create_private_file(temp_path)
+    pq.write_table(table, temp_path, compression="zstd")
+    os.replace(temp_path, path)
+
+
+def _history_dataset(table, root=None):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    path = os.path.join(root or HISTORY_PATH, table)
+    if not glob.glob(os.path.join(path, "date=*", "*.parquet")):
+        return None
+    partitioning = ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive")
+    return ds.dataset(path, format="parquet", partitioning=partitioning, schema=_history_schema(table).append(
+        pa.field("date", pa.string())))
+
+
+def append_history(snapshot, synced_at, student_count, sections=SECTIONS, root=None):
+    """Appends one finished sync's grade alerts and assignments to the history
+
+    Only tables in sections are written, as the others weren't re-synced. Days
+    before synced_at's are compacted afterwards if they still have several files.
+    """
+    import pyarrow as pa
+
+    root = root or HISTORY_PATH
+    partition = f"date={synced_at:%Y-%m-%d}"
+    filename = f"part-{synced_at:%H%M%S%f}.parquet"
+    written = [table for table in HISTORY_TABLES if table in sections]
+    for table in written:
+        schema = _history_schema(table)
+        df = getattr(snapshot, table)
+        if df is None:
+            rows = schema.empty_table()
+        else:
+            columns = [name for name in schema.names if name != "Synced At"]
+            rows = pa.Table.from_pandas(df[columns].assign(**{"Synced At": synced_at}), schema=schema,
+                                        preserve_index=False)
+            rows = rows.replace_schema_metadata().sort_by([("Student", "ascending")])
+        _write_parquet_atomically(os.path.join(root, table, partition, filename), rows)
+
+    syncs = pa.Table.from_pylist(
+        [{"Section": table, "Students": student_count, "Synced At": synced_at} for table in written],
+        schema=_history_schema("syncs")
+    )
+    _write_parquet_atomically(os.path.join(root, "syncs", partition, filename), syncs)
+    compact_history(before=synced_at.date(), root=root)
+
+
+def compact_history(before, root=None):
+    """Merges each day's history files into one, for days before the date before"""
+    import pyarrow.parquet as pq
+
+    root = root or HISTORY_PATH
+    for table in HISTORY_TABLES + ["syncs"]:
+        for day_dir in sorted(glob.glob(os.path.join(root, table, "date=*"))):
+            if os.path.basename(day_dir) >= f"date={before:%Y-%m-%d}":
+                continue
+            parts = sorted(glob.glob(os.path.join(day_dir, "part-*.parquet")))
+            if len(parts) < 2 and not (parts and os.path.exists(os.path.join(day_dir, "compacted.parquet"))):
+                continue
+
+            compacted_path = os.path.join(day_dir, "compacted.parquet")
+            files = parts + ([compacted_path] if os.path.exists(compacted_path) else [])
+            rows = pq.ParquetDataset(files, schema=_history_schema(table)).read()
+            sort_keys = ["Synced At"] if table == "syncs" else ["Student", "Synced At"]
+            rows = rows.sort_by([(key, "ascending") for key in sort_keys])
+            _write_parquet_atomically(compacted_path, rows)
+            for part in parts:
+                os.remove(part)
+            logger.info("history compacted", extra={"table": table, "day": os.path.basename(day_dir),
+                                                     "files": len(files), "rows": rows.num_rows})
+
+
+def read_history(table, columns=None, start=None, students=None, synced_at=None, root=None):
+    """Loads history rows for table as a DataFrame (empty if there is no history yet)
+
+    start (a UTC datetime) skips older syncs, pruning whole day partitions; students
+    limits the rows to those students; synced_at picks a single sync.
+    """
+    pd = _import_pandas()
+    dataset = _history_dataset(table, root)
+    if dataset is None:
+        return pd.DataFrame(columns=columns or _history_schema(table).names)
+    condition = _history_filter(start=start, students=students, synced_at=synced_at)
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+def _history_filter(start=None, end=None, students=None, synced_at=None):
+    """A dataset filter for history rows; the date bounds prune whole day partitions"""
+    import pyarrow.dataset as ds
+
+    conditions = []
+    if start is not None:
+        conditions += [ds.field("date") >= f"{start:%Y-%m-%d}", ds.field("Synced At") >= start]
+    if end is not None:
+        conditions += [ds.field("date") <= f"{end:%Y-%m-%d}", ds.field("Synced At") < end]
+    if synced_at is not None:
+        conditions += [ds.field("date") == f"{synced_at:%Y-%m-%d}", ds.field("Synced At") == synced_at]
+    if students is not None:
+        conditions.append(ds.field("Student").isin(list(students)))
+    condition = None
+    for extra in conditions:
+        condition = extra if condition is None else condition & extra
+    return condition
+
+
+def history_counts(table, start=None, students=None, where=None, root=None):
+    """Counts table's history rows per sync and student, for trend charts
+
+    where optionally maps a column to the values to count (e.g. {"Issue": ["Missing"]}).
+    Returns a DataFrame indexed by "Synced At" with one column per student; syncs
+    that found nothing for a student count as 0.
+    """
+    pd = _import_pandas()
+    syncs = read_history("syncs", ["Section", "Synced At"], start=start, root=root)
+    sync_times = pd.DatetimeIndex(syncs.loc[syncs["Section"] == table, "Synced At"].unique(), name="Synced At")
+
+    rows = read_history(table, ["Student", "Synced At"] + list(where or {}), start=start, students=students,
+                        root=root)
+    for column, values in (where or {}).items():
+        rows = rows[rows[column].isin(values)]
+    counts = rows.groupby(["Synced At", "Student"], observed=True).size().unstack("Student")
+    counts = counts.reindex(index=sync_times.sort_values(), columns=students if students is not None else None)
+    return counts.fillna(0).astype(int)
+
+
+def previous_history(table, before, students=None, root=None):
+    """Loads table's rows from the last sync before the UTC datetime before, or None if there wasn't one"""
+    syncs = read_history("syncs", ["Section", "Synced At"], root=root)
+    earlier = syncs.loc[(syncs["Section"] == table) & (syncs["Synced At"] < before), "Synced At"]
+    if earlier.empty:
+        return None
+    return read_history(table, HISTORY_KEYS[table], students=students, synced_at=earlier.max(), root=root)
+
+
+# --- EXPORTS ---
+# Master lists and history ranges are exported a chunk of EXPORT_CHUNK_ROWS rows at
+# a time: each chunk is sliced from the source frame (or read from the history
+# dataset), converted and written before the next one, so an export never holds a
+# second full copy of the data. Output goes to a temporary file that stays in memory
+# up to EXPORT_SPOOL_BYTES and spills to disk beyond that; only the finished file is
+# read back as bytes, which is what Streamlit's download buttons accept. CSV and
+# Parquet need only pandas and pyarrow; Excel workbooks need xlsxwriter.
+
+EXPORT_CHUNK_ROWS = 5000
+EXPORT_SPOOL_BYTES = 8 * 1024 * 1024
+
+# format -> (MIME type, file extension)
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+}
+
+
+def excel_export_available():
+    """True if xlsxwriter is installed, so workbooks can be exported"""
+    import importlib.util
+
+    return importlib.util.find_spec("xlsxwriter") is not None
+
+
+def iter_frame_chunks(df, columns=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Yields df (restricted to columns) in slices of at most chunk_rows rows; an empty df yields one empty slice"""
+    for start in range(0, max(len(df), 1), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows]
+        yield chunk if columns is None else chunk[columns]
+
+
+def iter_history_chunks(table, start=None, end=None, students=None, columns=None, chunk_rows=EXPORT_CHUNK_ROWS,
+                        root=None):
+    """Yields table's history rows between the UTC datetimes start and end as DataFrames of at most chunk_rows
+
+    The dataset is scanned batch by batch, so the range is never loaded whole.
+    """
+    schema = _history_schema(table)
+    columns = columns or schema.names
+    dataset = _history_dataset(table, root)
+    if dataset is not None:
+        condition = _history_filter(start=start, end=end, students=students)
+        for batch in dataset.to_batches(columns=columns, filter=condition, batch_size=chunk_rows):
+            if batch.num_rows:
+                yield batch.to_pandas()
+    # Typed like the dataset, so an export of an empty range still gets its columns
+    yield schema.empty_table().select(columns).to_pandas()
+
+
+def write_csv_export(chunks, out):
+    """Writes DataFrame chunks to the binary file out as one UTF-8 CSV"""
+    header = True
+    for chunk in chunks:
+        if chunk.empty and not header:
+            continue
+        out.write(chunk.to_csv(index=False, header=header).encode("utf-8"))
+        header = False
+
+
+def write_parquet_export(chunks, out, schema=None):
+    """Writes DataFrame chunks to the binary file out as one Parquet file, a row group per chunk
+
+    schema defaults to the first chunk's; later chunks are cast to it.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    try:
+        for chunk in chunks:
+            if writer is not None and chunk.empty:
+                continue
+            if schema is None:
+                schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(out, schema, compression="zstd")
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def write_excel_export(sheets, out):
+    """Writes a workbook to the binary file out with one worksheet per {sheet name: DataFrame chunks}
+
+    Rows are streamed to disk as they're written (xlsxwriter's constant_memory mode).
+    Excel can't store time zones, so times are written in DISPLAY_TIMEZONE.
+    Raises ImportError if xlsxwriter isn't installed.
+    """
+    import xlsxwriter
+
+    pd = _import_pandas()
+    workbook = xlsxwriter.Workbook(out, {"constant_memory": True, "default_date_format": "yyyy-mm-dd hh:mm"})
+    header_format = workbook.add_format({"bold": True})
+    try:
+        for sheet_name, chunks in sheets.items():
+            # Sheet names are capped at 31 characters and can't contain []:*?/\
+            worksheet = workbook.add_worksheet(re.sub(r"[\[\]:*?/\\]", "-", sheet_name)[:31])
+            row = 0
+            for chunk in chunks:
+                if row == 0:
+                    worksheet.write_row(0, 0, list(chunk.columns), header_format)
+                    row = 1
+                for column in chunk.columns:
+                    if isinstance(chunk[column].dtype, pd.DatetimeTZDtype):
+                        chunk = chunk.assign(**{column: chunk[column].dt.tz_convert(DISPLAY_TIMEZONE)
+                                                .dt.tz_localize(None)})
+                values = chunk.astype(object).where(chunk.notna(), None)
+                for record in values.itertuples(index=False, name=None):
+                    worksheet.write_row(row, 0, record)
+                    row += 1
+    finally:
+        workbook.close()
+
+
+def export_file(fmt, chunks):
+    """Writes an export in fmt (a key of EXPORT_FORMATS) through a temporary file and returns its bytes
+
+    chunks is an iterable of DataFrames, or for "xlsx" a {sheet name: chunks} dict.
+    """
+    import tempfile
+
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as out:
+        if fmt == "csv":
+            write_csv_export(chunks, out)
+        elif fmt == "parquet":
+            write_parquet_export(chunks, out)
+        elif fmt == "xlsx":
+            write_excel_export(chunks, out)
+        else:
+            raise ValueError(f"unknown export format {fmt!r}")
+        out.seek(0)
+        return out.read()
+
+
+# --- COMMAND LINE ---
+
+def main(argv=None):
+    """Syncs every student in the secrets file once and writes a snapshot for the dashboard"""
+    import argparse
+    import tomllib
+
+    parser = argparse.ArgumentParser(description="Sync Canvas data for every student and write a dashboard snapshot")
+    parser.add_argument("--secrets", default=".streamlit/secrets.toml",
+                        help="TOML file with [tokens] and optional [sync] / [cache] / [history] settings")
+    parser.add_argument("--output", help="snapshot file to write (default: [sync] snapshot_path)")
+    parser.add_argument("--full", action="store_true",
+                        help="ignore the response cache and the previous snapshot's incremental sync marks")
+    parser.add_argument("--api-url", help="Canvas base URL (default: [sync] api_url or %s), "
+                                          "e.g. a benchmarks/fake_canvas.py server" % API_URL)
+    parser.add_argument("--deadline", type=float,
+                        help="stop syncing after this many seconds and keep what was fetched "
+                             "(default: [sync] deadline_seconds, else %s; 0 for none)" % SYNC_DEADLINE_SECONDS)
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args(argv)
+
+    with open(args.secrets, "rb") as f:
+        secrets = tomllib.load(f)
+    sync_settings = secrets.get("sync", {})
+    cache_settings = secrets.get("cache", {})
+    configure(
+        api_url=args.api_url or sync_settings.get("api_url"),
+        max_concurrent_requests=sync_settings.get("max_concurrent_requests"),
+        backend=sync_settings.get("backend"),
+        cache_path=cache_settings.get("path"),
+        cache_max_mb=cache_settings.get("max_mb"),
+        history_path=secrets.get("history", {}).get("path"),
+        deadline_seconds=args.deadline if args.deadline is not None else sync_settings.get("deadline_seconds")
+    )
+    setup_logging(args.log_level)
+
+    output = args.output or sync_settings.get("snapshot_path", ".cache/snapshot.sqlite3")
+    student_tokens = dict(secrets.get("tokens", {}))
+    if not student_tokens:
+        parser.error(f"no [tokens] found in {args.secrets}")
+
+    # Carry the incremental sync marks and token checks over from the last snapshot.
+    # A full sync starts over, but keeps the old rows for fetches it can't finish.
+    sync_state = {}
+    fallback_state = None
+    client = get_canvas_client()
+    if os.path.exists(output):
+        try:
+            previous = read_snapshot(output, with_sync_state=True)
+            sync_state = previous["sync_state"]
+            client.token_health.restore(student_tokens, previous["token_health"])
+        except Exception:
+            logger.exception("Could not read previous snapshot; running a full sync", extra={"path": output})
+
+    if args.full:
+        client = client.with_refresh()
+        fallback_state, sync_state = sync_state, {}
+
+    problems = []
+    incomplete = {}
+    metrics = SyncMetrics(student_tokens)
+    snapshot = sync_students(student_tokens, client=client, sync_state=sync_state, problems=problems, metrics=metrics,
+                             incomplete=incomplete, fallback_state=fallback_state)
+    refreshed_at = datetime.now(timezone.utc)
+    write_snapshot(output, snapshot, refreshed_at, problems, metrics, sync_state, incomplete,
+                   client.token_health.report(student_tokens))
+    if HISTORY_PATH:
+        append_history(snapshot, refreshed_at, len(student_tokens))
+    logger.info("snapshot written", extra={"path": output, "students": len(student_tokens), "problems": len(problems),
+                                           "incomplete": len(incomplete)})
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,8 +1,20 @@
 import streamlit as st
 import pandas as pd
-import requests
-import re
-from datetime import datetime, timedelta
+import math
+import os
+import threading
+import time
+import tomllib
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import partial
+
+import canvas_sync
+from canvas_sync import (
+    DISPLAY_TIMEZONE, EXPORT_FORMATS, HISTORY_KEYS, SECTIONS, SyncMetrics, append_history, excel_export_available,
+    export_file, filter_window, format_dates, get_canvas_client, history_counts, iter_frame_chunks,
+    iter_history_chunks, iter_sync_students, logger, previous_history, read_snapshot, snapshot_from_state
+)
  
 # --- PASSWORD PROTECTION ---
 def check_password():
@@ -40,13 +52,58 @@ if not check_password():
     st.stop()
 
 # --- CONFIGURATION ---
-API_URL = "https://wvm.instructure.com"
+# Canvas fetch settings come from the [sync] and [cache] sections of secrets
+sync_settings = st.secrets.get("sync", {})
+cache_settings = st.secrets.get("cache", {})
+history_settings = st.secrets.get("history", {})
+canvas_sync.setup_logging(st.secrets.get("logging", {}).get("level", "INFO"))
+canvas_sync.configure(
+    api_url=sync_settings.get("api_url"),
+    max_concurrent_requests=sync_settings.get("max_concurrent_requests"),
+    backend=sync_settings.get("backend"),
+    cache_path=cache_settings.get("path"),
+    cache_max_mb=cache_settings.get("max_mb"),
+    history_path=history_settings.get("path"),
+    deadline_seconds=sync_settings.get("deadline_seconds")
+)
+
+# The shared data store re-syncs every student in the background this often
+REFRESH_INTERVAL = timedelta(minutes=int(sync_settings.get("refresh_minutes", 15)))
+# While a refresh is running, partial results are published at most this often
+PARTIAL_PUBLISH_SECONDS = 0.5
+# Sections synced on every refresh; the rest are fetched when an aide loads them
+EAGER_SECTIONS = ("grades", "todos")
+# Assignment windows aides can pick, narrowest first. To-dos are synced only out to
+# the widest one an aide has viewed within TODO_WINDOW_KEEP (at least the default).
+ASSIGNMENT_WINDOWS = ["This Week", "Next Week", "Next 2 Weeks", "Next 3 Weeks", "All Upcoming"]
+DEFAULT_ASSIGNMENT_WINDOW = "Next 2 Weeks"
+TODO_WINDOW_KEEP = timedelta(hours=1)
+# When set, data comes from a snapshot file written by `python canvas_sync.py`
+# (e.g. from cron) instead of syncing inside the dashboard
+SNAPSHOT_PATH = sync_settings.get("snapshot_path")
+
+# Student breakdowns show this many cards per page
+BREAKDOWN_PAGE_SIZE = 12
+
+
+@st.cache_data
+def load_roster(path):
+    """Reads {cohort: [student, ...]} from the roster TOML file
+
+    Falls back to every student with a token, in one cohort, if the file is missing.
+    """
+    try:
+        with open(path, "rb") as f:
+            cohorts = tomllib.load(f).get("cohorts", {})
+    except FileNotFoundError:
+        return {"All Students": list(st.secrets["tokens"])}
+    return {cohort: list(names) for cohort, names in cohorts.items()}
+
 
-# List of students to monitor
-STUDENTS = [
-    "DavidS", "Jonathan", "DavidM", "Anirudh", "Alex",
-    "Jesus", "Olivia", "Angel", "Tava", "Heidy", "Melody"
-]
+# Students to monitor, grouped by cohort (see roster.toml)
+COHORTS = load_roster(st.secrets.get("roster", {}).get("path", "roster.toml"))
+STUDENTS = [name for names in COHORTS.values() for name in names]
+STUDENT_COHORTS = {name: cohort for cohort, names in COHORTS.items() for name in names}
 
 # --- MAIN APPLICATION ---
 st.set_page_config(page_title="Camden-West Valley Canvas Monitoring Tool", layout="wide")
@@ -81,7 +138,7 @@ col1, col2 = st.columns([1, 3])
 with col1:
     selection_mode = st.radio(
         "Select students:",
-        ["All Students", "Individual Students"],
+        ["All Students", "By Cohort", "Individual Students"],
         index=0
     )
 
@@ -90,6 +147,13 @@ with col2:
     if selection_mode == "All Students":
         selected_students = STUDENTS
         st.info(f"📊 Monitoring all {len(STUDENTS)} students")
+    elif selection_mode == "By Cohort":
+        selected_cohorts = st.multiselect(
+            "Choose cohorts to monitor:",
+            list(COHORTS),
+            default=list(COHORTS)[:1]
+        )
+        selected_students = [name for cohort in selected_cohorts for name in COHORTS[cohort]]
     elif selection_mode == "Individual Students":
         selected_students = st.multiselect(
             "Choose students to monitor:",
@@ -102,606 +166,715 @@ if not selected_students:
     st.stop()
 
 
-def get_student_todo(name, token, cutoff_date=None):
-    """Fetches To-Do list using the DIRECT Canvas API endpoint"""
-    try:
-        url = f"{API_URL}/api/v1/planner/items"
-
-        headers = {
-            "Authorization": f"Bearer {token}"
-        }
-
-        params = {
-            "start_date": datetime.now().strftime("%Y-%m-%d"),
-            "filter": "new_activity",
-            "per_page": 50,
-            "order": "asc"  # Sort by due date
-        }
-
-        # If we have a cutoff date, add it to the API params
-        if cutoff_date:
-            params["end_date"] = cutoff_date.strftime("%Y-%m-%d")
-
-        response = requests.get(url, headers=headers, params=params)
-
-        if response.status_code != 200:
-            st.error(f"⚠️ {name}: Access Denied (Check Token)")
-            return []
-
-        items = response.json()
-
-        tasks = []
-        for item in items:
-            title = item.get('plannable', {}).get('title', 'Untitled')
-            due_date_str = item.get('plannable_date', None)
-
-            # Check Status
-            status = "Todo"
-            score = ""
-
-            if 'submissions' in item:
-                subs = item['submissions']
-                if isinstance(subs, dict):
-                    if subs.get('submitted'):
-                        status = "Submitted"
-                    if subs.get('graded'):
-                        score = f" (Score: {subs.get('score')})"
-                elif isinstance(subs, list) and len(subs) > 0:
-                    if subs[0].get('submitted'):
-                        status = "Submitted"
-
-            # Format Date
-            if due_date_str:
-                dt = pd.to_datetime(due_date_str)
-                formatted_date = dt.strftime('%m-%d %H:%M')
-            else:
-                formatted_date = "No Date"
-
-            tasks.append({
-                "Student": name,
-                "Task": title,
-                "Due": formatted_date,
-                "Status": status + score
-            })
-
-        return tasks
-
-    except Exception as e:
-        print(f"DEBUG ERROR for {name}: {e}")
-        return []
-
-
-def get_student_courses(name, token):
-    """Fetches active courses for a student - prerequisite for grades and announcements"""
-    try:
-        url = f"{API_URL}/api/v1/courses"
-
-        headers = {
-            "Authorization": f"Bearer {token}"
-        }
-
-        params = {
-            "enrollment_type": "student",
-            "enrollment_state": "active",
-            "per_page": 100
-        }
-
-        response = requests.get(url, headers=headers, params=params)
-
-        if response.status_code != 200:
-            st.error(f"⚠️ {name}: Unable to fetch courses (Check Token)")
-            return []
-
-        courses_data = response.json()
-
-        # Extract relevant course information
-        courses = []
-        for course in courses_data:
-            courses.append({
-                "id": course.get('id'),
-                "name": course.get('name', 'Unknown Course'),
-                "course_code": course.get('course_code', '')
-            })
-
-        return courses
-
-    except Exception as e:
-        print(f"DEBUG ERROR fetching courses for {name}: {e}")
-        return []
-
-
-def strip_html(text):
-    """Remove HTML tags from text"""
-    if not text:
-        return ""
-    clean = re.sub('<.*?>', '', text)
-    return clean.strip()
-
-
-def get_student_conversations(name, token):
-    """Fetches unread conversations (emails) from Canvas - last 3 weeks"""
-    try:
-        url = f"{API_URL}/api/v1/conversations"
-
-        headers = {
-            "Authorization": f"Bearer {token}"
-        }
-
-        params = {
-            "scope": "unread",
-            "per_page": 100  # Increased to get more results
-        }
-
-        response = requests.get(url, headers=headers, params=params)
+# --- SHARED DATA STORE ---
+
+def assignment_cutoff(choice):
+    """End of the ASSIGNMENT_WINDOWS choice: a Sunday in DISPLAY_TIMEZONE, or None for everything"""
+    today = pd.Timestamp.now(tz=DISPLAY_TIMEZONE)
+    days_until_sunday = 6 - today.weekday()
+    if days_until_sunday < 0:
+        days_until_sunday += 7
+    this_sunday = today + timedelta(days=days_until_sunday)
+
+    if choice == "This Week":
+        return this_sunday
+    if choice == "Next Week":
+        return this_sunday + timedelta(weeks=1)
+    if choice == "Next 2 Weeks":
+        return this_sunday + timedelta(weeks=2)
+    if choice == "Next 3 Weeks":
+        return this_sunday + timedelta(weeks=3)
+    return None
+
+
+class SharedDataStore:
+    """Process-wide dashboard data shared by every aide session
+
+    The latest snapshot (grades_df, convos_df, announcements_df, todos_df) for the
+    whole roster lives here rather than in st.session_state, so page loads read it
+    immediately and sessions never run their own sync. A daemon thread refreshes it
+    every REFRESH_INTERVAL; refresh() runs one on demand. Snapshots are published
+    per student as a refresh progresses, so the tables fill in live. Only one refresh
+    runs at a time, and a request made while one is running just waits for that one.
+
+    Refreshes cover only some SECTIONS: the background one syncs EAGER_SECTIONS, and
+    the other sections cost nothing until an aide loads one. section_synced_at maps
+    each section that has been synced to when it last was.
+
+    To-dos are synced only out to todo_window, the widest assignment window aides
+    have been viewing; widen_todos() extends the sync when one picks a wider window.
+    """
+
+    can_sync = True
+
+    def __init__(self, client, load_tokens, interval=REFRESH_INTERVAL):
+        self.client = client
+        self.load_tokens = load_tokens
+        self.interval = interval
+        self.snapshot = None
+        self.refreshed_at = None
+        self.section_synced_at = {}
+        self.problems = []
+        self.incomplete = {}  # student -> {data type: reason} for fetches the last refresh cut short
+        self.metrics = None  # SyncMetrics of the last finished refresh
+        self._sync_state = {}
+        self._last_sections = frozenset()
+        self.synced_todo_window = None  # todo_window as of the last refresh that synced to-dos
+        self._todo_windows = {}  # ASSIGNMENT_WINDOWS choice -> time.monotonic() an aide last viewed it
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Starts the background refresher (once); the first refresh begins immediately"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="canvas-refresher", daemon=True)
+            self._thread.start()
+
+    def is_refreshing(self):
+        return self._refresh_lock.locked()
+
+    @property
+    def schedule_note(self):
+        return f"refreshes automatically every {int(self.interval.total_seconds() // 60)} min"
+
+    @property
+    def token_health(self):
+        """{student: TokenHealth entry} for every rostered student whose token has been used"""
+        return self.client.token_health.report(self.load_tokens())
+
+    def loaded_sections(self):
+        """The sections shown by default plus every section an aide has loaded"""
+        return frozenset(EAGER_SECTIONS) | self.section_synced_at.keys()
+
+    @property
+    def todo_window(self):
+        """The widest ASSIGNMENT_WINDOWS choice viewed within TODO_WINDOW_KEEP, at least the default"""
+        viewed_since = time.monotonic() - TODO_WINDOW_KEEP.total_seconds()
+        viewed = [choice for choice, viewed_at in self._todo_windows.items() if viewed_at >= viewed_since]
+        return max(viewed + [DEFAULT_ASSIGNMENT_WINDOW], key=ASSIGNMENT_WINDOWS.index)
+
+    def show_todo_window(self, choice):
+        """Records that an aide is viewing to-dos through choice; True if they aren't synced that far yet"""
+        self._todo_windows[choice] = time.monotonic()
+        return not self._todos_cover(choice)
+
+    def _todos_cover(self, choice):
+        return (self.synced_todo_window is None  # The first sync will pick choice up
+                or ASSIGNMENT_WINDOWS.index(choice) <= ASSIGNMENT_WINDOWS.index(self.synced_todo_window))
+
+    def widen_todos(self):
+        """Syncs to-dos out to todo_window, fetching only the weeks past what the last refresh covered"""
+        self.refresh(sections=["todos"], todos_max_age=self.interval.total_seconds())
+
+    def refresh(self, full=False, on_progress=None, sections=EAGER_SECTIONS, todos_max_age=None):
+        """Re-syncs sections for every student, publishing a partial snapshot as each one finishes
+
+        on_progress(done, total, snapshot) is called from the calling thread after each
+        publish. full bypasses the response cache and the incremental sync marks, and
+        always covers every loaded section. If another refresh is already running, a
+        normal request waits for it and returns if it covered sections (and todo_window);
+        a full one, or one for other sections, waits and then runs its own.
+        todos_max_age is passed on to iter_sync_students.
+        """
+        sections = frozenset(sections)
+        if full:
+            sections |= self.loaded_sections()
+        if not self._refresh_lock.acquire(blocking=False):
+            with self._refresh_lock:
+                pass
+            if not full and sections <= self._last_sections and self._todos_cover(self.todo_window):
+                return
+            self._refresh_lock.acquire()
 
-        if response.status_code != 200:
-            st.error(f"⚠️ {name}: Unable to fetch conversations (Check Token)")
-            return []
-
-        conversations = response.json()
-
-        # Filter to last 3 weeks
-        three_weeks_ago = datetime.now() - timedelta(weeks=3)
-
-        messages = []
-        for convo in conversations:
-            last_message_at = convo.get('last_message_at')
-
-            # Only include messages from last 3 weeks
-            if last_message_at:
-                msg_date = pd.to_datetime(last_message_at)
-                if msg_date < three_weeks_ago:
+        try:
+            client = self.client
+            fallback_state = None
+            if full:
+                client = client.with_refresh()
+                # Keep showing the old data for students the full refresh hasn't reached yet
+                fallback_state, self._sync_state = self._sync_state, {}
+
+            student_tokens = self.load_tokens()
+            todo_window = self.todo_window
+            problems = []
+            incomplete = {}
+            metrics = SyncMetrics(student_tokens)
+            done = 0
+            published_at = 0.0
+            for name in iter_sync_students(student_tokens, None, client, self._sync_state, problems, metrics,
+                                           sections, incomplete, None, assignment_cutoff(todo_window),
+                                           todos_max_age, fallback_state):
+                done += name is not None
+                # Rebuilding frames costs O(roster), so big rosters publish at most every PARTIAL_PUBLISH_SECONDS
+                if name is not None and time.monotonic() - published_at < PARTIAL_PUBLISH_SECONDS:
                     continue
-            else:
-                continue  # Skip if no date
-
-            subject = convo.get('subject', 'No Subject')
-            last_message = convo.get('last_message', '')
-
-            # Create preview (first 100 chars)
-            preview = strip_html(last_message)
-            if len(preview) > 100:
-                preview = preview[:100] + "..."
-
-            # Get sender info
-            participants = convo.get('participants', [])
-            from_user = "Unknown"
-            if participants:
-                from_user = participants[0].get('name', 'Unknown')
-
-            messages.append({
-                "Student": name,
-                "Subject": subject,
-                "Preview": preview,
-                "Date": last_message_at,  # Store as datetime for sorting
-                "Date_Formatted": pd.to_datetime(last_message_at).strftime('%m-%d %H:%M'),
-                "From": from_user
-            })
-
-        return messages
-
-    except Exception as e:
-        print(f"DEBUG ERROR fetching conversations for {name}: {e}")
-        return []
-
-
-def get_student_announcements(name, token, courses):
-    """Fetches announcements from all student courses - last 3 weeks"""
-    try:
-        if not courses:
-            return []
+                published_at = time.monotonic()
+
+                # Publish in one assignment so readers never see a half-built snapshot
+                with metrics.stage("normalize"):
+                    self.snapshot = snapshot_from_state(student_tokens, self._sync_state, fallback_state)
+                self.problems = list(problems)
+                self.incomplete = dict(incomplete)
+                if on_progress:
+                    with metrics.stage("live preview"):
+                        on_progress(done, len(student_tokens), self.snapshot)
+
+            metrics.finish()
+            self.metrics = metrics
+            finished_at = datetime.now(timezone.utc)
+            self.section_synced_at = {**self.section_synced_at, **dict.fromkeys(sections, finished_at)}
+            if sections >= set(EAGER_SECTIONS):
+                self.refreshed_at = finished_at
+            if "todos" in sections:
+                self.synced_todo_window = todo_window
+            self._last_sections = sections
+
+            if canvas_sync.HISTORY_PATH:
+                try:
+                    append_history(self.snapshot, finished_at, len(student_tokens), sections)
+                except Exception:
+                    logger.exception("Error appending sync history")
+        finally:
+            self._refresh_lock.release()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Error in background refresh")
+            time.sleep(self.interval.total_seconds())
 
-        url = f"{API_URL}/api/v1/announcements"
 
-        headers = {
-            "Authorization": f"Bearer {token}"
-        }
+class SnapshotFileStore:
+    """Dashboard data loaded from a snapshot file written by the canvas_sync command line
 
-        # Build context_codes array from course IDs
-        context_codes = [f"course_{course['id']}" for course in courses]
+    Stands in for SharedDataStore when [sync] snapshot_path is set: syncing happens
+    elsewhere (e.g. cron), so the dashboard never talks to Canvas. The file is
+    re-read whenever its modification time changes.
+    """
 
-        # Calculate start date (3 weeks ago) and end date (today)
-        three_weeks_ago = datetime.now() - timedelta(weeks=3)
+    can_sync = False
+    schedule_note = "loaded from the scheduled sync's snapshot"
 
-        params = {
-            "context_codes[]": context_codes,
-            "active_only": True,
-            "start_date": three_weeks_ago.strftime("%Y-%m-%d"),
-            "end_date": datetime.now().strftime("%Y-%m-%d"),
-            "per_page": 100
-        }
+    def __init__(self, path):
+        self.path = path
+        self._loaded = {}
+        self._loaded_mtime = None
+        self._lock = threading.Lock()
 
-        response = requests.get(url, headers=headers, params=params)
+    def _current(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return {}
+        with self._lock:
+            if mtime != self._loaded_mtime:
+                try:
+                    self._loaded = read_snapshot(self.path)
+                    self._loaded_mtime = mtime
+                except Exception:
+                    logger.exception("Error reading snapshot", extra={"path": self.path})
+            return self._loaded
+
+    @property
+    def snapshot(self):
+        return self._current().get("snapshot")
+
+    @property
+    def refreshed_at(self):
+        return self._current().get("refreshed_at")
+
+    @property
+    def section_synced_at(self):
+        # The command line syncs every section at once
+        refreshed_at = self.refreshed_at
+        return dict.fromkeys(SECTIONS, refreshed_at) if refreshed_at else {}
+
+    @property
+    def problems(self):
+        return self._current().get("problems", [])
+
+    @property
+    def incomplete(self):
+        return self._current().get("incomplete", {})
+
+    @property
+    def token_health(self):
+        return self._current().get("token_health", {})
+
+    @property
+    def metrics(self):
+        return self._current().get("metrics")
+
+    def is_refreshing(self):
+        return False
 
-        if response.status_code != 200:
-            st.error(f"⚠️ {name}: Unable to fetch announcements (Check Token)")
-            return []
+    def loaded_sections(self):
+        return frozenset(SECTIONS)
 
-        announcements_data = response.json()
+    def show_todo_window(self, choice):
+        # The command line syncs every upcoming to-do
+        return False
 
-        announcements = []
-        for announcement in announcements_data:
-            title = announcement.get('title', 'No Title')
-            message = announcement.get('message', '')
-            posted_at = announcement.get('posted_at')
+    def refresh(self, full=False, on_progress=None, sections=EAGER_SECTIONS):
+        """Re-reads the snapshot file if it changed; full and sections are ignored, as syncs run elsewhere"""
+        self._current()
 
-            if not posted_at:
-                continue
 
-            # Strip HTML and create preview
-            preview = strip_html(message)
-            if len(preview) > 150:
-                preview = preview[:150] + "..."
+def load_roster_tokens():
+    """Maps each rostered student to their Canvas token, skipping students without one"""
+    tokens = st.secrets["tokens"]
+    return {name: tokens[name] for name in STUDENTS if name in tokens}
 
-            # Get course name from context_code
-            context_code = announcement.get('context_code', '')
-            course_name = "Unknown Course"
-            if context_code.startswith('course_'):
-                course_id = int(context_code.replace('course_', ''))
-                for course in courses:
-                    if course['id'] == course_id:
-                        course_name = course['name']
-                        break
 
-            announcements.append({
-                "Student": name,
-                "Title": title,
-                "Preview": preview,
-                "Posted": posted_at,  # Store as datetime for sorting
-                "Posted_Formatted": pd.to_datetime(posted_at).strftime('%m-%d'),
-                "Course": course_name
-            })
+@st.cache_resource
+def get_data_store():
+    """Returns the process-wide data store: the snapshot file if configured, else a SharedDataStore
 
-        return announcements
+    A SharedDataStore has its background refresher started.
+    """
+    if SNAPSHOT_PATH:
+        return SnapshotFileStore(SNAPSHOT_PATH)
+    store = SharedDataStore(get_canvas_client(), load_roster_tokens)
+    store.start()
+    return store
 
-    except Exception as e:
-        print(f"DEBUG ERROR fetching announcements for {name}: {e}")
-        return []
 
+def filter_students(df, students):
+    """Restricts a snapshot frame to the selected students (no-op when all are selected)"""
+    if df is None or set(students) >= set(STUDENTS):
+        return df
+    return df[df['Student'].isin(students)]
 
-def get_student_grades(name, token, courses):
-    """Fetches submissions and flags missing/zero grades"""
-    grade_issues = []
 
-    try:
-        headers = {
-            "Authorization": f"Bearer {token}"
-        }
-
-        # Iterate through each course
-        for course in courses:
-            course_id = course['id']
-            course_name = course['name']
-
-            try:
-                url = f"{API_URL}/api/v1/courses/{course_id}/students/submissions"
-                params = {
-                    "student_ids[]": "all",
-                    "per_page": 100
-                }
-
-                response = requests.get(url, headers=headers, params=params)
-
-                if response.status_code != 200:
-                    continue  # Skip this course if we can't access submissions
-
-                submissions = response.json()
-
-                # Check each submission for issues
-                for submission in submissions:
-                    # Skip if excused
-                    if submission.get('excused'):
-                        continue
-
-                    assignment_name = submission.get('assignment', {}).get('name', 'Unknown Assignment')
-                    score = submission.get('score')
-                    missing = submission.get('missing', False)
-                    workflow_state = submission.get('workflow_state', '')
-                    due_at = submission.get('assignment', {}).get('due_at')
-
-                    issue = None
-
-                    # Check for zero grade (but not excused)
-                    if score == 0 and not submission.get('excused'):
-                        issue = "Zero Grade"
-                    # Check for missing flag
-                    elif missing:
-                        issue = "Missing"
-                    # Check for unsubmitted past due
-                    elif workflow_state == "unsubmitted" and due_at:
-                        due_date = pd.to_datetime(due_at)
-                        if due_date < datetime.now():
-                            issue = "Unsubmitted"
-
-                    # If we found an issue, add it to the list
-                    if issue:
-                        formatted_due = "No Date"
-                        if due_at:
-                            dt = pd.to_datetime(due_at)
-                            formatted_due = dt.strftime('%m-%d')
-
-                        grade_issues.append({
-                            "Student": name,
-                            "Assignment": assignment_name,
-                            "Course": course_name,
-                            "Issue": issue,
-                            "Due Date": formatted_due,
-                            "Status": workflow_state
-                        })
-
-            except Exception as e:
-                print(f"DEBUG ERROR fetching submissions for {name} in course {course_id}: {e}")
-                continue  # Skip this course and continue with others
-
-        return grade_issues
-
-    except Exception as e:
-        print(f"DEBUG ERROR in get_student_grades for {name}: {e}")
-        return []
+def describe_age(timestamp):
+    """Human-readable age of a UTC timestamp, e.g. 3 min ago"""
+    seconds = (datetime.now(timezone.utc) - timestamp).total_seconds()
+    if seconds < 60:
+        return "just now"
+    if seconds < 3600:
+        return f"{int(seconds // 60)} min ago"
+    return f"{int(seconds // 3600)} h ago"
 
 
 # --- MAIN DASHBOARD UI ---
 
-# Initialize session state for data persistence
-if 'data_loaded' not in st.session_state:
-    st.session_state.data_loaded = False
-    st.session_state.grades_df = None
-    st.session_state.convos_df = None
-    st.session_state.announcements_df = None
-    st.session_state.todos_df = None
-
-if st.button("🔄 Sync Selected Students"):
-    # Initialize collectors for all data types
-    all_conversations = []
-    all_todos = []
-    all_grades = []
-    all_announcements = []
-
-    progress_bar = st.progress(0)
+store = get_data_store()
 
-    for i, student_name in enumerate(selected_students):
-        # Get token from secrets
-        try:
-            token = st.secrets["tokens"][student_name]
-        except KeyError:
-            st.warning(f"⚠️ Token not found for {student_name} in secrets")
-            progress_bar.progress((i + 1) / len(selected_students))
-            continue
+col_sync, col_bypass = st.columns([1, 3])
+with col_sync:
+    sync_clicked = st.button("🔄 Refresh Now")
+with col_bypass:
+    bypass_cache = store.can_sync and st.checkbox(
+        "Force full refresh (bypass cache)",
+        value=False,
+        help="Ignore cached Canvas responses and incremental sync marks, and download everything again"
+    )
 
-        # 1. Get courses (needed for grades & announcements)
-        courses = get_student_courses(student_name, token)
+def render_token_status(students):
+    """One table of every selected student's token: working, rejected by Canvas, unchecked or missing
+
+    Students whose token Canvas rejected are skipped by syncs until the token is
+    checked again (see canvas_sync.TokenHealth), so this replaces their per-fetch errors.
+    """
+    token_health = store.token_health
+    rows = []
+    for name in students:
+        entry = token_health.get(name)
+        if name not in st.secrets["tokens"]:
+            status, checked, detail = "🚫 Missing from secrets", "", "Add the student's token under [tokens]"
+        elif entry is None:
+            status, checked, detail = "❔ Unchecked", "", ""
+        elif entry["status"] == "rejected":
+            status, checked, detail = "❌ Rejected", describe_age(entry["checked_at"]), entry["detail"]
+        else:
+            status, checked, detail = "✅ OK", describe_age(entry["checked_at"]), ""
+        rows.append({"Student": name, "Token": status, "Checked": checked, "Detail": detail})
+
+    bad = [row["Student"] for row in rows if row["Token"].startswith(("❌", "🚫"))]
+    label = f"🔑 TOKEN STATUS ({len(bad)} need attention)" if bad else "🔑 TOKEN STATUS"
+    with st.expander(label, expanded=bool(bad)):
+        if bad:
+            st.caption("❌ Rejected tokens are expired or revoked; their students show their last synced data "
+                       f"and cost no Canvas requests until the token is checked again in "
+                       f"{canvas_sync.TOKEN_HEALTH_TTL // 60} min.")
+        st.dataframe(pd.DataFrame(rows), width="stretch", hide_index=True)
+
+def render_live_preview(snapshot):
+    """Shows the grade alerts and assignments synced so far while a refresh runs"""
+    grades_df, _, _, todos_df = (filter_students(df, selected_students) for df in snapshot)
+    if grades_df is not None and not grades_df.empty:
+        st.subheader(f"🚨 Grade alerts so far ({len(grades_df)})")
+        st.dataframe(format_dates(grades_df[['Student', 'Assignment', 'Course', 'Issue', 'Due Date']], 'Due Date', '%m-%d'),
+                     width="stretch")
+    if todos_df is not None and not todos_df.empty:
+        st.subheader(f"✅ Assignments so far ({len(todos_df)})")
+        st.dataframe(format_dates(todos_df[['Student', 'Task', 'Due', 'Status']], 'Due', '%m-%d %H:%M'),
+                     width="stretch")
+
+
+if sync_clicked:
+    if store.is_refreshing():
+        st.info("⏳ A refresh is already running; waiting for it to finish...")
 
-        # 2. Fetch all data types
-        student_convos = get_student_conversations(student_name, token)
-        student_todos = get_student_todo(student_name, token, None)  # Will add filtering in UI
-        student_grades = get_student_grades(student_name, token, courses)
-        student_announcements = get_student_announcements(student_name, token, courses)
+    progress_bar = st.progress(0)
+    live_preview = st.empty()
 
-        # 3. Collect results
-        all_conversations.extend(student_convos)
-        all_todos.extend(student_todos)
-        all_grades.extend(student_grades)
-        all_announcements.extend(student_announcements)
+    def update_progress(done, total, snapshot):
+        progress_bar.progress(min(done / max(total, 1), 1.0), text=f"Synced {done} of {total} students")
+        with live_preview.container():
+            render_live_preview(snapshot)
 
-        progress_bar.progress((i + 1) / len(selected_students))
+    # Refresh the shared store for everyone, fetching all students concurrently
+    store.refresh(full=bypass_cache, on_progress=update_progress, sections=store.loaded_sections())
 
     progress_bar.empty()
+    live_preview.empty()
 
-    # Convert to DataFrames
-    grades_df = pd.DataFrame(all_grades) if all_grades else None
-    convos_df = pd.DataFrame(all_conversations) if all_conversations else None
-    announcements_df = pd.DataFrame(all_announcements) if all_announcements else None
-    todos_df = pd.DataFrame(all_todos) if all_todos else None
-
-    # Sort conversations and announcements by date (newest first)
-    if convos_df is not None and not convos_df.empty:
-        convos_df['Date'] = pd.to_datetime(convos_df['Date'])
-        convos_df = convos_df.sort_values('Date', ascending=False)
-
-    if announcements_df is not None and not announcements_df.empty:
-        announcements_df['Posted'] = pd.to_datetime(announcements_df['Posted'])
-        announcements_df = announcements_df.sort_values('Posted', ascending=False)
-
-    # Store in session state
-    st.session_state.grades_df = grades_df
-    st.session_state.convos_df = convos_df
-    st.session_state.announcements_df = announcements_df
-    st.session_state.todos_df = todos_df
-    st.session_state.data_loaded = True
-
-# Retrieve data from session state
-if st.session_state.data_loaded:
-    grades_df = st.session_state.grades_df
-    convos_df = st.session_state.convos_df
-    announcements_df = st.session_state.announcements_df
-    todos_df = st.session_state.todos_df
+# Read the latest shared snapshot
+snapshot = store.snapshot
+data_loaded = snapshot is not None
+
+if data_loaded:
+    if store.refreshed_at is None:
+        st.caption("⏳ First sync in progress; showing the students synced so far")
+    else:
+        st.caption(f"🕒 Last refreshed {describe_age(store.refreshed_at)} · {store.schedule_note}")
+    # Rejected tokens are reported once in the token status table instead
+    rejected = {name for name, entry in store.token_health.items() if entry["status"] == "rejected"}
+    for student_name, message in store.problems:
+        if student_name in selected_students and student_name not in rejected:
+            st.error(message)
+    incomplete = [f"{name} ({', '.join(store.incomplete[name])})" for name in selected_students
+                  if name in store.incomplete]
+    if incomplete:
+        st.warning("⏳ The last sync ran out of time or hit failing Canvas endpoints, so these students "
+                   f"show their previously synced data: {'; '.join(incomplete)}")
+
+    grades_df, convos_df, announcements_df, todos_df = (filter_students(df, selected_students) for df in snapshot)
+elif store.can_sync:
+    st.info("⏳ The first sync is running in the background. Click Refresh Now to wait for it.")
 else:
+    st.info(f"⏳ No snapshot at {SNAPSHOT_PATH} yet. Run `python canvas_sync.py` to create one.")
+render_token_status(selected_students)
+
+if not data_loaded:
     grades_df = None
     convos_df = None
     announcements_df = None
     todos_df = None
 
-if st.session_state.data_loaded:
-    # --- GRADES ALERTS SECTION ---
+# --- DASHBOARD SECTIONS ---
+# Each section is a fragment, so changing one section's filter reruns only that
+# section instead of the whole script (password check, header, sync and all).
+
+# Look-back windows offered by the messages and announcements filters
+RECENT_WINDOWS = {
+    "Last 3 Days": timedelta(days=3),
+    "Last Week": timedelta(weeks=1),
+    "Last 2 Weeks": timedelta(weeks=2),
+    "Last 3 Weeks (All)": None
+}
+
+
+def window_start(choice):
+    """Start of the look-back window picked in a RECENT_WINDOWS radio, or None for everything"""
+    window = RECENT_WINDOWS[choice]
+    return pd.Timestamp.now(tz="UTC") - window if window else None
+
+
+# Columns each section exports, and the sheet it gets in a student workbook
+EXPORT_COLUMNS = {
+    "grades": ['Student', 'Assignment', 'Course', 'Issue', 'Due Date', 'Status'],
+    "conversations": ['Student', 'Subject', 'Preview', 'Date', 'From'],
+    "announcements": ['Student', 'Title', 'Preview', 'Posted', 'Course'],
+    "todos": ['Student', 'Task', 'Due', 'Status'],
+}
+EXPORT_SHEETS = {
+    "grades": "Grade Alerts",
+    "conversations": "Unread Messages",
+    "announcements": "Announcements",
+    "todos": "Assignments",
+}
+
+
+def section_windows():
+    """The window each section's radio last showed, for exports
+
+    Sections are fragments that rerun on their own, so their choices go into one
+    dict that download callables read when clicked rather than when rendered.
+    """
+    return st.session_state.setdefault("section_windows", {})
+
+
+def export_frame(df, columns, fmt):
+    """Exports df[columns] in fmt; passed to download buttons so the file is only built on click"""
+    return export_file(fmt, iter_frame_chunks(df, columns))
+
+
+def render_export_buttons(df, columns, name, key):
+    """CSV and Parquet download buttons for a master list, exporting exactly the rows shown"""
+    stamp = pd.Timestamp.now(tz=DISPLAY_TIMEZONE).strftime("%Y%m%d-%H%M")
+    for col, fmt in zip(st.columns([1, 1, 4])[:2], ["csv", "parquet"]):
+        mime, extension = EXPORT_FORMATS[fmt]
+        col.download_button(f"⬇️ {fmt.upper()}", partial(export_frame, df, columns, fmt),
+                            file_name=f"{name}-{stamp}.{extension}", mime=mime, key=f"{key}_export_{fmt}",
+                            on_click="ignore")
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def load_previous_keys(table, synced_at, students):
+    """Keys of table's rows in the last history sync before synced_at, or None if there wasn't one"""
+    previous = previous_history(table, synced_at, students)
+    return None if previous is None else set(previous.itertuples(index=False, name=None))
+
+
+def new_since_last_sync(df, table):
+    """Flags df's rows that weren't in the previous sync's history, or returns None without history"""
+    synced_at = store.section_synced_at.get(table)
+    if not canvas_sync.HISTORY_PATH or synced_at is None:
+        return None
+    previous = load_previous_keys(table, synced_at, tuple(selected_students))
+    if previous is None:
+        return None
+    keys = df[HISTORY_KEYS[table]].itertuples(index=False, name=None)
+    new_rows = pd.Series([key not in previous for key in keys], index=df.index)
+    if table == "todos":
+        # The previous sync may have covered a narrower window; rows due past its last
+        # one are only newly in view, so they aren't flagged
+        last_due = max((due for _, _, due in previous if pd.notna(due)), default=None)
+        new_rows &= df['Due'] <= last_due if last_due is not None else False
+    return new_rows
+
+
+def with_new_column(display_df, new_rows):
+    """Prepends a 🆕 column to a display frame when new_since_last_sync found a previous sync"""
+    if new_rows is None:
+        return display_df
+    st.caption(f"🆕 {int(new_rows.sum())} new since the last sync")
+    return display_df.assign(New=new_rows.map({True: "🆕", False: ""}))[["New", *display_df.columns]]
+
+
+def render_section_status(section, label):
+    """Shows when section was last synced, with a button to sync it now
+
+    Sections outside EAGER_SECTIONS aren't synced until an aide clicks Load here; a
+    click re-syncs just that section, then reruns the page so every table sees it.
+    Returns True if the section has data to show.
+    """
+    synced_at = store.section_synced_at.get(section)
+    if not store.can_sync:
+        return section in store.loaded_sections()
+
+    col_status, col_button = st.columns([4, 1])
+    if synced_at is None and section in EAGER_SECTIONS:
+        col_status.caption(f"⏳ {label} are still syncing")
+        return True
+    if synced_at is None:
+        col_status.caption(f"💤 {label} aren't loaded yet, so they cost no Canvas requests until you load them.")
+        clicked = col_button.button("📥 Load", key=f"{section}_load")
+    else:
+        col_status.caption(f"🕒 {label} updated {describe_age(synced_at)}")
+        clicked = col_button.button("🔄 Refresh", key=f"{section}_refresh")
+
+    if clicked:
+        with st.spinner(f"Syncing {label.lower()}..."):
+            store.refresh(sections=[section])
+        st.rerun()
+    return section in store.loaded_sections()
+
+def render_student_breakdown(df, columns, key):
+    """Renders one card per student in a 3-column grid, a page of BREAKDOWN_PAGE_SIZE at a time
+
+    Only the cards on the current page are built, so the element count stays flat
+    however many students are selected. key keeps each section's search and page separate.
+    """
+    st.divider()
+    st.subheader("👤 Student Breakdown")
+
+    students = list(df['Student'].unique())
+    col_search, col_page = st.columns([3, 1])
+    with col_search:
+        search = st.text_input("🔎 Find student", key=f"{key}_search", placeholder="Type part of a name")
+    if search:
+        students = [student for student in students if search.lower() in student.lower()]
+
+    pages = max(math.ceil(len(students) / BREAKDOWN_PAGE_SIZE), 1)
+    page_key = f"{key}_page"
+    if st.session_state.get(page_key, 1) > pages:
+        st.session_state[page_key] = pages  # The search shrank the list past the current page
+    with col_page:
+        page = st.number_input("Page", min_value=1, max_value=pages, key=page_key) if pages > 1 else 1
+
+    visible = students[(page - 1) * BREAKDOWN_PAGE_SIZE:page * BREAKDOWN_PAGE_SIZE]
+    if not visible:
+        st.info("🔎 No students match that search.")
+        return
+    st.caption(f"Showing {len(visible)} of {len(students)} students")
+
+    page_rows = df[df['Student'].isin(visible)]
+    cols = st.columns(3)
+    for i, (student, student_data) in enumerate(page_rows.groupby('Student', sort=False, observed=True)):
+        with cols[i % 3]:
+            with st.container(border=True):
+                st.write(f"**{student}**")
+                st.table(student_data[columns])
+
+
+@st.fragment
+def render_summary_section(grades_df, convos_df, announcements_df, todos_df):
+    """Compact per-student counts for every section, in one virtualized table"""
+    with st.expander("📊 SUMMARY", expanded=True):
+        summary = pd.DataFrame({"Student": selected_students})
+        summary["Cohort"] = summary["Student"].map(STUDENT_COHORTS)
+        summary["Sync"] = ["⏳ Incomplete" if name in store.incomplete else "✅" for name in summary["Student"]]
+        for label, section, df in [("Grade Alerts", "grades", grades_df),
+                                   ("Unread Messages", "conversations", convos_df),
+                                   ("Announcements", "announcements", announcements_df),
+                                   ("Assignments", "todos", todos_df)]:
+            if section not in store.loaded_sections():
+                continue  # Not loaded yet; a column of zeros would read as "all clear"
+            counts = df['Student'].value_counts() if df is not None else pd.Series(dtype=int)
+            summary[label] = summary["Student"].map(counts).fillna(0).astype(int)
+
+        st.dataframe(summary.sort_values("Grade Alerts", ascending=False), width="stretch", hide_index=True)
+
+
+@st.fragment
+def render_grades_section(grades_df):
     grades_count = len(grades_df) if grades_df is not None and not grades_df.empty else 0
     with st.expander(f"🚨 GRADES ALERTS ({grades_count})", expanded=(grades_count > 0)):
+        render_section_status("grades", "Grade alerts")
         if grades_df is not None and not grades_df.empty:
-            st.subheader("📋 Master Alert List")
-            st.dataframe(grades_df, use_container_width=True)
-
-            st.divider()
-            st.subheader("👤 Student Breakdown")
-
-            cols = st.columns(3)
-            unique_students = grades_df['Student'].unique()
+            display_grades = format_dates(
+                grades_df[['Student', 'Assignment', 'Course', 'Issue', 'Due Date', 'Status']], 'Due Date', '%m-%d'
+            )
+            display_grades = with_new_column(display_grades, new_since_last_sync(grades_df, "grades"))
 
-            for i, student in enumerate(unique_students):
-                col = cols[i % 3]
-                student_data = grades_df[grades_df['Student'] == student]
+            st.subheader("📋 Master Alert List")
+            st.dataframe(display_grades, width="stretch")
+            render_export_buttons(grades_df, EXPORT_COLUMNS["grades"], "grade-alerts", key="grades")
 
-                with col:
-                    with st.container(border=True):
-                        st.write(f"**{student}**")
-                        st.table(student_data[['Assignment', 'Issue', 'Due Date']])
+            render_student_breakdown(display_grades, ['Assignment', 'Issue', 'Due Date'], key="grades")
         else:
             st.success("✅ No grade issues found!")
 
-    # --- UNREAD MESSAGES SECTION ---
+
+@st.fragment
+def render_messages_section(convos_df):
     convos_count = len(convos_df) if convos_df is not None and not convos_df.empty else 0
-    with st.expander(f"📧 UNREAD MESSAGES ({convos_count})", expanded=False):
+    loaded = "conversations" in store.loaded_sections()
+    with st.expander(f"📧 UNREAD MESSAGES ({convos_count if loaded else 'not loaded'})", expanded=False):
+        if not render_section_status("conversations", "Unread messages"):
+            return
         if convos_df is not None and not convos_df.empty:
             # Add time filter for emails
             email_filter = st.radio(
                 "Show emails from:",
-                ["Last 3 Days", "Last Week", "Last 2 Weeks", "Last 3 Weeks (All)"],
+                list(RECENT_WINDOWS),
                 index=3,
                 horizontal=True,
                 key="email_filter"
             )
+            section_windows()["conversations"] = email_filter
 
-            # Apply time filter
-            filtered_convos = convos_df.copy()
-            if email_filter == "Last 3 Days":
-                cutoff = datetime.now() - timedelta(days=3)
-                filtered_convos = filtered_convos[filtered_convos['Date'] >= cutoff]
-            elif email_filter == "Last Week":
-                cutoff = datetime.now() - timedelta(weeks=1)
-                filtered_convos = filtered_convos[filtered_convos['Date'] >= cutoff]
-            elif email_filter == "Last 2 Weeks":
-                cutoff = datetime.now() - timedelta(weeks=2)
-                filtered_convos = filtered_convos[filtered_convos['Date'] >= cutoff]
+            # Apply time filter (newest first)
+            filtered_convos = filter_window(convos_df, 'Date', start=window_start(email_filter), newest_first=True)
 
             if not filtered_convos.empty:
-                st.subheader("📋 Master Message List")
                 # Display with formatted date
-                display_convos = filtered_convos.copy()
-                display_convos['Date'] = display_convos['Date_Formatted']
-                st.dataframe(display_convos[['Student', 'Subject', 'Preview', 'Date', 'From']], use_container_width=True)
-
-                st.divider()
-                st.subheader("👤 Student Breakdown")
-
-                cols = st.columns(3)
-                unique_students = filtered_convos['Student'].unique()
+                display_convos = format_dates(
+                    filtered_convos[['Student', 'Subject', 'Preview', 'Date', 'From']], 'Date', '%m-%d %H:%M'
+                )
 
-                for i, student in enumerate(unique_students):
-                    col = cols[i % 3]
-                    student_data = filtered_convos[filtered_convos['Student'] == student].copy()
-                    student_data['Date'] = student_data['Date_Formatted']
+                st.subheader("📋 Master Message List")
+                st.dataframe(display_convos, width="stretch")
+                render_export_buttons(filtered_convos, EXPORT_COLUMNS["conversations"], "unread-messages",
+                                      key="messages")
 
-                    with col:
-                        with st.container(border=True):
-                            st.write(f"**{student}**")
-                            st.table(student_data[['Subject', 'Preview', 'Date']])
+                render_student_breakdown(display_convos, ['Subject', 'Preview', 'Date'], key="messages")
             else:
                 st.info(f"📬 No unread messages in the selected timeframe.")
         else:
             st.info("📬 All caught up! No unread messages.")
 
-    # --- ANNOUNCEMENTS SECTION ---
+
+@st.fragment
+def render_announcements_section(announcements_df):
     announcements_count = len(announcements_df) if announcements_df is not None and not announcements_df.empty else 0
-    with st.expander(f"📢 ANNOUNCEMENTS ({announcements_count})", expanded=False):
+    loaded = "announcements" in store.loaded_sections()
+    with st.expander(f"📢 ANNOUNCEMENTS ({announcements_count if loaded else 'not loaded'})", expanded=False):
+        if not render_section_status("announcements", "Announcements"):
+            return
         if announcements_df is not None and not announcements_df.empty:
             # Add time filter for announcements
             announcement_filter = st.radio(
                 "Show announcements from:",
-                ["Last 3 Days", "Last Week", "Last 2 Weeks", "Last 3 Weeks (All)"],
+                list(RECENT_WINDOWS),
                 index=3,
                 horizontal=True,
                 key="announcement_filter"
             )
+            section_windows()["announcements"] = announcement_filter
 
-            # Apply time filter
-            filtered_announcements = announcements_df.copy()
-            if announcement_filter == "Last 3 Days":
-                cutoff = datetime.now() - timedelta(days=3)
-                filtered_announcements = filtered_announcements[filtered_announcements['Posted'] >= cutoff]
-            elif announcement_filter == "Last Week":
-                cutoff = datetime.now() - timedelta(weeks=1)
-                filtered_announcements = filtered_announcements[filtered_announcements['Posted'] >= cutoff]
-            elif announcement_filter == "Last 2 Weeks":
-                cutoff = datetime.now() - timedelta(weeks=2)
-                filtered_announcements = filtered_announcements[filtered_announcements['Posted'] >= cutoff]
+            # Apply time filter (newest first)
+            filtered_announcements = filter_window(
+                announcements_df, 'Posted', start=window_start(announcement_filter), newest_first=True
+            )
 
             if not filtered_announcements.empty:
-                st.subheader("📋 Master Announcements List")
                 # Display with formatted date
-                display_announcements = filtered_announcements.copy()
-                display_announcements['Posted'] = display_announcements['Posted_Formatted']
-                st.dataframe(display_announcements[['Student', 'Title', 'Preview', 'Posted', 'Course']], use_container_width=True)
-
-                st.divider()
-                st.subheader("👤 Student Breakdown")
-
-                cols = st.columns(3)
-                unique_students = filtered_announcements['Student'].unique()
+                display_announcements = format_dates(
+                    filtered_announcements[['Student', 'Title', 'Preview', 'Posted', 'Course']], 'Posted', '%m-%d'
+                )
 
-                for i, student in enumerate(unique_students):
-                    col = cols[i % 3]
-                    student_data = filtered_announcements[filtered_announcements['Student'] == student].copy()
-                    student_data['Posted'] = student_data['Posted_Formatted']
+                st.subheader("📋 Master Announcements List")
+                st.dataframe(display_announcements, width="stretch")
+                render_export_buttons(filtered_announcements, EXPORT_COLUMNS["announcements"], "announcements",
+                                      key="announcements")
 
-                    with col:
-                        with st.container(border=True):
-                            st.write(f"**{student}**")
-                            st.table(student_data[['Title', 'Preview', 'Posted']])
+                render_student_breakdown(display_announcements, ['Title', 'Preview', 'Posted'], key="announcements")
             else:
                 st.info(f"📢 No announcements in the selected timeframe.")
         else:
             st.info("📢 No announcements in this timeframe.")
 
-    # --- ASSIGNMENTS SECTION ---
+
+@st.fragment
+def render_assignments_section(todos_df):
     todos_count = len(todos_df) if todos_df is not None and not todos_df.empty else 0
     with st.expander(f"✅ ASSIGNMENTS ({todos_count})", expanded=True):
-        if todos_df is not None and not todos_df.empty:
-            # Add time filter for assignments
-            assignment_filter = st.radio(
-                "Show assignments due:",
-                ["This Week", "Next Week", "Next 2 Weeks", "Next 3 Weeks", "All Upcoming"],
-                index=2,
-                horizontal=True,
-                key="assignment_filter"
-            )
+        render_section_status("todos", "Assignments")
+
+        # Add time filter for assignments; shown even when empty, as a wider window may have some
+        assignment_filter = st.radio(
+            "Show assignments due:",
+            ASSIGNMENT_WINDOWS,
+            index=ASSIGNMENT_WINDOWS.index(DEFAULT_ASSIGNMENT_WINDOW),
+            horizontal=True,
+            key="assignment_filter"
+        )
+        section_windows()["todos"] = assignment_filter
 
-            # Calculate cutoff date based on filter
-            today = datetime.now()
-            days_until_sunday = 6 - today.weekday()
-            if days_until_sunday < 0:
-                days_until_sunday += 7
-            this_sunday = today + timedelta(days=days_until_sunday)
-
-            if assignment_filter == "This Week":
-                cutoff_date = this_sunday
-            elif assignment_filter == "Next Week":
-                cutoff_date = this_sunday + timedelta(weeks=1)
-            elif assignment_filter == "Next 2 Weeks":
-                cutoff_date = this_sunday + timedelta(weeks=2)
-            elif assignment_filter == "Next 3 Weeks":
-                cutoff_date = this_sunday + timedelta(weeks=3)
-            else:
-                cutoff_date = None
-
-            # Apply filter to assignments
-            filtered_todos = todos_df.copy()
-            if cutoff_date:
-                # Parse Due dates and filter
-                filtered_todos['Due_Parsed'] = pd.to_datetime(filtered_todos['Due'], format='%m-%d %H:%M', errors='coerce')
-                # Add current year for comparison
-                current_year = datetime.now().year
-                filtered_todos['Due_Parsed'] = filtered_todos['Due_Parsed'].apply(
-                    lambda x: x.replace(year=current_year) if pd.notna(x) else x
-                )
-                filtered_todos = filtered_todos[
-                    (filtered_todos['Due_Parsed'].isna()) |
-                    (filtered_todos['Due_Parsed'] <= cutoff_date)
-                ]
+        # To-dos are only synced out to the widest window in use; fetch the added weeks
+        if store.show_todo_window(assignment_filter):
+            with st.spinner(f"Syncing assignments due {assignment_filter.lower()}..."):
+                store.widen_todos()
+            st.rerun()
+
+        if todos_df is not None and not todos_df.empty:
+            # Apply filter to assignments, keeping undated tasks and anything due by the cutoff
+            filtered_todos = filter_window(todos_df, 'Due', end=assignment_cutoff(assignment_filter))
 
             if not filtered_todos.empty:
+                display_todos = format_dates(filtered_todos[['Student', 'Task', 'Due', 'Status']], 'Due', '%m-%d %H:%M')
+                display_todos = with_new_column(display_todos, new_since_last_sync(filtered_todos, "todos"))
+
                 st.caption(f"Showing {len(filtered_todos)} assignment(s)")
                 st.subheader("📋 Master List")
                 st.dataframe(
-                    filtered_todos[['Student', 'Task', 'Due', 'Status']],
-                    use_container_width=True,
+                    display_todos,
+                    width="stretch",
                     column_config={
                         "Status": st.column_config.TextColumn(
                             "Status",
@@ -709,22 +882,201 @@ if st.session_state.data_loaded:
                         )
                     }
                 )
+                render_export_buttons(filtered_todos, EXPORT_COLUMNS["todos"], "assignments", key="assignments")
 
-                st.divider()
-                st.subheader("👤 Student Breakdown")
-
-                cols = st.columns(3)
-                unique_students = filtered_todos['Student'].unique()
-
-                for i, student in enumerate(unique_students):
-                    col = cols[i % 3]
-                    student_work = filtered_todos[filtered_todos['Student'] == student]
-
-                    with col:
-                        with st.container(border=True):
-                            st.write(f"**{student}**")
-                            st.table(student_work[['Task', 'Status', 'Due']])
+                render_student_breakdown(display_todos, ['Task', 'Status', 'Due'], key="assignments")
             else:
                 st.success("🎉 No assignments found for this time period!")
         else:
             st.success("🎉 No active assignments found!")
+
+
+# Trend chart choices: metric -> (history table, filter), and look-back windows
+TREND_METRICS = {
+    "Grade Alerts": ("grades", None),
+    "Missing": ("grades", {"Issue": ["Missing", "Unsubmitted"]}),
+    "Zero Grades": ("grades", {"Issue": ["Zero Grade"]}),
+    "Assignments": ("todos", None),
+}
+TREND_WINDOWS = {
+    "Last Week": timedelta(weeks=1),
+    "Last Month": timedelta(days=30),
+    "Last 3 Months": timedelta(days=90),
+}
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def load_trend(metric, window, students, latest_sync):
+    """Per-sync counts for a TREND_METRICS entry; latest_sync only keys the cache to the newest data"""
+    table, where = TREND_METRICS[metric]
+    start = pd.Timestamp.now(tz="UTC").floor("D") - TREND_WINDOWS[window]
+    return history_counts(table, start=start, students=list(students), where=where)
+
+
+@st.fragment
+def render_trends_section():
+    with st.expander("📈 TRENDS", expanded=False):
+        col_metric, col_window = st.columns(2)
+        metric = col_metric.radio("Show:", list(TREND_METRICS), horizontal=True, key="trend_metric")
+        window = col_window.radio("Over:", list(TREND_WINDOWS), index=1, horizontal=True, key="trend_window")
+
+        table = TREND_METRICS[metric][0]
+        counts = load_trend(metric, window, tuple(selected_students), store.section_synced_at.get(table))
+        if counts.empty:
+            st.info("📈 No history yet; every sync adds a point.")
+            return
+
+        counts.index = counts.index.tz_convert(DISPLAY_TIMEZONE)
+        if len(counts.columns) > BREAKDOWN_PAGE_SIZE:
+            # One line per student stops being readable; chart the total instead
+            counts = counts.sum(axis=1).rename("All selected students").to_frame()
+        st.line_chart(counts)
+        st.caption(f"{metric} per student at each sync since {counts.index[0]:%m-%d}")
+
+
+def export_student_workbook(name, frames, windows):
+    """One student's workbook: a sheet per loaded section, filtered to the window that section shows"""
+    grades_df, convos_df, announcements_df, todos_df = (
+        None if df is None else df[df['Student'] == name] for df in frames
+    )
+    sections = {
+        "grades": grades_df,
+        "conversations": filter_window(
+            convos_df, 'Date', start=window_start(windows.get("conversations", list(RECENT_WINDOWS)[3])),
+            newest_first=True
+        ) if convos_df is not None else None,
+        "announcements": filter_window(
+            announcements_df, 'Posted', start=window_start(windows.get("announcements", list(RECENT_WINDOWS)[3])),
+            newest_first=True
+        ) if announcements_df is not None else None,
+        "todos": filter_window(
+            todos_df, 'Due', end=assignment_cutoff(windows.get("todos", DEFAULT_ASSIGNMENT_WINDOW))
+        ) if todos_df is not None else None,
+    }
+    return export_file("xlsx", {
+        EXPORT_SHEETS[section]: iter_frame_chunks(df, EXPORT_COLUMNS[section][1:])
+        for section, df in sections.items() if df is not None and section in store.loaded_sections()
+    })
+
+
+def export_history(table, window, students, fmt):
+    """Exports table's history rows for students over a TREND_WINDOWS window, read chunk by chunk"""
+    start = pd.Timestamp.now(tz="UTC").floor("D") - TREND_WINDOWS[window]
+    return export_file(fmt, iter_history_chunks(table, start=start, students=students))
+
+
+@st.fragment
+def render_export_section(frames):
+    with st.expander("⬇️ EXPORT", expanded=False):
+        st.caption("Files are built when you click, using each section's current time filter.")
+        stamp = pd.Timestamp.now(tz=DISPLAY_TIMEZONE).strftime("%Y%m%d-%H%M")
+
+        st.subheader("👤 Student Workbook")
+        if excel_export_available():
+            col_student, col_button = st.columns([3, 1])
+            name = col_student.selectbox("Student:", selected_students, key="export_student")
+            mime, extension = EXPORT_FORMATS["xlsx"]
+            col_button.download_button(
+                "⬇️ Excel", partial(export_student_workbook, name, frames, section_windows()),
+                file_name=f"{name}-{stamp}.{extension}", mime=mime, key="export_workbook", on_click="ignore",
+                disabled=name is None
+            )
+        else:
+            st.info("📦 Install xlsxwriter (`pip install xlsxwriter`) to export Excel workbooks.")
+
+        if canvas_sync.HISTORY_PATH:
+            st.subheader("📈 History")
+            col_table, col_window, col_format = st.columns(3)
+            table = col_table.radio("Rows:", ["grades", "todos"], key="export_history_table", horizontal=True,
+                                    format_func=EXPORT_SHEETS.get)
+            window = col_window.radio("Over:", list(TREND_WINDOWS), index=1, key="export_history_window")
+            fmt = col_format.radio("Format:", ["csv", "parquet"], key="export_history_format",
+                                   format_func=str.upper)
+            mime, extension = EXPORT_FORMATS[fmt]
+            st.download_button(
+                "⬇️ Export history", partial(export_history, table, window, list(selected_students), fmt),
+                file_name=f"{table}-history-{stamp}.{extension}", mime=mime, key="export_history",
+                on_click="ignore"
+            )
+            st.caption("One row per alert or assignment at every sync, with its Synced At time (UTC).")
+
+
+@contextmanager
+def timed(timings, stage):
+    """Adds the enclosed block's duration to timings, a list of stage rows"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.append({"stage": stage, "seconds": round(time.perf_counter() - started, 4)})
+
+
+@st.fragment
+def render_diagnostics_section(metrics):
+    if not st.toggle("🩺 Show sync diagnostics", key="show_diagnostics"):
+        return
+
+    with st.expander("🩺 DIAGNOSTICS", expanded=True):
+        if metrics is None:
+            st.info("⏳ No sync has finished yet.")
+            return
+
+        totals = metrics.totals()
+        cols = st.columns(6)
+        cols[0].metric("Sync time", f"{totals['wall_seconds']:.1f}s")
+        cols[1].metric("Requests", totals['requests'])
+        cols[2].metric("Cache hits", totals['cache_hits'])
+        cols[3].metric("Throttled", totals['throttled'])
+        cols[4].metric("Errors", totals['errors'])
+        cols[5].metric("Downloaded", f"{totals['bytes'] / 1e6:.2f} MB")
+        st.caption(f"Last sync started {describe_age(metrics.started_at)}")
+        open_paths = get_canvas_client().breaker.open_paths() if store.can_sync else []
+        if open_paths:
+            st.warning(f"🔌 Skipping Canvas paths that keep failing, for now: {', '.join(open_paths)}")
+
+        st.subheader("🌐 By Endpoint")
+        st.dataframe(metrics.summarize("endpoint"), width="stretch")
+
+        st.subheader("👤 By Student")
+        st.dataframe(metrics.summarize("student"), width="stretch")
+
+        # Sync stages come from the last refresh; render stages from this page load
+        st.subheader("⏱️ Stages")
+        stages = pd.DataFrame(metrics.stages + st.session_state.get("render_timings", []), columns=["stage", "seconds"])
+        st.dataframe(
+            stages.groupby("stage", sort=False).agg(runs=("seconds", "size"), total_seconds=("seconds", "sum")),
+            width="stretch"
+        )
+
+        st.subheader("🐢 Slowest Requests")
+        slowest = pd.DataFrame(metrics.requests).nlargest(10, "seconds") if metrics.requests else pd.DataFrame()
+        st.dataframe(slowest, width="stretch")
+
+        st.download_button(
+            "⬇️ Export diagnostics (JSON)",
+            metrics.to_json(),
+            file_name=f"sync-diagnostics-{metrics.started_at:%Y%m%d-%H%M%S}.json",
+            mime="application/json"
+        )
+
+
+if data_loaded:
+    render_timings = []
+    with timed(render_timings, "render summary"):
+        render_summary_section(grades_df, convos_df, announcements_df, todos_df)
+    with timed(render_timings, "render grades"):
+        render_grades_section(grades_df)
+    with timed(render_timings, "render messages"):
+        render_messages_section(convos_df)
+    with timed(render_timings, "render announcements"):
+        render_announcements_section(announcements_df)
+    with timed(render_timings, "render assignments"):
+        render_assignments_section(todos_df)
+    if canvas_sync.HISTORY_PATH:
+        with timed(render_timings, "render trends"):
+            render_trends_section()
+    with timed(render_timings, "render export"):
+        render_export_section((grades_df, convos_df, announcements_df, todos_df))
+    st.session_state.render_timings = render_timings
+
+render_diagnostics_section(store.metrics)
@@ -0,0 +1,303 @@
+"""Tests for canvas_sync; nothing here talks to a real Canvas"""
+import copy
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import pytest
+
+import canvas_sync
+from canvas_sync import CircuitBreaker, GradeRecord, TodoRecord, filter_window, merge_records, merge_todo_fetches, \
+    plan_todo_fetches, sort_by_time, sync_state_from_json, sync_state_to_json, sync_student_grades
+from fake_canvas import FakeCanvas
+
+PATH = "/api/v1/conversations"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces time.monotonic in canvas_sync with a clock the test advances by hand"""
+    now = [1000.0]
+    monkeypatch.setattr(canvas_sync.time, "monotonic", lambda: now[0])
+    return now
+
+
+def fail(breaker, path=PATH):
+    ticket = breaker.acquire(path)
+    assert ticket is not None
+    breaker.release(path, ticket, False)
+
+
+def test_breaker_opens_after_threshold_failures(clock):
+    breaker = CircuitBreaker(threshold=3, reset_seconds=60, stall_seconds=10)
+    for _ in range(2):
+        fail(breaker)
+    assert breaker.open_paths() == []
+    fail(breaker)
+    assert breaker.acquire(PATH) is None
+    assert breaker.open_paths() == [PATH]
+    assert breaker.acquire("/api/v1/courses") is not None
+
+
+def test_breaker_half_opens_for_one_trial_and_closes_on_success(clock):
+    breaker = CircuitBreaker(threshold=3, reset_seconds=60, stall_seconds=10)
+    for _ in range(3):
+        fail(breaker)
+
+    clock[0] += 61
+    assert breaker.open_paths() == [PATH]  # Still skipped until the trial succeeds
+    trial = breaker.acquire(PATH)
+    assert trial is not None
+    assert breaker.acquire(PATH) is None  # Only one trial at a time
+
+    breaker.release(PATH, trial, True)
+    assert breaker.open_paths() == []
+    assert breaker.acquire(PATH) is not None
+
+
+def test_breaker_reopens_when_trial_fails(clock):
+    breaker = CircuitBreaker(threshold=3, reset_seconds=60, stall_seconds=10)
+    for _ in range(3):
+        fail(breaker)
+
+    clock[0] += 61
+    fail(breaker)
+    assert breaker.acquire(PATH) is None
+    clock[0] += 30
+    assert breaker.acquire(PATH) is None
+    clock[0] += 31
+    assert breaker.acquire(PATH) is not None
+
+
+def test_breaker_ignores_slow_requests_on_healthy_path(clock):
+    breaker = CircuitBreaker(threshold=3, reset_seconds=60, stall_seconds=10)
+    slow = [breaker.acquire(PATH) for _ in range(3)]
+    clock[0] += 12
+    assert breaker.acquire(PATH) is not None
+    assert breaker.open_paths() == []
+    for ticket in slow:
+        breaker.release(PATH, ticket, True)
+
+
+def test_breaker_counts_stuck_requests_once_path_failed(clock):
+    breaker = CircuitBreaker(threshold=3, reset_seconds=60, stall_seconds=10)
+    fail(breaker)
+    stuck = [breaker.acquire(PATH) for _ in range(2)]
+    assert breaker.acquire(PATH) is not None  # Not stuck yet
+    clock[0] += 11
+    assert breaker.acquire(PATH) is None
+    assert breaker.open_paths() == [PATH]
+    breaker.release(PATH, stuck[0], True)
+    assert breaker.acquire(PATH) is not None
+
+
+def test_breaker_ignores_outcomes_that_say_nothing(clock):
+    breaker = CircuitBreaker(threshold=1, reset_seconds=60, stall_seconds=10)
+    ticket = breaker.acquire(PATH)
+    breaker.release(PATH, ticket, None)
+    assert breaker.acquire(PATH) is not None
+
+
+NOW = datetime(2026, 10, 5, 12, tzinfo=timezone.utc)
+DAY = timedelta(days=1)
+
+
+def done(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def todo(task, due):
+    return TodoRecord("Ana", task, due.isoformat(), "Todo")
+
+
+def test_merge_records_overlays_changed_and_applies_keep():
+    previous = [("a", 1), ("b", 1), ("c", 1)]
+    changed = [("b", 2), ("d", 0)]
+    merged = merge_records(previous, changed, key=lambda row: row[0], keep=lambda row: row[1] > 0)
+    assert merged == [("a", 1), ("b", 2), ("c", 1)]
+
+
+def test_plan_todo_fetches_fetches_whole_window_without_ranges():
+    cached, missing = plan_todo_fetches([], NOW, NOW + 14 * DAY, NOW, max_age=3600)
+    assert cached == []
+    assert missing == [(NOW, NOW + 14 * DAY)]
+
+
+def test_plan_todo_fetches_only_fetches_added_weeks():
+    ranges = [(NOW, NOW + 7 * DAY, NOW - timedelta(minutes=5))]
+    cached, missing = plan_todo_fetches(ranges, NOW, NOW + 21 * DAY, NOW, max_age=3600)
+    assert cached == ranges
+    assert missing == [(NOW + 7 * DAY, NOW + 21 * DAY)]
+
+
+def test_plan_todo_fetches_fills_gaps_and_skips_expired_ranges():
+    ranges = [
+        (NOW + 2 * DAY, NOW + 4 * DAY, NOW),
+        (NOW + 4 * DAY, NOW + 9 * DAY, NOW - timedelta(hours=2)),  # Too old to count
+        (NOW + 6 * DAY, None, NOW),
+    ]
+    cached, missing = plan_todo_fetches(ranges, NOW, None, NOW, max_age=3600)
+    assert cached == [ranges[0], ranges[2]]
+    assert missing == [(NOW, NOW + 2 * DAY), (NOW + 4 * DAY, NOW + 6 * DAY)]
+
+
+def test_merge_todo_fetches_replaces_fetched_range_and_keeps_cut_short_one():
+    cached = [(NOW, NOW + 7 * DAY, NOW)]
+    previous = [
+        todo("past", NOW - DAY),
+        todo("cached", NOW + DAY),
+        todo("refetched", NOW + 8 * DAY),
+        todo("cut short", NOW + 12 * DAY),
+    ]
+    fetches = [
+        (NOW + 7 * DAY, NOW + 10 * DAY, done([todo("new", NOW + 9 * DAY)])),
+        (NOW + 10 * DAY, NOW + 14 * DAY, done(None)),
+    ]
+    todos, ranges = merge_todo_fetches(previous, cached, fetches, NOW, NOW + 14 * DAY, NOW)
+    assert sorted(row.task for row in todos) == ["cached", "cut short", "new"]
+    assert ranges == cached + [(NOW + 7 * DAY, NOW + 10 * DAY, NOW)]
+
+
+def test_merge_todo_fetches_lists_boundary_items_once():
+    boundary = todo("boundary", NOW + 7 * DAY)
+    twin = todo("twin", NOW + 8 * DAY)
+    cached = [(NOW, NOW + 7 * DAY, NOW)]
+    previous = [todo("cached", NOW + DAY), boundary]  # The cached fetch included its end date
+    fetches = [
+        (NOW + 7 * DAY, NOW + 10 * DAY, done([boundary, twin, twin, todo("end", NOW + 10 * DAY)])),
+        (NOW + 10 * DAY, NOW + 14 * DAY, done([todo("end", NOW + 10 * DAY)])),
+    ]
+    todos, _ = merge_todo_fetches(previous, cached, fetches, NOW, NOW + 14 * DAY, NOW)
+    assert sorted(row.task for row in todos) == ["boundary", "cached", "end", "twin", "twin"]
+
+
+def grade(course_id, assignment_id, issue):
+    return GradeRecord("Ana", course_id, assignment_id, f"Assignment {assignment_id}", f"Course {course_id}", issue,
+                       None, "")
+
+
+@pytest.fixture
+def grade_fetches(monkeypatch):
+    """Stands in for Canvas' course, missing work and per-course grade fetches
+
+    Set "courses", "missing" and "grades" (course id -> rows, or None for a failed
+    course); "since" records the since each course's grades were fetched with.
+    """
+    canvas = {"courses": [{"id": 1}, {"id": 2}], "missing": [], "grades": {}, "since": {}}
+
+    def get_course_grades(name, token, course, client=None, since=None):
+        canvas["since"][course["id"]] = since
+        return canvas["grades"].get(course["id"], [])
+
+    monkeypatch.setattr(canvas_sync, "FETCH_BACKEND", "rest")
+    monkeypatch.setattr(canvas_sync, "get_student_courses", lambda name, token, client=None: canvas["courses"])
+    monkeypatch.setattr(canvas_sync, "get_student_missing", lambda name, token, client=None: canvas["missing"])
+    monkeypatch.setattr(canvas_sync, "get_course_grades", get_course_grades)
+    return canvas
+
+
+def sync_grades(previous=None, carried=None):
+    with ThreadPoolExecutor(max_workers=2) as request_pool:
+        return sync_student_grades("Ana", "token", request_pool, None, previous, NOW, carried)
+
+
+def grades_state(grades, since):
+    return {"courses": [{"id": 1}, {"id": 2}], "grades": grades, "grades_since": {1: since, 2: since},
+            "missing_since": since}
+
+
+def test_sync_student_grades_full_fetch_prefers_zero_grade_over_missing(grade_fetches):
+    grade_fetches["missing"] = [grade(1, 10, "Missing"), grade(2, 20, "Missing")]
+    grade_fetches["grades"] = {1: [grade(1, 10, "Zero Grade")], 2: [grade(2, 21, "Zero Grade")]}
+
+    courses, grades, grades_since, missing_since = sync_grades()
+    assert courses == [{"id": 1}, {"id": 2}]
+    assert sorted(grades) == [grade(1, 10, "Zero Grade"), grade(2, 20, "Missing"), grade(2, 21, "Zero Grade")]
+    assert grades_since == {1: NOW, 2: NOW}
+    assert missing_since == NOW
+    assert grade_fetches["since"] == {1: None, 2: None}
+
+
+def test_sync_student_grades_incremental_fetch_clears_resolved_alerts(grade_fetches):
+    last_sync = NOW - timedelta(hours=1)
+    previous = grades_state([grade(1, 10, "Zero Grade"), grade(2, 20, "Missing"), grade(2, 21, "Zero Grade")],
+                            last_sync)
+    grade_fetches["missing"] = [grade(2, 20, "Missing")]
+    grade_fetches["grades"] = {1: [grade(1, 10, None)], 2: [grade(2, 22, "Zero Grade")]}
+
+    _, grades, grades_since, _ = sync_grades(previous)
+    assert sorted(grades) == [grade(2, 20, "Missing"), grade(2, 21, "Zero Grade"), grade(2, 22, "Zero Grade")]
+    assert grades_since == {1: NOW, 2: NOW}
+    assert grade_fetches["since"] == {1: last_sync, 2: last_sync}
+
+
+def test_sync_student_grades_keeps_failed_course_rows_and_mark(grade_fetches):
+    last_sync = NOW - timedelta(hours=1)
+    previous = grades_state([grade(1, 10, "Zero Grade"), grade(2, 21, "Zero Grade")], last_sync)
+    grade_fetches["grades"] = {1: [grade(1, 10, None)], 2: None}
+
+    _, grades, grades_since, _ = sync_grades(previous)
+    assert grades == [grade(2, 21, "Zero Grade")]
+    assert grades_since == {1: NOW, 2: last_sync}
+
+
+def test_sync_student_grades_full_refresh_replaces_refetched_courses(grade_fetches):
+    carried = grades_state([grade(1, 10, "Zero Grade"), grade(2, 21, "Zero Grade")], NOW - timedelta(hours=1))
+    grade_fetches["courses"] = None  # The course list fails too, so the carried one is used
+    grade_fetches["grades"] = {1: [grade(1, 11, "Zero Grade")], 2: None}
+
+    courses, grades, grades_since, _ = sync_grades(carried=carried)
+    assert courses == carried["courses"]
+    assert sorted(grades) == [grade(1, 11, "Zero Grade"), grade(2, 21, "Zero Grade")]
+    assert grades_since == {1: NOW}
+
+
+def test_filter_window_slices_sorted_frame():
+    df = sort_by_time(pd.DataFrame({
+        "Date": pd.to_datetime([NOW - 3 * DAY, None, NOW - DAY, NOW - 10 * DAY], utc=True),
+        "Subject": ["three", "undated", "one", "ten"],
+    }), "Date")
+    assert list(filter_window(df, "Date", start=NOW - 5 * DAY)["Subject"]) == ["three", "one"]
+    assert list(filter_window(df, "Date", end=NOW - 2 * DAY)["Subject"]) == ["undated", "ten", "three"]
+    assert list(filter_window(df, "Date", newest_first=True)["Subject"]) == ["one", "three", "ten", "undated"]
+
+
+@pytest.fixture
+def fake_canvas(monkeypatch):
+    """Serves a small FakeCanvas in this process and points canvas_sync at it"""
+    canvas = FakeCanvas(students=3, courses_per_student=3, submissions_per_course=20)
+    monkeypatch.setattr(canvas_sync, "API_URL", canvas.start())
+    yield canvas
+    canvas.stop()
+
+
+def test_sync_state_survives_json_round_trip(fake_canvas):
+    tokens = fake_canvas.tokens()
+    client = canvas_sync.CanvasClient()
+    sync_state = {}
+    canvas_sync.sync_students(tokens, client=client, sync_state=sync_state, deadline_seconds=0)
+
+    restored = sync_state_from_json(sync_state_to_json(sync_state))
+    assert restored == sync_state
+
+    expected = canvas_sync.sync_students(tokens, client=client, sync_state=copy.deepcopy(sync_state),
+                                         deadline_seconds=0)
+    frames = canvas_sync.sync_students(tokens, client=client, sync_state=restored, deadline_seconds=0)
+    assert not expected[0].empty and not expected[3].empty
+    for frame, expected_frame in zip(frames, expected):
+        pd.testing.assert_frame_equal(frame, expected_frame)
+
+
+def test_response_cache_is_private_and_skips_conversations(fake_canvas, tmp_path):
+    cache = canvas_sync.ResponseCache(str(tmp_path / "cache" / "responses.sqlite3"))
+    client = canvas_sync.CanvasClient(cache=cache)
+    name, token = next(iter(fake_canvas.tokens().items()))
+    assert canvas_sync.get_student_conversations(name, token, client)
+    assert canvas_sync.get_student_courses(name, token, client)
+
+    stored = cache._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+    assert stored == 1  # Only the course list
+    assert (tmp_path / "cache").stat().st_mode & 0o777 == 0o700
+    assert (tmp_path / "cache" / "responses.sqlite3").stat().st_mode & 0o777 == 0o600